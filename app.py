@@ -37,13 +37,26 @@ but will have different HTTP-verbs.
 
 # IMPLEMENT THE ACTUAL ENDPOINTS! Feel free to remove
 
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import List, Optional, Literal
 import psycopg2
-from db_setup import get_connection
-from fastapi import FastAPI, HTTPException, status, Query, Path, Body
+from db_setup import REPLICAS, get_pool, get_replica_set, close_pool
+from pool import PoolTimeout
+from cache import get_cache
+from fastapi import FastAPI, HTTPException, status, Query, Path, Body, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, date
+import csv
+import io
+import time
 import db
+import metrics
+import events
+from compression import CompressionMiddleware
+from replicas import NoReplicaAvailable, ReadYourWritesMiddleware, pinned_to_primary
+from responses import FastJSONResponse, dumps, validators, not_modified
 
 # Import schemas
 try:
@@ -63,13 +76,84 @@ except ImportError:
     # Fallback if schemas not available
     pass
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the pool up front so the first requests don't pay for the connection handshake
+    get_pool().open()
+    if get_replica_set() is not None:
+        get_replica_set().open()
+    yield
+    events.stop_listener()
+    close_pool()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Hemnet Clone API",
     description="A simplified API for a real estate platform similar to Hemnet.se",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=FastJSONResponse
 )
+# The metrics middleware is added last so it wraps compression, request durations include it
+app.add_middleware(CompressionMiddleware)
+if REPLICAS:
+    # Clients that wrote read from the primary for a few seconds, see get_read_db
+    app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.exception_handler(PoolTimeout)
+def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(status_code=503, content={"detail": "Database is busy, try again later"})
+
+# ========== DEPENDENCIES ==========
+def get_db():
+    """
+    Borrows a connection from the pool for the duration of the request,
+    it's handed back to the pool when the request ends (also when an exception is raised)
+    """
+    pool = get_pool()
+    start = time.perf_counter()
+    conn = pool.getconn()
+    metrics.observe_pool_wait(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def _read_checkout(request: Optional[Request] = None):
+    """
+    A connection for reading and the pool to hand it back to: a replica when DB_REPLICAS has a healthy one
+    and the client isn't pinned to the primary after a write, the primary otherwise
+    """
+    replicas = get_replica_set()
+    if replicas is not None and (request is None or not pinned_to_primary(request)):
+        try:
+            return replicas, replicas.getconn()
+        except NoReplicaAvailable:
+            pass
+    pool = get_pool()
+    return pool, pool.getconn()
+
+def get_read_db(request: Request):
+    """
+    get_db for endpoints that only read, the connection may be a replica's.
+    Endpoints that read through a @cached db function stay on get_db, a lagging replica
+    could put the state from before a write back into the cache
+    """
+    start = time.perf_counter()
+    pool, conn = _read_checkout(request)
+    metrics.observe_pool_wait(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def get_fields(fields: Optional[str] = Query(None, description="Comma separated columns to return, default all")):
+    """The fields= parameter of the list endpoints, the db functions check the names against their whitelist"""
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()] or None
 
 # ========== HEALTH CHECK ==========
 @app.get("/", tags=["Health"])
@@ -78,26 +162,39 @@ def root():
 
 @app.get("/health", tags=["Health"])
 def health_check():
+    pool = get_pool()
     try:
-        conn = get_connection()
-        conn.close()
-        return {"status": "healthy", "database": "connected"}
+        conn = pool.getconn()
+        pool.putconn(conn)
+        return {"status": "healthy", "database": "connected", "pool": pool.stats(), "cache": get_cache().stats(),
+                "events": events.get_listener().stats(),
+                "replicas": get_replica_set().stats() if get_replica_set() is not None else None}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database connection failed: {str(e)}")
 
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+def get_metrics():
+    """Request, query and pool metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(get_pool().stats(), get_cache().stats()),
+                             media_type="text/plain; version=0.0.4")
+
 # ========== USER ENDPOINTS ==========
 @app.get("/users", tags=["Users"])
 def get_all_users(
     limit: int = Query(100, ge=1, le=500),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page, replaces offset"),
+    fields: Optional[List[str]] = Depends(get_fields),
+    conn=Depends(get_read_db)
 ):
-    conn = get_connection()
-    users = db.get_users(conn, limit, offset)
-    return {"users": users, "count": len(users)}
+    try:
+        users = db.get_users(conn, limit, offset, after=cursor, fields=fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"users": users, "count": len(users), "next_cursor": db.next_cursor(users, limit, "user_id")}
 
 @app.get("/users/{user_id}", tags=["Users"])
-def get_user_by_id(user_id: int = Path(..., gt=0)):
-    conn = get_connection()
+def get_user_by_id(user_id: int = Path(..., gt=0), conn=Depends(get_read_db)):
     user = db.get_user(conn, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -105,8 +202,7 @@ def get_user_by_id(user_id: int = Path(..., gt=0)):
 
 
 @app.post("/users", status_code=status.HTTP_201_CREATED, tags=["Users"])
-def create_user(user_data: dict):
-    conn = get_connection()
+def create_user(user_data: dict, conn=Depends(get_db)):
     try:
         # Validate required fields
         required_fields = ['email', 'password_hash', 'first_name', 'last_name', 'user_type', 'role']
@@ -137,9 +233,7 @@ def create_user(user_data: dict):
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}") 
     
 @app.put("/users/{user_id}", tags=["Users"])
-def update_user(user_id: int = Path(..., gt=0), user_data: dict = Body(...)):
-    conn = get_connection()
-    
+def update_user(user_id: int = Path(..., gt=0), user_data: dict = Body(...), conn=Depends(get_db)):
     # Check if user exists
     existing_user = db.get_user(conn, user_id)
     if not existing_user:
@@ -163,50 +257,172 @@ def update_user(user_id: int = Path(..., gt=0), user_data: dict = Body(...)):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Users"])
-def delete_user(user_id: int = Path(..., gt=0)):
-    conn = get_connection()
+def delete_user(user_id: int = Path(..., gt=0), conn=Depends(get_db)):
     deleted = db.delete_user(conn, user_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="User not found")
     return None
 
+# ========== BULK IMPORT ENDPOINTS ==========
+# Declared before /listings/{listing_id}, otherwise "bulk" would be taken for a listing id.
+# POST only creates rows whose external_ref is new, PUT also updates the existing ones
+BULK_MAX_ROWS = 10000
+BULK_STATUSES = ("created", "updated", "exists", "unchanged", "error")
+
+def _bulk_rows(payload: dict, key: str) -> list:
+    rows = payload.get(key)
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise HTTPException(status_code=400, detail=f"Expected a list of objects in '{key}'")
+    if not 1 <= len(rows) <= BULK_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"'{key}' must contain between 1 and {BULK_MAX_ROWS} rows")
+    return rows
+
+def _bulk_response(results: list) -> dict:
+    summary = {status_name: 0 for status_name in BULK_STATUSES}
+    for result in results:
+        summary[result["status"]] += 1
+    return {"count": len(results), **summary, "results": results}
+
+@app.post("/listings/bulk", tags=["Bulk import"])
+def bulk_create_listings(payload: dict = Body(..., description='{"listings": [{"external_ref": ..., ...}]}'),
+                         conn=Depends(get_db)):
+    return _bulk_response(db.bulk_import_listings(conn, _bulk_rows(payload, "listings")))
+
+@app.put("/listings/bulk", tags=["Bulk import"])
+def bulk_upsert_listings(payload: dict = Body(..., description='{"listings": [{"external_ref": ..., ...}]}'),
+                         conn=Depends(get_db)):
+    return _bulk_response(db.bulk_import_listings(conn, _bulk_rows(payload, "listings"), upsert=True))
+
+@app.post("/images/bulk", tags=["Bulk import"])
+def bulk_create_images(payload: dict = Body(..., description='{"images": [{"external_ref": ..., "listing_external_ref": ..., ...}]}'),
+                       conn=Depends(get_db)):
+    return _bulk_response(db.bulk_import_images(conn, _bulk_rows(payload, "images")))
+
+@app.put("/images/bulk", tags=["Bulk import"])
+def bulk_upsert_images(payload: dict = Body(..., description='{"images": [{"external_ref": ..., "listing_external_ref": ..., ...}]}'),
+                       conn=Depends(get_db)):
+    return _bulk_response(db.bulk_import_images(conn, _bulk_rows(payload, "images"), upsert=True))
+
 # ========== LISTING ENDPOINTS ==========
 @app.get("/listings", tags=["Listings"])
 def get_all_listings(
     limit: int = Query(100, ge=1, le=500),
     offset: int = Query(0, ge=0),
     city: Optional[str] = Query(None),
+    city_match: Literal["substring", "prefix", "exact"] = Query("substring", description="How city is matched, case insensitive"),
     min_price: Optional[Decimal] = Query(None, gt=0),
     max_price: Optional[Decimal] = Query(None, gt=0),
-    category_id: Optional[int] = Query(None, gt=0)
+    category_id: Optional[int] = Query(None, gt=0),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page, replaces offset"),
+    summary: bool = Query(False, description="Search page rows: fewer columns, with primary image, bid and favorite counts"),
+    fields: Optional[List[str]] = Depends(get_fields),
+    conn=Depends(get_read_db)
+):
+    try:
+        listings = db.get_listings(
+            conn, limit, offset, 
+            city=city, 
+            min_price=min_price, 
+            max_price=max_price,
+            category_id=category_id,
+            after=cursor,
+            city_match=city_match,
+            summary=summary,
+            fields=fields
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Returned as a response so the rows skip jsonable_encoder, see responses.py
+    return FastJSONResponse({
+        "listings": listings,
+        "count": len(listings),
+        "next_cursor": db.next_cursor(listings, limit, "created_at", "listing_id")
+    })
+
+# Declared before /listings/{listing_id}, otherwise "search" and "geo" would be taken for a listing id
+@app.get("/listings/geo", tags=["Listings"])
+def get_listings_by_location(
+    lat: Optional[float] = Query(None, ge=-90, le=90, description="Center of a radius search"),
+    lon: Optional[float] = Query(None, ge=-180, le=180, description="Center of a radius search"),
+    radius_km: Optional[float] = Query(None, gt=0, le=500),
+    min_lat: Optional[float] = Query(None, ge=-90, le=90, description="Viewport, south edge"),
+    min_lon: Optional[float] = Query(None, ge=-180, le=180, description="Viewport, west edge"),
+    max_lat: Optional[float] = Query(None, ge=-90, le=90, description="Viewport, north edge"),
+    max_lon: Optional[float] = Query(None, ge=-180, le=180, description="Viewport, east edge"),
+    limit: int = Query(100, ge=1, le=500),
+    min_price: Optional[Decimal] = Query(None, gt=0),
+    max_price: Optional[Decimal] = Query(None, gt=0),
+    category_id: Optional[int] = Query(None, gt=0),
+    conn=Depends(get_read_db)
+):
+    filters = dict(min_price=min_price, max_price=max_price, category_id=category_id)
+    viewport = (min_lat, min_lon, max_lat, max_lon)
+
+    if None not in (lat, lon, radius_km):
+        listings = db.get_listings_in_radius(conn, lat, lon, radius_km, limit, **filters)
+    elif None not in viewport:
+        if min_lat > max_lat or min_lon > max_lon:
+            raise HTTPException(status_code=400, detail="min_lat/min_lon must be below max_lat/max_lon")
+        listings = db.get_listings_in_bbox(conn, *viewport, limit, **filters)
+    else:
+        raise HTTPException(status_code=400, detail="Give either lat, lon and radius_km or min_lat, min_lon, max_lat and max_lon")
+
+    return FastJSONResponse({"listings": listings, "count": len(listings)})
+
+@app.get("/listings/search", tags=["Listings"])
+def search_listings(
+    q: str = Query(..., min_length=1, description="Search words, supports \"phrases\", OR and -word"),
+    limit: int = Query(20, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    city: Optional[str] = Query(None),
+    city_match: Literal["substring", "prefix", "exact"] = Query("substring", description="How city is matched, case insensitive"),
+    min_price: Optional[Decimal] = Query(None, gt=0),
+    max_price: Optional[Decimal] = Query(None, gt=0),
+    category_id: Optional[int] = Query(None, gt=0),
+    conn=Depends(get_read_db)
 ):
-    conn = get_connection()
-    listings = db.get_listings(
-        conn, limit, offset, 
-        city=city, 
-        min_price=min_price, 
+    listings = db.search_listings(
+        conn, q, limit, offset,
+        city=city,
+        min_price=min_price,
         max_price=max_price,
-        category_id=category_id
+        category_id=category_id,
+        city_match=city_match
     )
-    return {"listings": listings, "count": len(listings)}
+    return FastJSONResponse({"listings": listings, "count": len(listings)})
 
 @app.get("/listings/{listing_id}", tags=["Listings"])
-def get_listing_by_id(listing_id: int = Path(..., gt=0)):
-    conn = get_connection()
-    listing = db.get_listing(conn, listing_id)
+def get_listing_by_id(
+    request: Request,
+    listing_id: int = Path(..., gt=0),
+    include: Optional[str] = Query(None, description="Comma separated parts to include: images, agent, stats. Default all"),
+    conn=Depends(get_read_db)
+):
+    parts = db.LISTING_DETAIL_PARTS
+    if include is not None:
+        parts = [part.strip() for part in include.split(",") if part.strip()]
+    unknown = set(parts) - set(db.LISTING_DETAIL_PARTS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown include: {', '.join(sorted(unknown))}")
+
+    # 304 if the client's copy is current, without the detail query
+    version = db.get_listing_version(conn, listing_id)
+    headers = validators(version, f"listing-{listing_id}-{','.join(sorted(set(parts)))}")
+    if not_modified(request, version, headers):
+        return Response(status_code=304, headers=headers)
+    
+    # Listing, images, agent/agency and bid/favorite stats in one round trip
+    try:
+        listing = db.get_listing_detail(conn, listing_id, include=parts)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not listing:
         raise HTTPException(status_code=404, detail="Listing not found")
     
-    # Get images for this listing
-    images = db.get_listing_images(conn, listing_id)
-    listing['images'] = images
-    
-    return listing
+    return FastJSONResponse(listing, headers=headers)
 
 @app.post("/listings", status_code=status.HTTP_201_CREATED, tags=["Listings"])
-def create_listing(listing_data: dict):
-    conn = get_connection()
-    
+def create_listing(listing_data: dict, conn=Depends(get_db)):
     # Validate required fields
     required_fields = ['agent_id', 'category_id', 'user_id', 'title', 'description',
                       'price', 'address', 'city', 'postal_code']
@@ -229,16 +445,14 @@ def create_listing(listing_data: dict):
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
 @app.put("/listings/{listing_id}", tags=["Listings"])
-def update_listing(listing_id: int = Path(..., gt=0), listing_data: dict = Body(...)):
-    conn = get_connection()
-    
+def update_listing(listing_id: int = Path(..., gt=0), listing_data: dict = Body(...), conn=Depends(get_db)):
     # Check if listing exists
     existing_listing = db.get_listing(conn, listing_id)
     if not existing_listing:
         raise HTTPException(status_code=404, detail="Listing not found")
     
     # Remove protected fields
-    protected_fields = ['listing_id', 'created_at', 'updated_at', 'published_at', 'sold_at']
+    protected_fields = ['listing_id', 'created_at', 'updated_at', 'published_at', 'sold_at', 'search_vector', 'highest_bid']
     for field in protected_fields:
         listing_data.pop(field, None)
     
@@ -257,10 +471,9 @@ def update_listing(listing_id: int = Path(..., gt=0), listing_data: dict = Body(
 @app.patch("/listings/{listing_id}/status", tags=["Listings"])
 def update_listing_status(
     listing_id: int = Path(..., gt=0),
-    status: str = Query(..., description="New status: active, sold, pending")
+    status: str = Query(..., description="New status: active, sold, pending"),
+    conn=Depends(get_db)
 ):
-    conn = get_connection()
-    
     if status == "sold":
         updated = db.update_listing(conn, listing_id, status=status, sold_at="NOW()")
     else:
@@ -274,17 +487,16 @@ def update_listing_status(
 @app.patch("/listings/{listing_id}/price", tags=["Listings"])
 def update_listing_price(
     listing_id: int = Path(..., gt=0),
-    new_price: Decimal = Query(..., gt=0)
+    new_price: Decimal = Query(..., gt=0),
+    conn=Depends(get_db)
 ):
-    conn = get_connection()
     updated = db.update_listing(conn, listing_id, price=new_price)
     if not updated:
         raise HTTPException(status_code=404, detail="Listing not found")
     return {"message": "Price updated successfully", "new_price": new_price}
 
 @app.delete("/listings/{listing_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Listings"])
-def delete_listing(listing_id: int = Path(..., gt=0)):
-    conn = get_connection()
+def delete_listing(listing_id: int = Path(..., gt=0), conn=Depends(get_db)):
     deleted = db.delete_listing(conn, listing_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="Listing not found")
@@ -292,15 +504,21 @@ def delete_listing(listing_id: int = Path(..., gt=0)):
 
 # ========== BID ENDPOINTS ==========
 @app.get("/bids", tags=["Bids"])
-def get_all_bids(listing_id: Optional[int] = Query(None, gt=0)):
-    conn = get_connection()
-    bids = db.get_bids(conn, listing_id)
-    return {"bids": bids, "count": len(bids)}
+def get_all_bids(
+    listing_id: Optional[int] = Query(None, gt=0),
+    since: Optional[datetime] = Query(None, description="Bids placed at or after this time"),
+    until: Optional[datetime] = Query(None, description="Bids placed before this time"),
+    fields: Optional[List[str]] = Depends(get_fields),
+    conn=Depends(get_read_db)
+):
+    try:
+        bids = db.get_bids(conn, listing_id, fields=fields, since=since, until=until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({"bids": bids, "count": len(bids)})
 
 @app.post("/bids", status_code=status.HTTP_201_CREATED, tags=["Bids"])
-def create_bid(bid_data: dict):
-    conn = get_connection()
-    
+def create_bid(bid_data: dict, conn=Depends(get_db)):
     required_fields = ['listing_id', 'user_id', 'amount']
     for field in required_fields:
         if field not in bid_data:
@@ -320,6 +538,10 @@ def create_bid(bid_data: dict):
         
         return {"bid_id": bid_id, "message": "Bid placed successfully"}
     
+    except db.BidRejected as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except psycopg2.IntegrityError as e:
         raise HTTPException(status_code=400, detail="Invalid listing_id or user_id")
     except Exception as e:
@@ -328,25 +550,69 @@ def create_bid(bid_data: dict):
 @app.patch("/bids/{bid_id}/status", tags=["Bids"])
 def update_bid_status(
     bid_id: int = Path(..., gt=0),
-    status: str = Query(..., description="New status: pending, accepted, rejected")
+    status: str = Query(..., description="New status: pending, accepted, rejected"),
+    conn=Depends(get_db)
 ):
-    conn = get_connection()
     updated = db.update_bid_status(conn, bid_id, status)
     if not updated:
         raise HTTPException(status_code=404, detail="Bid not found")
     return {"message": f"Bid status updated to {status}"}
 
+SSE_KEEPALIVE_SECONDS = 15
+
+def _sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+
+def _bid_snapshot(listing_id: int):
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        listing = db.get_listing(conn, listing_id)
+    finally:
+        pool.putconn(conn)
+    if listing is None:
+        return None
+    return {"listing_id": listing_id, "status": listing["status"], "highest_bid": listing["highest_bid"]}
+
+@app.get("/listings/{listing_id}/bids/stream", tags=["Bids"])
+async def stream_bids(listing_id: int = Path(..., gt=0)):
+    """
+    Server-Sent Events for the bids on a listing, instead of polling GET /bids.
+    Starts with a snapshot event (status and highest bid), then a bid_placed or bid_status event per change.
+    A reconnected event means events may have been missed, reload the bids
+    """
+    # Subscribe before taking the snapshot, so no bid placed in between is missed
+    subscription = events.get_listener().subscribe(listing_id)
+    try:
+        snapshot = await run_in_threadpool(_bid_snapshot, listing_id)
+    except BaseException:
+        subscription.close()
+        raise
+    if snapshot is None:
+        subscription.close()
+        raise HTTPException(status_code=404, detail="Listing not found")
+
+    async def stream():
+        # Starlette cancels the generator when the client disconnects, which closes the subscription
+        try:
+            yield _sse("snapshot", snapshot)
+            while True:
+                event = await subscription.get(timeout=SSE_KEEPALIVE_SECONDS)
+                yield b": keepalive\n\n" if event is None else _sse(event["event"], event)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # ========== FAVORITE ENDPOINTS ==========
 @app.get("/users/{user_id}/favorites", tags=["Favorites"])
-def get_user_favorites(user_id: int = Path(..., gt=0)):
-    conn = get_connection()
+def get_user_favorites(user_id: int = Path(..., gt=0), conn=Depends(get_read_db)):
     favorites = db.get_favorites(conn, user_id)
-    return {"favorites": favorites, "count": len(favorites)}
+    return FastJSONResponse({"favorites": favorites, "count": len(favorites)})
 
 @app.post("/favorites", status_code=status.HTTP_201_CREATED, tags=["Favorites"])
-def add_to_favorites(favorite_data: dict):
-    conn = get_connection()
-    
+def add_to_favorites(favorite_data: dict, conn=Depends(get_db)):
     required_fields = ['user_id', 'listing_id']
     for field in required_fields:
         if field not in favorite_data:
@@ -366,36 +632,105 @@ def add_to_favorites(favorite_data: dict):
 @app.delete("/favorites", status_code=status.HTTP_204_NO_CONTENT, tags=["Favorites"])
 def remove_from_favorites(
     user_id: int = Query(..., gt=0),
-    listing_id: int = Query(..., gt=0)
+    listing_id: int = Query(..., gt=0),
+    conn=Depends(get_db)
 ):
-    conn = get_connection()
     removed = db.remove_favorite(conn, user_id, listing_id)
     if not removed:
         raise HTTPException(status_code=404, detail="Favorite not found")
     return None
 
+# ========== SAVED SEARCH ENDPOINTS ==========
+@app.get("/users/{user_id}/saved-searches", tags=["Saved searches"])
+def get_user_saved_searches(user_id: int = Path(..., gt=0), conn=Depends(get_read_db)):
+    searches = db.get_saved_searches(conn, user_id)
+    return {"saved_searches": searches, "count": len(searches)}
+
+@app.get("/users/{user_id}/saved-searches/matches", tags=["Saved searches"])
+def get_user_saved_search_matches(
+    user_id: int = Path(..., gt=0),
+    limit: int = Query(100, ge=1, le=500),
+    conn=Depends(get_read_db)
+):
+    """Listings that started to match one of the user's saved searches, newest first"""
+    matches = db.get_saved_search_matches(conn, user_id, limit)
+    return FastJSONResponse({"matches": matches, "count": len(matches)})
+
+@app.post("/saved-searches", status_code=status.HTTP_201_CREATED, tags=["Saved searches"])
+def create_saved_search(search_data: dict, conn=Depends(get_db)):
+    if 'user_id' not in search_data:
+        raise HTTPException(status_code=400, detail="Missing required field: user_id")
+    allowed_fields = {'user_id', 'name', 'city', 'category_id', 'min_price', 'max_price'}
+    unknown = set(search_data) - allowed_fields
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    try:
+        search_id = db.create_saved_search(conn, **search_data)
+        if not search_id:
+            raise HTTPException(status_code=400, detail="Failed to create saved search")
+        return {"search_id": search_id, "message": "Saved search created successfully"}
+    except psycopg2.IntegrityError as e:
+        if "foreign key constraint" in str(e).lower():
+            raise HTTPException(status_code=400, detail="Invalid user_id or category_id")
+        # min_price above max_price
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/saved-searches/{search_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Saved searches"])
+def delete_saved_search(search_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    if not db.delete_saved_search(conn, search_id):
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    return None
+
+# ========== ANALYTICS ENDPOINTS ==========
+# Read-only, the rollups are recomputed by python db_setup.py --refresh-rollups (run it from cron)
+@app.get("/listings/{listing_id}/price-history", tags=["Analytics"])
+def get_listing_price_history(listing_id: int = Path(..., gt=0), conn=Depends(get_read_db)):
+    history = db.get_price_history(conn, listing_id)
+    if not history and not db.get_listing(conn, listing_id):
+        raise HTTPException(status_code=404, detail="Listing not found")
+    return {"listing_id": listing_id, "history": history}
+
+@app.get("/analytics/price-per-sqm", tags=["Analytics"])
+def get_price_per_sqm(
+    city: Optional[str] = Query(None, description="Default all cities"),
+    category_id: Optional[int] = Query(None, gt=0, description="Default all categories"),
+    since: Optional[date] = Query(None),
+    until: Optional[date] = Query(None),
+    conn=Depends(get_read_db)
+):
+    """Median asking price per sqm of the active listings at the end of each month"""
+    series = db.get_price_per_sqm_series(conn, city, category_id, since, until)
+    return FastJSONResponse({"city": city, "category_id": category_id, "series": series})
+
 # ========== AGENCY ENDPOINTS ==========
 @app.get("/agencies", tags=["Agencies"])
 def get_all_agencies(
     limit: int = Query(100, ge=1, le=500),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page, replaces offset"),
+    conn=Depends(get_read_db)
 ):
-    conn = get_connection()
-    agencies = db.get_agencies(conn, limit, offset)
-    return {"agencies": agencies, "count": len(agencies)}
+    try:
+        agencies = db.get_agencies(conn, limit, offset, after=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"agencies": agencies, "count": len(agencies), "next_cursor": db.next_cursor(agencies, limit, "agency_id")}
 
 @app.get("/agencies/{agency_id}", tags=["Agencies"])
-def get_agency_by_id(agency_id: int = Path(..., gt=0)):
-    conn = get_connection()
-    agency = db.get_agency(conn, agency_id)
+def get_agency_by_id(request: Request, agency_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    version = db.get_agency_version(conn, agency_id)
+    headers = validators(version, f"agency-{agency_id}")
+    if not_modified(request, version, headers):
+        return Response(status_code=304, headers=headers)
+
+    agency = db.get_agency(conn, agency_id, version=version)
     if not agency:
         raise HTTPException(status_code=404, detail="Agency not found")
-    return agency
+    return FastJSONResponse(agency, headers=headers)
 
 @app.post("/agencies", status_code=status.HTTP_201_CREATED, tags=["Agencies"])
-def create_agency(agency_data: dict):
-    conn = get_connection()
-    
+def create_agency(agency_data: dict, conn=Depends(get_db)):
     required_fields = ['name', 'license_number']
     for field in required_fields:
         if field not in agency_data:
@@ -415,15 +750,17 @@ def create_agency(agency_data: dict):
 
 # ========== IMAGE ENDPOINTS ==========
 @app.get("/listings/{listing_id}/images", tags=["Images"])
-def get_listing_images(listing_id: int = Path(..., gt=0)):
-    conn = get_connection()
+def get_listing_images(request: Request, listing_id: int = Path(..., gt=0), conn=Depends(get_read_db)):
+    version = db.get_listing_images_version(conn, listing_id)
+    headers = validators(version, f"listing-images-{listing_id}")
+    if not_modified(request, version, headers):
+        return Response(status_code=304, headers=headers)
+
     images = db.get_listing_images(conn, listing_id)
-    return {"images": images, "count": len(images)}
+    return FastJSONResponse({"images": images, "count": len(images)}, headers=headers)
 
 @app.post("/images", status_code=status.HTTP_201_CREATED, tags=["Images"])
-def add_image(image_data: dict):
-    conn = get_connection()
-    
+def add_image(image_data: dict, conn=Depends(get_db)):
     required_fields = ['listing_id', 'image_url']
     for field in required_fields:
         if field not in image_data:
@@ -447,35 +784,135 @@ def add_image(image_data: dict):
     except psycopg2.IntegrityError as e:
         raise HTTPException(status_code=400, detail="Invalid listing_id")
 
+# ========== EXPORT ENDPOINTS ==========
+# Full table exports streamed as NDJSON (one JSON object per line) or CSV.
+# The rows are read in batches from a server side cursor and written out as they arrive
+EXPORT_CHUNK_ROWS = 500
+
+def _export_chunks(rows, columns, export_format: str):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == "csv" else None
+    if writer:
+        writer.writerow(columns)
+
+    for count, row in enumerate(rows, 1):
+        if writer:
+            writer.writerow([row[column] for column in columns])
+        else:
+            # Encoded like the list endpoints' FastJSONResponse
+            buffer.write(dumps(row).decode("utf-8"))
+            buffer.write("\n")
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+class _ExportResponse(StreamingResponse):
+    """
+    StreamingResponse that calls release() however the response ends: streamed completely, the client went
+    away (maybe before the first chunk, the generator never started) or sending failed in a middleware.
+    A background task would be skipped in the last case
+    """
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self._release)
+
+def _export_response(rows_fn, columns, export_format: str, filename: str, **filters):
+    # The connection is checked out up front, so a busy pool still answers 503
+    pool, conn = _read_checkout()
+    rows = rows_fn(conn, **filters)
+
+    def release():
+        # Closing the rows generator ends the export's transaction (and its server side cursor)
+        # before the connection goes back to the pool
+        try:
+            rows.close()
+        finally:
+            pool.putconn(conn)
+
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return _ExportResponse(_export_chunks(rows, columns, export_format), release, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}.{export_format}"'
+    })
+
+@app.get("/export/listings", tags=["Export"])
+def export_listings(
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    city: Optional[str] = Query(None),
+    city_match: Literal["substring", "prefix", "exact"] = Query("substring", description="How city is matched, case insensitive"),
+    min_price: Optional[Decimal] = Query(None, gt=0),
+    max_price: Optional[Decimal] = Query(None, gt=0),
+    category_id: Optional[int] = Query(None, gt=0)
+):
+    return _export_response(
+        db.iter_listings, db.LISTING_COLUMNS, format, "listings",
+        city=city, min_price=min_price, max_price=max_price,
+        category_id=category_id, city_match=city_match
+    )
+
+@app.get("/export/bids", tags=["Export"])
+def export_bids(
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    listing_id: Optional[int] = Query(None, gt=0)
+):
+    return _export_response(db.iter_bids, db.BID_COLUMNS, format, "bids", listing_id=listing_id)
+
 # ========== CATEGORY ENDPOINTS ==========
 @app.get("/categories", tags=["Categories"])
-def get_all_categories():
-    conn = get_connection()
-    categories = db.get_categories(conn)
-    return {"categories": categories, "count": len(categories)}
+def get_all_categories(request: Request, conn=Depends(get_db)):
+    version = db.get_categories_version(conn)
+    headers = validators(version, "categories")
+    if not_modified(request, version, headers):
+        return Response(status_code=304, headers=headers)
+
+    categories = db.get_categories(conn, version=version)
+    return FastJSONResponse({"categories": categories, "count": len(categories)}, headers=headers)
 
 @app.get("/categories/{category_id}", tags=["Categories"])
-def get_category_by_id(category_id: int = Path(..., gt=0)):
-    conn = get_connection()
+def get_category_by_id(category_id: int = Path(..., gt=0), conn=Depends(get_db)):
     category = db.get_category(conn, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
     return category
 
+@app.post("/categories", status_code=status.HTTP_201_CREATED, tags=["Categories"])
+def create_category(category_data: dict, conn=Depends(get_db)):
+    if 'name' not in category_data:
+        raise HTTPException(status_code=400, detail="Missing required field: name")
+    
+    try:
+        category_id = db.create_category(conn, category_data['name'], category_data.get('description'))
+        if not category_id:
+            raise HTTPException(status_code=400, detail="Failed to create category")
+        
+        return {"category_id": category_id, "message": "Category created successfully"}
+    
+    except psycopg2.IntegrityError as e:
+        raise HTTPException(status_code=400, detail="Category name already exists")
+
 # ========== VIEWING ENDPOINTS ==========
 @app.get("/viewings", tags=["Viewings"])
 def get_all_viewings(
     user_id: Optional[int] = Query(None, gt=0),
-    listing_id: Optional[int] = Query(None, gt=0)
+    listing_id: Optional[int] = Query(None, gt=0),
+    since: Optional[datetime] = Query(None, description="Viewings at or after this time"),
+    until: Optional[datetime] = Query(None, description="Viewings before this time"),
+    conn=Depends(get_read_db)
 ):
-    conn = get_connection()
-    viewings = db.get_viewings(conn, user_id=user_id, listing_id=listing_id)
+    viewings = db.get_viewings(conn, user_id=user_id, listing_id=listing_id, since=since, until=until)
     return {"viewings": viewings, "count": len(viewings)}
 
 @app.post("/viewings", status_code=status.HTTP_201_CREATED, tags=["Viewings"])
-def create_viewing(viewing_data: dict):
-    conn = get_connection()
-    
+def create_viewing(viewing_data: dict, conn=Depends(get_db)):
     required_fields = ['listing_id', 'user_id', 'viewing_date', 'viewing_time']
     for field in required_fields:
         if field not in viewing_data:
@@ -504,22 +941,42 @@ def create_viewing(viewing_data: dict):
 
 # ========== AGENT ENDPOINTS ==========
 @app.get("/agents", tags=["Agents"])
-def get_all_agents(agency_id: Optional[int] = Query(None, gt=0)):
-    conn = get_connection()
+def get_all_agents(agency_id: Optional[int] = Query(None, gt=0), conn=Depends(get_db)):
     agents = db.get_agents(conn, agency_id)
     return {"agents": agents, "count": len(agents)}
 
+@app.post("/agents", status_code=status.HTTP_201_CREATED, tags=["Agents"])
+def create_agent(agent_data: dict, conn=Depends(get_db)):
+    required_fields = ['agency_id', 'user_id']
+    for field in required_fields:
+        if field not in agent_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    try:
+        agent_id = db.create_agent(
+            conn,
+            agency_id=agent_data['agency_id'],
+            user_id=agent_data['user_id'],
+            bio=agent_data.get('bio'),
+            profile_image_url=agent_data.get('profile_image_url'),
+            years_experience=agent_data.get('years_experience')
+        )
+        if not agent_id:
+            raise HTTPException(status_code=400, detail="Failed to create agent")
+        
+        return {"agent_id": agent_id, "message": "Agent created successfully"}
+    
+    except psycopg2.IntegrityError as e:
+        raise HTTPException(status_code=400, detail="Invalid agency_id or user_id")
+
 # ========== REVIEW ENDPOINTS ==========
 @app.get("/reviews", tags=["Reviews"])
-def get_all_reviews(agent_id: Optional[int] = Query(None, gt=0)):
-    conn = get_connection()
+def get_all_reviews(agent_id: Optional[int] = Query(None, gt=0), conn=Depends(get_read_db)):
     reviews = db.get_agent_reviews(conn, agent_id)
     return {"reviews": reviews, "count": len(reviews)}
 
 @app.post("/reviews", status_code=status.HTTP_201_CREATED, tags=["Reviews"])
-def create_review(review_data: dict):
-    conn = get_connection()
-    
+def create_review(review_data: dict, conn=Depends(get_db)):
     required_fields = ['agent_id', 'user_id', 'rating']
     for field in required_fields:
         if field not in review_data:
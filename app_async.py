@@ -0,0 +1,526 @@
+from contextlib import asynccontextmanager
+from typing import Optional
+from decimal import Decimal
+from datetime import datetime
+import time
+
+import psycopg
+from psycopg_pool import PoolTimeout
+from fastapi import FastAPI, HTTPException, status, Query, Path, Body, Depends, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+import db_async
+import metrics
+from db_setup import get_async_pool, close_async_pool
+
+"""
+The same api as app.py, but with async endpoints on top of db_async.py (psycopg 3 and its async pool).
+A slow query only parks a coroutine here instead of holding one of Starlette's threadpool workers.
+
+Start it with: uvicorn app_async:app
+"""
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await get_async_pool().open(wait=True)
+    yield
+    await close_async_pool()
+
+app = FastAPI(
+    lifespan=lifespan,
+    title="Hemnet Clone API (async)",
+    description="A simplified API for a real estate platform similar to Hemnet.se",
+    version="1.0.0",
+    docs_url="/docs",
+    redoc_url="/redoc"
+)
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(status_code=503, content={"detail": "Database is busy, try again later"})
+
+# ========== DEPENDENCIES ==========
+async def get_db():
+    """
+    Borrows a connection from the async pool for the duration of the request.
+    Queries aren't timed per function here (that's psycopg2 only), the pool wait is
+    """
+    start = time.perf_counter()
+    async with get_async_pool().connection() as conn:
+        metrics.observe_pool_wait(time.perf_counter() - start)
+        yield conn
+
+# ========== HEALTH CHECK ==========
+@app.get("/", tags=["Health"])
+async def root():
+    return {"message": "Hemnet Clone API is running", "status": "healthy"}
+
+@app.get("/health", tags=["Health"])
+async def health_check():
+    pool = get_async_pool()
+    try:
+        async with pool.connection() as conn:
+            await conn.execute("SELECT 1;")
+        return {"status": "healthy", "database": "connected", "pool": _pool_stats(pool)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database connection failed: {str(e)}")
+
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+async def get_metrics():
+    """Request and pool metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(_pool_stats(get_async_pool())), media_type="text/plain; version=0.0.4")
+
+def _pool_stats(pool) -> dict:
+    """psycopg_pool stats in the same shape as pool.ConnectionPool.stats()"""
+    stats = pool.get_stats()
+    return {
+        "min_size": pool.min_size,
+        "max_size": pool.max_size,
+        "size": stats.get("pool_size", 0),
+        "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+        "idle": stats.get("pool_available", 0),
+        "waits": stats.get("requests_queued", 0),
+        "wait_time_ms": stats.get("requests_wait_ms", 0),
+        "timeouts": stats.get("requests_errors", 0),
+    }
+
+# ========== USER ENDPOINTS ==========
+@app.get("/users", tags=["Users"])
+async def get_all_users(
+    limit: int = Query(100, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    conn=Depends(get_db)
+):
+    users = await db_async.get_users(conn, limit, offset)
+    return {"users": users, "count": len(users)}
+
+@app.get("/users/{user_id}", tags=["Users"])
+async def get_user_by_id(user_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    user = await db_async.get_user(conn, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+@app.post("/users", status_code=status.HTTP_201_CREATED, tags=["Users"])
+async def create_user(user_data: dict, conn=Depends(get_db)):
+    try:
+        # Validate required fields
+        required_fields = ['email', 'password_hash', 'first_name', 'last_name', 'user_type', 'role']
+        for field in required_fields:
+            if field not in user_data:
+                raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+        
+        user_id = await db_async.create_user(
+            conn,
+            email=user_data['email'],
+            password_hash=user_data['password_hash'],
+            first_name=user_data['first_name'],
+            last_name=user_data['last_name'],
+            phone=user_data.get('phone'),
+            user_type=user_data['user_type'],
+            role=user_data['role']
+        )
+        if not user_id:
+            raise HTTPException(status_code=400, detail="Failed to create user")
+        
+        return {"user_id": user_id, "message": "User created successfully"}
+    
+    except psycopg.IntegrityError as e:
+        if "unique constraint" in str(e).lower():
+            raise HTTPException(status_code=400, detail="Email already exists")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Server error: {str(e)}") 
+    
+@app.put("/users/{user_id}", tags=["Users"])
+async def update_user(user_id: int = Path(..., gt=0), user_data: dict = Body(...), conn=Depends(get_db)):
+    # Check if user exists
+    existing_user = await db_async.get_user(conn, user_id)
+    if not existing_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Remove fields that shouldn't be updated
+    protected_fields = ['user_id', 'created_at', 'updated_at']
+    for field in protected_fields:
+        user_data.pop(field, None)
+    
+    if not user_data:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    try:
+        updated = await db_async.update_user(conn, user_id, **user_data)
+        if updated:
+            return {"message": "User updated successfully"}
+        else:
+            raise HTTPException(status_code=400, detail="Failed to update user")
+    except psycopg.IntegrityError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Users"])
+async def delete_user(user_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    deleted = await db_async.delete_user(conn, user_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="User not found")
+    return None
+
+# ========== LISTING ENDPOINTS ==========
+@app.get("/listings", tags=["Listings"])
+async def get_all_listings(
+    limit: int = Query(100, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    city: Optional[str] = Query(None),
+    min_price: Optional[Decimal] = Query(None, gt=0),
+    max_price: Optional[Decimal] = Query(None, gt=0),
+    category_id: Optional[int] = Query(None, gt=0),
+    conn=Depends(get_db)
+):
+    listings = await db_async.get_listings(
+        conn, limit, offset, 
+        city=city, 
+        min_price=min_price, 
+        max_price=max_price,
+        category_id=category_id
+    )
+    return {"listings": listings, "count": len(listings)}
+
+@app.get("/listings/{listing_id}", tags=["Listings"])
+async def get_listing_by_id(listing_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    listing = await db_async.get_listing(conn, listing_id)
+    if not listing:
+        raise HTTPException(status_code=404, detail="Listing not found")
+    
+    # Get images for this listing
+    images = await db_async.get_listing_images(conn, listing_id)
+    listing['images'] = images
+    
+    return listing
+
+@app.post("/listings", status_code=status.HTTP_201_CREATED, tags=["Listings"])
+async def create_listing(listing_data: dict, conn=Depends(get_db)):
+    # Validate required fields
+    required_fields = ['agent_id', 'category_id', 'user_id', 'title', 'description',
+                      'price', 'address', 'city', 'postal_code']
+    for field in required_fields:
+        if field not in listing_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    try:
+        listing_id = await db_async.create_listing(conn, **listing_data)
+        if not listing_id:
+            raise HTTPException(status_code=400, detail="Failed to create listing")
+        
+        return {"listing_id": listing_id, "message": "Listing created successfully"}
+    
+    except psycopg.IntegrityError as e:
+        if "foreign key constraint" in str(e).lower():
+            raise HTTPException(status_code=400, detail="Invalid agent_id, category_id, or user_id")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
+
+@app.put("/listings/{listing_id}", tags=["Listings"])
+async def update_listing(listing_id: int = Path(..., gt=0), listing_data: dict = Body(...), conn=Depends(get_db)):
+    # Check if listing exists
+    existing_listing = await db_async.get_listing(conn, listing_id)
+    if not existing_listing:
+        raise HTTPException(status_code=404, detail="Listing not found")
+    
+    # Remove protected fields
+    protected_fields = ['listing_id', 'created_at', 'updated_at', 'published_at', 'sold_at', 'search_vector', 'highest_bid']
+    for field in protected_fields:
+        listing_data.pop(field, None)
+    
+    if not listing_data:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    try:
+        updated = await db_async.update_listing(conn, listing_id, **listing_data)
+        if updated:
+            return {"message": "Listing updated successfully"}
+        else:
+            raise HTTPException(status_code=400, detail="Failed to update listing")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.patch("/listings/{listing_id}/status", tags=["Listings"])
+async def update_listing_status(
+    listing_id: int = Path(..., gt=0),
+    status: str = Query(..., description="New status: active, sold, pending"),
+    conn=Depends(get_db)
+):
+    if status == "sold":
+        updated = await db_async.update_listing(conn, listing_id, status=status, sold_at=datetime.now())
+    else:
+        updated = await db_async.update_listing(conn, listing_id, status=status)
+    
+    if not updated:
+        raise HTTPException(status_code=404, detail="Listing not found")
+    
+    return {"message": f"Listing status updated to {status}"}
+
+@app.patch("/listings/{listing_id}/price", tags=["Listings"])
+async def update_listing_price(
+    listing_id: int = Path(..., gt=0),
+    new_price: Decimal = Query(..., gt=0),
+    conn=Depends(get_db)
+):
+    updated = await db_async.update_listing(conn, listing_id, price=new_price)
+    if not updated:
+        raise HTTPException(status_code=404, detail="Listing not found")
+    return {"message": "Price updated successfully", "new_price": new_price}
+
+@app.delete("/listings/{listing_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Listings"])
+async def delete_listing(listing_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    deleted = await db_async.delete_listing(conn, listing_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Listing not found")
+    return None
+
+# ========== BID ENDPOINTS ==========
+@app.get("/bids", tags=["Bids"])
+async def get_all_bids(listing_id: Optional[int] = Query(None, gt=0), conn=Depends(get_db)):
+    bids = await db_async.get_bids(conn, listing_id)
+    return {"bids": bids, "count": len(bids)}
+
+@app.post("/bids", status_code=status.HTTP_201_CREATED, tags=["Bids"])
+async def create_bid(bid_data: dict, conn=Depends(get_db)):
+    required_fields = ['listing_id', 'user_id', 'amount']
+    for field in required_fields:
+        if field not in bid_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    try:
+        bid_id = await db_async.create_bid(
+            conn,
+            listing_id=bid_data['listing_id'],
+            user_id=bid_data['user_id'],
+            amount=bid_data['amount'],
+            comment=bid_data.get('comment')
+        )
+        
+        if not bid_id:
+            raise HTTPException(status_code=400, detail="Failed to create bid")
+        
+        return {"bid_id": bid_id, "message": "Bid placed successfully"}
+    
+    except db_async.BidRejected as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except psycopg.IntegrityError as e:
+        raise HTTPException(status_code=400, detail="Invalid listing_id or user_id")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.patch("/bids/{bid_id}/status", tags=["Bids"])
+async def update_bid_status(
+    bid_id: int = Path(..., gt=0),
+    status: str = Query(..., description="New status: pending, accepted, rejected"),
+    conn=Depends(get_db)
+):
+    updated = await db_async.update_bid_status(conn, bid_id, status)
+    if not updated:
+        raise HTTPException(status_code=404, detail="Bid not found")
+    return {"message": f"Bid status updated to {status}"}
+
+# ========== FAVORITE ENDPOINTS ==========
+@app.get("/users/{user_id}/favorites", tags=["Favorites"])
+async def get_user_favorites(user_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    favorites = await db_async.get_favorites(conn, user_id)
+    return {"favorites": favorites, "count": len(favorites)}
+
+@app.post("/favorites", status_code=status.HTTP_201_CREATED, tags=["Favorites"])
+async def add_to_favorites(favorite_data: dict, conn=Depends(get_db)):
+    required_fields = ['user_id', 'listing_id']
+    for field in required_fields:
+        if field not in favorite_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    favorite_id = await db_async.add_favorite(
+        conn,
+        user_id=favorite_data['user_id'],
+        listing_id=favorite_data['listing_id']
+    )
+    
+    if favorite_id:
+        return {"favorite_id": favorite_id, "message": "Added to favorites"}
+    else:
+        return {"message": "Already in favorites"}
+
+@app.delete("/favorites", status_code=status.HTTP_204_NO_CONTENT, tags=["Favorites"])
+async def remove_from_favorites(
+    user_id: int = Query(..., gt=0),
+    listing_id: int = Query(..., gt=0),
+    conn=Depends(get_db)
+):
+    removed = await db_async.remove_favorite(conn, user_id, listing_id)
+    if not removed:
+        raise HTTPException(status_code=404, detail="Favorite not found")
+    return None
+
+# ========== AGENCY ENDPOINTS ==========
+@app.get("/agencies", tags=["Agencies"])
+async def get_all_agencies(
+    limit: int = Query(100, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    conn=Depends(get_db)
+):
+    agencies = await db_async.get_agencies(conn, limit, offset)
+    return {"agencies": agencies, "count": len(agencies)}
+
+@app.get("/agencies/{agency_id}", tags=["Agencies"])
+async def get_agency_by_id(agency_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    agency = await db_async.get_agency(conn, agency_id)
+    if not agency:
+        raise HTTPException(status_code=404, detail="Agency not found")
+    return agency
+
+@app.post("/agencies", status_code=status.HTTP_201_CREATED, tags=["Agencies"])
+async def create_agency(agency_data: dict, conn=Depends(get_db)):
+    required_fields = ['name', 'license_number']
+    for field in required_fields:
+        if field not in agency_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    try:
+        agency_id = await db_async.create_agency(conn, **agency_data)
+        if not agency_id:
+            raise HTTPException(status_code=400, detail="Failed to create agency")
+        
+        return {"agency_id": agency_id, "message": "Agency created successfully"}
+    
+    except psycopg.IntegrityError as e:
+        if "unique constraint" in str(e).lower():
+            raise HTTPException(status_code=400, detail="License number already exists")
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ========== IMAGE ENDPOINTS ==========
+@app.get("/listings/{listing_id}/images", tags=["Images"])
+async def get_listing_images(listing_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    images = await db_async.get_listing_images(conn, listing_id)
+    return {"images": images, "count": len(images)}
+
+@app.post("/images", status_code=status.HTTP_201_CREATED, tags=["Images"])
+async def add_image(image_data: dict, conn=Depends(get_db)):
+    required_fields = ['listing_id', 'image_url']
+    for field in required_fields:
+        if field not in image_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    try:
+        image_id = await db_async.add_image(
+            conn,
+            listing_id=image_data['listing_id'],
+            image_url=image_data['image_url'],
+            display_order=image_data.get('display_order'),
+            is_primary=image_data.get('is_primary', False),
+            caption=image_data.get('caption')
+        )
+        
+        if not image_id:
+            raise HTTPException(status_code=400, detail="Failed to add image")
+        
+        return {"image_id": image_id, "message": "Image added successfully"}
+    
+    except psycopg.IntegrityError as e:
+        raise HTTPException(status_code=400, detail="Invalid listing_id")
+
+# ========== CATEGORY ENDPOINTS ==========
+@app.get("/categories", tags=["Categories"])
+async def get_all_categories(conn=Depends(get_db)):
+    categories = await db_async.get_categories(conn)
+    return {"categories": categories, "count": len(categories)}
+
+@app.get("/categories/{category_id}", tags=["Categories"])
+async def get_category_by_id(category_id: int = Path(..., gt=0), conn=Depends(get_db)):
+    category = await db_async.get_category(conn, category_id)
+    if not category:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return category
+
+# ========== VIEWING ENDPOINTS ==========
+@app.get("/viewings", tags=["Viewings"])
+async def get_all_viewings(
+    user_id: Optional[int] = Query(None, gt=0),
+    listing_id: Optional[int] = Query(None, gt=0),
+    conn=Depends(get_db)
+):
+    viewings = await db_async.get_viewings(conn, user_id=user_id, listing_id=listing_id)
+    return {"viewings": viewings, "count": len(viewings)}
+
+@app.post("/viewings", status_code=status.HTTP_201_CREATED, tags=["Viewings"])
+async def create_viewing(viewing_data: dict, conn=Depends(get_db)):
+    required_fields = ['listing_id', 'user_id', 'viewing_date', 'viewing_time']
+    for field in required_fields:
+        if field not in viewing_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    try:
+        viewing_id = await db_async.create_viewing(
+            conn,
+            listing_id=viewing_data['listing_id'],
+            user_id=viewing_data['user_id'],
+            viewing_date=viewing_data['viewing_date'],
+            viewing_time=viewing_data['viewing_time'],
+            status=viewing_data.get('status', 'pending'),
+            notes=viewing_data.get('notes')
+        )
+        
+        if not viewing_id:
+            raise HTTPException(status_code=400, detail="Failed to create viewing")
+        
+        return {"viewing_id": viewing_id, "message": "Viewing booked successfully"}
+    
+    except psycopg.IntegrityError as e:
+        raise HTTPException(status_code=400, detail="Invalid listing_id or user_id")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ========== AGENT ENDPOINTS ==========
+@app.get("/agents", tags=["Agents"])
+async def get_all_agents(agency_id: Optional[int] = Query(None, gt=0), conn=Depends(get_db)):
+    agents = await db_async.get_agents(conn, agency_id)
+    return {"agents": agents, "count": len(agents)}
+
+# ========== REVIEW ENDPOINTS ==========
+@app.get("/reviews", tags=["Reviews"])
+async def get_all_reviews(agent_id: Optional[int] = Query(None, gt=0), conn=Depends(get_db)):
+    reviews = await db_async.get_agent_reviews(conn, agent_id)
+    return {"reviews": reviews, "count": len(reviews)}
+
+@app.post("/reviews", status_code=status.HTTP_201_CREATED, tags=["Reviews"])
+async def create_review(review_data: dict, conn=Depends(get_db)):
+    required_fields = ['agent_id', 'user_id', 'rating']
+    for field in required_fields:
+        if field not in review_data:
+            raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
+    
+    if not 1 <= review_data['rating'] <= 5:
+        raise HTTPException(status_code=400, detail="Rating must be between 1 and 5")
+    
+    try:
+        review_id = await db_async.create_review(
+            conn,
+            agent_id=review_data['agent_id'],
+            user_id=review_data['user_id'],
+            rating=review_data['rating'],
+            comment=review_data.get('comment'),
+            transaction=review_data.get('transaction')
+        )
+        
+        if not review_id:
+            raise HTTPException(status_code=400, detail="Failed to create review")
+        
+        return {"review_id": review_id, "message": "Review submitted successfully"}
+    
+    except psycopg.IntegrityError as e:
+        raise HTTPException(status_code=400, detail="Invalid agent_id or user_id")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,1028 @@
+"""
+Benchmarks for the api and the database layer.
+
+They run against the database configured in .env, so create the tables (db_setup.py) and load
+some data first. Every benchmark is a subcommand, e.g:
+
+    python bench.py async --clients 200 --requests 20000
+
+`python datagen.py` fills the database with a realistic amount of data, and `python bench.py load`
+replays a mix of requests and writes per route results as json that can be compared between commits.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+import db
+from datagen import CITIES
+from db_setup import SAVED_SEARCH_MATCH_SQL, get_connection
+
+
+# ========== HELPERS ==========
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed: float, errors: int = 0) -> dict:
+    """Latencies are in seconds, the result is in milliseconds"""
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def print_table(rows, columns):
+    widths = [max(len(str(column)), *(len(str(row.get(column, ""))) for row in rows)) for column in columns]
+    print("  ".join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row.get(column, "")).ljust(width) for column, width in zip(columns, widths)))
+
+
+def time_call(fn, *args, repeat: int = 20, **kwargs) -> float:
+    """Returns the median time of fn(*args, **kwargs) in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return round(percentile(timings, 50) * 1000, 3)
+
+
+async def http_load(base_url: str, paths, clients: int, total: int) -> dict:
+    """
+    Sends `total` GET requests spread over `clients` concurrent connections.
+    paths is a list of paths that is cycled through, or a callable returning the next path
+    """
+    latencies = []
+    errors = 0
+    sent = 0
+    next_path = paths if callable(paths) else (lambda i: paths[i % len(paths)])
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60,
+                                 limits=httpx.Limits(max_connections=clients)) as client:
+        async def worker():
+            nonlocal sent, errors
+            while sent < total:
+                path = next_path(sent)
+                sent += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+
+    return summarize(latencies, elapsed, errors)
+
+
+class Server:
+    """Runs `uvicorn <module>:app` in a subprocess for the duration of a with-block"""
+
+    def __init__(self, module: str, port: int, workers: int = 1):
+        self.module = module
+        self.port = port
+        self.workers = workers
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen([
+            sys.executable, "-m", "uvicorn", f"{self.module}:app",
+            "--port", str(self.port), "--workers", str(self.workers), "--log-level", "warning",
+        ])
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if httpx.get(self.base_url + "/health", timeout=1).status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.process.terminate()
+        raise RuntimeError(f"{self.module} did not start on port {self.port}")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+
+def explain(con, query: str, params=(), seqscan: bool = True) -> str:
+    """EXPLAIN output of a query, with seqscan=False the planner avoids sequential scans where it can"""
+    with con:
+        with con.cursor() as cursor:
+            if not seqscan:
+                cursor.execute("SET LOCAL enable_seqscan = off;")
+            cursor.execute("EXPLAIN " + query, tuple(params))
+            return "\n".join(row[0] for row in cursor.fetchall())
+
+
+# ========== BENCHMARKS ==========
+def bench_async(args):
+    """Sync (app.py, threadpool + psycopg2) vs async (app_async.py, psycopg 3) on /listings"""
+    rows = []
+    for module in ("app", "app_async"):
+        with Server(module, args.port) as server:
+            # warm up the pool and the database caches
+            asyncio.run(http_load(server.base_url, [args.path], 10, 200))
+            result = asyncio.run(http_load(server.base_url, [args.path], args.clients, args.requests))
+        rows.append({"mode": "sync" if module == "app" else "async", **result})
+    print(f"GET {args.path} with {args.clients} concurrent clients")
+    print_table(rows, ["mode", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms"])
+
+
+def bench_pagination(args):
+    """Latency of page 1 vs a deep page of /listings with LIMIT/OFFSET and with keyset cursors"""
+    con = get_connection()
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM house_listing;")
+            total = cursor.fetchone()[0]
+    rows = []
+    for page in (1, args.page):
+        offset = (page - 1) * args.limit
+        if offset >= total:
+            print(f"Skipping page {page}, house_listing only has {total} rows")
+            continue
+        # The cursor a client would hold after walking to this page
+        after = None
+        if offset:
+            with con:
+                with con.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT created_at, listing_id FROM house_listing
+                        ORDER BY created_at DESC, listing_id DESC
+                        OFFSET %s LIMIT 1;
+                    """, (offset - 1,))
+                    after = db.encode_cursor(*cursor.fetchone())
+        rows.append({
+            "page": page,
+            "offset_ms": time_call(db.get_listings, con, args.limit, offset, repeat=args.repeat),
+            "keyset_ms": time_call(db.get_listings, con, args.limit, 0, after=after, repeat=args.repeat),
+        })
+    con.close()
+    print(f"db.get_listings, {args.limit} rows per page, {total} listings")
+    print_table(rows, ["page", "offset_ms", "keyset_ms"])
+
+
+CITY_INDEX_CHECKS = [
+    # (city_match, city, index that has to show up in the plan)
+    ("substring", "holm", "idx_listing_city_trgm"),
+    ("prefix", "stock", "idx_listing_city_lower"),
+    ("exact", "Stockholm", "idx_listing_city_lower"),
+]
+
+
+def city_index_plans(con, seqscan: bool = False) -> list:
+    """The plan of every CITY_INDEX_CHECKS filter and whether it uses its index (also run by tests/)"""
+    rows = []
+    for city_match, city, index in CITY_INDEX_CHECKS:
+        where, params = db.listing_filters(city=city, city_match=city_match)
+        plan = explain(con, f"SELECT * FROM house_listing WHERE {where}", params, seqscan=seqscan)
+        rows.append({"city_match": city_match, "city": city, "index": index, "used": index in plan, "plan": plan})
+    return rows
+
+
+def check_city_indexes(args):
+    """
+    Checks that every city_match mode of db.get_listings can be answered from an index.
+    On a small table the planner prefers a sequential scan anyway, so unless --natural is given
+    sequential scans are disabled to see which index the planner would pick.
+    """
+    con = get_connection()
+    rows = city_index_plans(con, seqscan=args.natural)
+    con.close()
+    if args.verbose:
+        for row in rows:
+            print(row["plan"], end="\n\n")
+    print_table(rows, ["city_match", "city", "index", "used"])
+    if not all(row["used"] for row in rows):
+        sys.exit(1)
+
+
+# Viewports centered on Stockholm, from a few blocks to most of southern Sweden (degrees)
+VIEWPORT_SIZES = [0.01, 0.05, 0.2, 1.0, 5.0]
+
+
+def bench_geo(args):
+    """db.get_listings_in_bbox and db.get_listings_in_radius for map viewports of different sizes"""
+    con = get_connection()
+    rows = []
+    for size in VIEWPORT_SIZES:
+        half = size / 2
+        viewport = (args.lat - half, args.lon - half, args.lat + half, args.lon + half)
+        listings = db.get_listings_in_bbox(con, *viewport, args.limit)
+        # roughly the same area as a circle, one degree of latitude is ~111 km
+        radius_km = half * 111
+        rows.append({
+            "viewport_deg": size,
+            "rows": len(listings),
+            "bbox_ms": time_call(db.get_listings_in_bbox, con, *viewport, args.limit, repeat=args.repeat),
+            "radius_km": round(radius_km, 1),
+            "radius_ms": time_call(db.get_listings_in_radius, con, args.lat, args.lon, radius_km, args.limit,
+                                   repeat=args.repeat),
+        })
+    con.close()
+    print(f"Viewports around ({args.lat}, {args.lon}), limit {args.limit}")
+    print_table(rows, ["viewport_deg", "rows", "bbox_ms", "radius_km", "radius_ms"])
+
+
+def _reference_ids(con) -> dict:
+    """Existing agent, category and user ids to point generated rows at"""
+    ids = {}
+    with con:
+        with con.cursor() as cursor:
+            for table, column in (("realtor_agent", "agent_id"), ("listing_categories", "category_id"), ("users", "user_id")):
+                cursor.execute(f"SELECT {column} FROM {table} ORDER BY {column} LIMIT 100;")
+                ids[column] = [row[0] for row in cursor.fetchall()]
+                if not ids[column]:
+                    raise RuntimeError(f"{table} is empty, load seed_data.sql first")
+    return ids
+
+
+def _import_rows(count: int, ids: dict, prefix: str) -> list:
+    rows = []
+    for i in range(count):
+        rows.append({
+            "external_ref": f"{prefix}-{i}",
+            "agent_id": ids["agent_id"][i % len(ids["agent_id"])],
+            "category_id": ids["category_id"][i % len(ids["category_id"])],
+            "user_id": ids["user_id"][i % len(ids["user_id"])],
+            "title": f"Importerad bostad {i}",
+            "description": "Ljus och rymlig bostad med balkong, nära till kommunikationer och service.",
+            "price": 1500000 + (i % 500) * 25000,
+            "address": f"Testgatan {i % 200 + 1}",
+            "city": ("Stockholm", "Göteborg", "Malmö", "Uppsala")[i % 4],
+            "postal_code": "111 22",
+            "rooms": 1 + i % 6,
+            "size_sqm": 25 + i % 150,
+        })
+    return rows
+
+
+def bench_import(args):
+    """Rows/sec of db.bulk_import_listings vs one db.create_listing (and transaction) per row"""
+    con = get_connection()
+    ids = _reference_ids(con)
+    prefix = f"bench-import-{int(time.time())}"
+    rows = []
+
+    single_rows = _import_rows(args.single, ids, prefix + "-single")
+    start = time.perf_counter()
+    for row in single_rows:
+        db.create_listing(con, **row)
+    elapsed = time.perf_counter() - start
+    rows.append({"path": "create_listing", "rows": len(single_rows), "seconds": round(elapsed, 2),
+                 "rows_per_sec": round(len(single_rows) / elapsed, 1)})
+
+    bulk_rows = _import_rows(args.rows, ids, prefix + "-bulk")
+    start = time.perf_counter()
+    for i in range(0, len(bulk_rows), args.batch):
+        db.bulk_import_listings(con, bulk_rows[i:i + args.batch])
+    elapsed = time.perf_counter() - start
+    rows.append({"path": f"bulk_import ({args.batch}/batch)", "rows": len(bulk_rows), "seconds": round(elapsed, 2),
+                 "rows_per_sec": round(len(bulk_rows) / elapsed, 1)})
+
+    # Same batches again, every row already exists
+    start = time.perf_counter()
+    for i in range(0, len(bulk_rows), args.batch):
+        db.bulk_import_listings(con, bulk_rows[i:i + args.batch], upsert=True)
+    elapsed = time.perf_counter() - start
+    rows.append({"path": "bulk re-import (upsert)", "rows": len(bulk_rows), "seconds": round(elapsed, 2),
+                 "rows_per_sec": round(len(bulk_rows) / elapsed, 1)})
+
+    if not args.keep:
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute("DELETE FROM house_listing WHERE title LIKE 'Importerad bostad %%' AND "
+                               "(external_ref LIKE %s OR external_ref IS NULL);", (prefix + "%",))
+    con.close()
+    print_table(rows, ["path", "rows", "seconds", "rows_per_sec"])
+
+
+# What the saved search triggers run for one new listing
+SAVED_SEARCH_LOOKUP_SQL = "SELECT count(*) FROM ({}) matching;".format(SAVED_SEARCH_MATCH_SQL.format(listings="""
+    (SELECT 0 AS listing_id, %(price)s::numeric AS price, 'active' AS status,
+            %(city)s::varchar AS city, %(category_id)s::integer AS category_id)"""))
+
+# Plain predicates over every saved search, what re-running all searches per listing would cost
+SAVED_SEARCH_SCAN_SQL = """
+    SELECT count(*) FROM saved_searches
+    WHERE is_active
+      AND (category_id IS NULL OR category_id = %(category_id)s)
+      AND (city IS NULL OR lower(city) = lower(%(city)s))
+      AND (min_price IS NULL OR min_price <= %(price)s)
+      AND (max_price IS NULL OR max_price >= %(price)s);
+"""
+
+
+def bench_saved_searches(args):
+    """
+    Loads --searches saved searches, then creates --listings listings through db.create_listing, whose insert
+    trigger matches each one against the saved searches. Reports create_listing latency and the matcher's index lookup vs
+    a scan of all saved searches, and checks that both find the same searches
+    """
+    from datagen import copy_rows
+
+    con = get_connection()
+    ids = _reference_ids(con)
+    rng = random.Random(args.seed)
+    tag = f"bench-saved-{int(time.time())}"
+    weights = [city[3] for city in CITIES]
+
+    def searches():
+        for _ in range(args.searches):
+            city = rng.choices(CITIES, weights)[0]
+            # A flat of 40-120 sqm in that city, most searches set both bounds
+            low = round(city[4] * rng.uniform(40, 80), -4)
+            high = round(low * rng.uniform(1.2, 2.5), -4)
+            yield (
+                rng.choice(ids["user_id"]), tag,
+                city[0] if rng.random() < 0.8 else None,
+                rng.choice(ids["category_id"]) if rng.random() < 0.6 else None,
+                low if rng.random() < 0.9 else None,
+                high if rng.random() < 0.9 else None,
+            )
+
+    start = time.perf_counter()
+    loaded = copy_rows(con, "saved_searches", ("user_id", "name", "city", "category_id", "min_price", "max_price"),
+                       searches())
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("ANALYZE saved_searches;")
+    print(f"Loaded {loaded} saved searches in {time.perf_counter() - start:.1f}s")
+
+    create_latencies, match_latencies, scan_latencies = [], [], []
+    matches, mismatches = [], 0
+    listing_ids = []
+    for i in range(args.listings):
+        city = rng.choices(CITIES, weights)[0]
+        size = rng.randint(30, 150)
+        row = {
+            "agent_id": rng.choice(ids["agent_id"]), "category_id": rng.choice(ids["category_id"]),
+            "user_id": rng.choice(ids["user_id"]), "title": f"Bevakad bostad {i}",
+            "description": "Nyinkommen bostad för bevakningstest.", "price": round(city[4] * size, -4),
+            "address": f"Testgatan {i % 200 + 1}", "city": city[0], "postal_code": f"{city[5]} 22", "size_sqm": size,
+        }
+        start = time.perf_counter()
+        listing_id = db.create_listing(con, **row)
+        create_latencies.append(time.perf_counter() - start)
+        listing_ids.append(listing_id)
+
+        listing = {"price": row["price"], "city": row["city"], "category_id": row["category_id"]}
+        with con:
+            with con.cursor() as cursor:
+                start = time.perf_counter()
+                cursor.execute(SAVED_SEARCH_LOOKUP_SQL, listing)
+                found = cursor.fetchone()[0]
+                match_latencies.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                cursor.execute(SAVED_SEARCH_SCAN_SQL, listing)
+                expected = cursor.fetchone()[0]
+                scan_latencies.append(time.perf_counter() - start)
+                cursor.execute("SELECT count(*) FROM saved_search_matches WHERE listing_id = %s;", (listing_id,))
+                written = cursor.fetchone()[0]
+        matches.append(written)
+        mismatches += not (found == expected == written)
+
+    if not args.keep:
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute("DELETE FROM house_listing WHERE listing_id = ANY(%s);", (listing_ids,))
+                cursor.execute("DELETE FROM saved_searches WHERE name = %s;", (tag,))
+    con.close()
+
+    rows = []
+    for name, latencies in (("create_listing (with matching)", create_latencies),
+                            ("matcher lookup", match_latencies),
+                            ("scan of all searches", scan_latencies)):
+        rows.append({"step": name, "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                     "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+                     "p99_ms": round(percentile(latencies, 99) * 1000, 2)})
+    print(f"{args.listings} new listings against {loaded} saved searches, "
+          f"{sum(matches) / len(matches):.1f} matches per listing (max {max(matches)})")
+    print_table(rows, ["step", "p50_ms", "p95_ms", "p99_ms"])
+    if mismatches:
+        print(f"FAILED: {mismatches} listings where the matcher, the scan and the outbox disagree")
+        sys.exit(1)
+    print("OK: the outbox has exactly the searches the scan finds for every listing")
+
+
+def bench_partitions(args):
+    """
+    The same --bids bids, generated in the database over --months months, in a plain table and in one
+    partitioned by month like create_tables(partitioned=True) makes it. Compares time range queries, the newest
+    bids, one listing's bids and removing the oldest month (DELETE vs DETACH)
+    """
+    import re
+    from datetime import datetime, timedelta
+    from db_setup import add_months, create_monthly_partitions
+
+    plain, partitioned = "bench_bids_plain", "bench_bids_partitioned"
+    end = datetime.now().replace(microsecond=0)
+    start = datetime.combine(add_months(end.date(), 1 - args.months), datetime.min.time())
+    con = get_connection()
+
+    with con:
+        with con.cursor() as cursor:
+            for table in (plain, partitioned):
+                cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+            cursor.execute(f"""
+                CREATE TABLE {plain} (
+                    bid_id BIGINT PRIMARY KEY, listing_id INTEGER NOT NULL, user_id INTEGER,
+                    amount DECIMAL NOT NULL, bid_date TIMESTAMP NOT NULL, status VARCHAR(20) NOT NULL
+                );
+            """)
+            cursor.execute(f"CREATE TABLE {partitioned} (LIKE {plain}) PARTITION BY RANGE (bid_date);")
+            cursor.execute(f"ALTER TABLE {partitioned} ADD PRIMARY KEY (bid_id, bid_date);")
+            create_monthly_partitions(cursor, partitioned, "bid_date", start.date(), end.date())
+
+    rows = []
+    for table in (plain, partitioned):
+        load_start = time.perf_counter()
+        with con:
+            with con.cursor() as cursor:
+                # Spread evenly over the period, ordered by time like real bids
+                cursor.execute(f"""
+                    INSERT INTO {table}
+                    SELECT i, 1 + i %% %(listings)s, 1 + i %% 1000, 1000000 + (i %% 500) * 10000,
+                           %(start)s::timestamp + (i::float8 / %(bids)s) * (%(end)s::timestamp - %(start)s::timestamp),
+                           'pending'
+                    FROM generate_series(1, %(bids)s) i;
+                """, {"listings": args.listings, "bids": args.bids, "start": start, "end": end})
+                cursor.execute(f"CREATE INDEX ON {table}(listing_id);")
+                cursor.execute(f"CREATE INDEX ON {table}(bid_date);")
+        con.autocommit = True
+        with con.cursor() as cursor:
+            cursor.execute(f"VACUUM ANALYZE {table};")
+        con.autocommit = False
+        rows.append({"query": "load + index", "table": table, "ms": round((time.perf_counter() - load_start) * 1000)})
+
+    last_week = end - timedelta(days=7)
+    last_month = datetime.combine(add_months(end.date(), -1), datetime.min.time())
+    queries = [
+        ("last 7 days, count", "SELECT count(*), max(amount) FROM {table} WHERE bid_date >= %s AND bid_date < %s",
+         (last_week, end)),
+        ("newest 100", "SELECT * FROM {table} ORDER BY bid_date DESC LIMIT 100", ()),
+        ("newest 100 since last month", "SELECT * FROM {table} WHERE bid_date >= %s ORDER BY bid_date DESC LIMIT 100",
+         (last_month,)),
+        ("one listing", "SELECT * FROM {table} WHERE listing_id = %s ORDER BY amount DESC", (args.listings // 2,)),
+        ("one listing, last 7 days", "SELECT * FROM {table} WHERE listing_id = %s AND bid_date >= %s "
+                                     "ORDER BY amount DESC", (args.listings // 2, last_week)),
+    ]
+
+    def run(query, params):
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute(query, params)
+                cursor.fetchall()
+
+    for name, query, params in queries:
+        for table in (plain, partitioned):
+            sql = query.format(table=table)
+            plan = explain(con, sql, params)
+            scanned = len(set(re.findall(rf"on ({partitioned}_y\d+m\d+)", plan))) if table == partitioned else ""
+            rows.append({"query": name, "table": table, "ms": time_call(run, sql, params, repeat=args.repeat),
+                         "partitions_read": scanned})
+
+    # Dropping the oldest month: a DELETE of its rows vs detaching its partition
+    following = datetime.combine(add_months(start.date(), 1), datetime.min.time())
+    with con:
+        with con.cursor() as cursor:
+            removal_start = time.perf_counter()
+            cursor.execute(f"DELETE FROM {plain} WHERE bid_date < %s;", (following,))
+            rows.append({"query": "remove oldest month", "table": plain,
+                         "ms": round((time.perf_counter() - removal_start) * 1000)})
+            removal_start = time.perf_counter()
+            oldest = f"{partitioned}_y{start.year}m{start.month:02d}"
+            cursor.execute(f"ALTER TABLE {partitioned} DETACH PARTITION {oldest};")
+            cursor.execute(f"DROP TABLE {oldest};")
+            rows.append({"query": "remove oldest month", "table": partitioned,
+                         "ms": round((time.perf_counter() - removal_start) * 1000)})
+
+    if not args.keep:
+        with con:
+            with con.cursor() as cursor:
+                for table in (plain, partitioned):
+                    cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+    con.close()
+    print(f"{args.bids:,} bids over {args.months} months, median of {args.repeat}")
+    print_table(rows, ["query", "table", "ms", "partitions_read"])
+
+
+def _cpu_ms(fn, repeat: int) -> float:
+    """Median CPU time (not wall time) of fn() in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        timings.append(time.process_time() - start)
+    return round(percentile(timings, 50) * 1000, 3)
+
+
+def bench_json(args):
+    """CPU time per response of FastAPI's default encoding (jsonable_encoder + json) vs FastJSONResponse"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from responses import FastJSONResponse
+
+    con = get_connection()
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT listing_id FROM bids GROUP BY listing_id ORDER BY count(*) DESC LIMIT 1;")
+            busiest_listing = (cursor.fetchone() or (None,))[0]
+            cursor.execute("SELECT user_id FROM favorites GROUP BY user_id ORDER BY count(*) DESC LIMIT 1;")
+            busiest_user = (cursor.fetchone() or (0,))[0]
+    pages = [
+        ("/listings", "listings", db.get_listings(con, args.limit)),
+        ("/bids?listing_id", "bids", db.get_bids(con, busiest_listing)),
+        ("/users/{id}/favorites", "favorites", db.get_favorites(con, busiest_user)),
+    ]
+    con.close()
+
+    rows = []
+    for route, key, items in pages:
+        content = {key: items, "count": len(items)}
+        default = JSONResponse(jsonable_encoder(content)).body
+        fast = FastJSONResponse(content).body
+        rows.append({
+            "route": route,
+            "rows": len(items),
+            "default_ms": _cpu_ms(lambda: JSONResponse(jsonable_encoder(content)).body, args.repeat),
+            "fast_ms": _cpu_ms(lambda: FastJSONResponse(content).body, args.repeat),
+            "default_bytes": len(default),
+            "fast_bytes": len(fast),
+            "same": json.loads(default) == json.loads(fast),
+        })
+    for row in rows:
+        row["speedup"] = f"{row['default_ms'] / row['fast_ms']:.1f}x" if row["fast_ms"] else ""
+    print(f"CPU time per response, median of {args.repeat}")
+    print_table(rows, ["route", "rows", "default_ms", "fast_ms", "speedup", "default_bytes", "fast_bytes", "same"])
+
+
+# The columns a listing grid shows, see bench compression
+GRID_FIELDS = ["listing_id", "title", "price", "address", "city", "rooms", "size_sqm", "created_at"]
+
+
+def bench_compression(args):
+    """
+    Bytes on the wire and estimated latency of typical /listings pages: all columns vs fields=,
+    uncompressed vs gzip and brotli (compression.py). Transfer time is estimated for a --mbps link
+    """
+    import compression
+    from responses import dumps
+
+    con = get_connection()
+    variants = [
+        ("all columns", {}),
+        ("fields=grid", {"fields": GRID_FIELDS}),
+        ("summary, fields=grid", {"summary": True, "fields": GRID_FIELDS + ["primary_image_url"]}),
+    ]
+    rows = []
+    for limit in args.limits:
+        for name, kwargs in variants:
+            listings = db.get_listings(con, limit, **kwargs)
+            body = dumps({"listings": listings, "count": len(listings)})
+            query_ms = time_call(db.get_listings, con, limit, repeat=args.repeat, **kwargs)
+            encodings = [("identity", None)] + [(encoding, compression.ENCODERS[encoding])
+                                                for encoding in compression.PREFERENCE
+                                                if encoding in compression.ENCODERS]
+            for encoding, encoder in encodings:
+                wire = encoder(body) if encoder else body
+                compress_ms = _cpu_ms(lambda: encoder(body), args.repeat) if encoder else 0.0
+                transfer_ms = len(wire) * 8 / (args.mbps * 1_000_000) * 1000
+                rows.append({
+                    "limit": limit,
+                    "page": name,
+                    "encoding": encoding,
+                    "bytes": len(wire),
+                    "query_ms": query_ms,
+                    "compress_ms": compress_ms,
+                    "transfer_ms": round(transfer_ms, 2),
+                    "total_ms": round(query_ms + compress_ms + transfer_ms, 2),
+                })
+    con.close()
+
+    baselines = {row["limit"]: row for row in rows if row["page"] == "all columns" and row["encoding"] == "identity"}
+    for row in rows:
+        baseline = baselines[row["limit"]]
+        row["bytes_saved"] = f"{1 - row['bytes'] / baseline['bytes']:.0%}"
+        row["time_saved"] = f"{1 - row['total_ms'] / baseline['total_ms']:.0%}" if baseline["total_ms"] else ""
+    print(f"/listings pages, median of {args.repeat}, transfer at {args.mbps} Mbit/s")
+    print_table(rows, ["limit", "page", "encoding", "bytes", "bytes_saved", "query_ms", "compress_ms",
+                       "transfer_ms", "total_ms", "time_saved"])
+
+
+def bench_rows(args):
+    """Time, memory and garbage collections to fetch (and encode) N listing rows, RealDictCursor vs RecordCursor"""
+    import gc
+    import tracemalloc
+    from psycopg2.extras import RealDictCursor
+    from records import RecordCursor
+    from responses import dumps
+
+    query = f"SELECT {db.LISTING_SELECT} FROM house_listing ORDER BY listing_id LIMIT %s;"
+    con = get_connection()
+
+    def fetch(cursor_factory):
+        with con:
+            with con.cursor(cursor_factory=cursor_factory) as cursor:
+                cursor.execute(query, (args.rows,))
+                return cursor.fetchall()
+
+    rows = []
+    for name, cursor_factory in (("RealDictCursor", RealDictCursor), ("RecordCursor", RecordCursor)):
+        fetched = fetch(cursor_factory)
+        # Memory held by the fetched rows, measured on a fresh fetch
+        del fetched
+        gc.collect()
+        tracemalloc.start()
+        fetched = fetch(cursor_factory)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        collections = sum(stat["collections"] for stat in gc.get_stats())
+        fetch_ms = time_call(fetch, cursor_factory, repeat=args.repeat)
+        collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+        rows.append({
+            "cursor": name,
+            "rows": len(fetched),
+            "fetch_ms": fetch_ms,
+            "encode_ms": time_call(dumps, {"listings": fetched}, repeat=args.repeat),
+            "memory_kb": round(memory / 1024),
+            "bytes_per_row": round(memory / max(len(fetched), 1)),
+            "gc_runs": collections,
+        })
+        del fetched
+    con.close()
+    print(f"{args.rows} rows from house_listing, median of {args.repeat} (gc_runs is the total over all runs)")
+    print_table(rows, ["cursor", "rows", "fetch_ms", "encode_ms", "memory_kb", "bytes_per_row", "gc_runs"])
+
+
+def bench_prepared(args):
+    """Point lookups with plain SQL vs prepared statements (prepared.py), microseconds per call"""
+    import prepared
+
+    ids = _max_ids()
+    lookups = [
+        ("get_listing", db.get_listing, "listing_id"),
+        ("get_user", db.get_user, "user_id"),
+        ("get_listing_images", db.get_listing_images, "listing_id"),
+        ("get_bids", db.get_bids, "listing_id"),
+    ]
+    results = {}
+    for enabled in (False, True):
+        prepared.ENABLED = enabled
+        con = get_connection()
+        for name, fn, id_column in lookups:
+            r = random.Random(args.seed)
+            keys = [r.randint(1, ids[id_column]) for _ in range(args.calls)]
+            for key in keys[:100]:  # warm up, prepares the statement
+                fn(con, key)
+            start = time.perf_counter()
+            for key in keys:
+                fn(con, key)
+            results[(name, enabled)] = (time.perf_counter() - start) / len(keys) * 1e6
+        con.close()
+
+    rows = []
+    for name, _, _ in lookups:
+        plain, fast = results[(name, False)], results[(name, True)]
+        rows.append({"function": name, "plain_us": round(plain, 1), "prepared_us": round(fast, 1),
+                     "change": f"{(fast - plain) / plain * 100:+.1f}%"})
+    print(f"{args.calls} calls per function with random ids, one connection")
+    print_table(rows, ["function", "plain_us", "prepared_us", "change"])
+
+
+def bench_bidding(args):
+    """
+    Hundreds of concurrent bidders on one listing through db.create_bid. Every bidder reads the current
+    highest bid and tries to beat it, so many bids are stale by the time they're placed and must be rejected.
+    Checks afterwards that the accepted bids strictly increase in the order they were placed and that
+    house_listing.highest_bid and listing_summary agree with the bids table. Exits with 1 if not
+    """
+    import threading
+    from pool import ConnectionPool
+
+    con = get_connection()
+    ids = _reference_ids(con)
+    row = _import_rows(1, ids, f"bench-bidding-{int(time.time())}")[0]
+    listing_id = db.create_listing(con, **row)  # status defaults to active
+
+    pool = ConnectionPool(get_connection, max_size=args.connections, timeout=60)
+    start_line = threading.Barrier(args.bidders)
+    lock = threading.Lock()
+    counts = {"accepted": 0, "rejected": 0, "errors": 0}
+    latencies = []
+
+    def bidder(number: int):
+        r = random.Random(args.seed + number)
+        user_id = ids["user_id"][number % len(ids["user_id"])]
+        start_line.wait()
+        for _ in range(args.bids):
+            conn = pool.getconn()
+            try:
+                with conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT highest_bid FROM house_listing WHERE listing_id = %s;", (listing_id,))
+                        highest = cursor.fetchone()[0] or row["price"]
+                start = time.perf_counter()
+                try:
+                    db.create_bid(conn, listing_id, user_id, highest + r.randint(1, 20) * 1000)
+                    outcome = "accepted"
+                except db.BidRejected:
+                    outcome = "rejected"
+                except Exception:
+                    outcome = "errors"
+                elapsed = time.perf_counter() - start
+            finally:
+                pool.putconn(conn)
+            with lock:
+                counts[outcome] += 1
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=bidder, args=(number,)) for number in range(args.bidders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.close()
+
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT amount FROM bids WHERE listing_id = %s ORDER BY bid_id;", (listing_id,))
+            amounts = [amount for amount, in cursor.fetchall()]
+            cursor.execute("SELECT highest_bid FROM house_listing WHERE listing_id = %s;", (listing_id,))
+            cached = cursor.fetchone()[0]
+            cursor.execute("SELECT bid_count, highest_bid FROM listing_summary WHERE listing_id = %s;", (listing_id,))
+            summary = cursor.fetchone()
+
+    checks = {
+        "accepted bids are stored": len(amounts) == counts["accepted"],
+        "amounts increase in bid order": all(a < b for a, b in zip(amounts, amounts[1:])),
+        "house_listing.highest_bid is the highest bid": cached == (max(amounts) if amounts else None),
+        "listing_summary matches": summary is None or tuple(summary) == (len(amounts), max(amounts, default=None)),
+        "no errors": counts["errors"] == 0,
+    }
+    if not args.keep:
+        db.delete_listing(con, listing_id)
+    con.close()
+
+    total = sum(counts.values())
+    print(f"{args.bidders} bidders x {args.bids} bids on listing {listing_id}, {args.connections} connections")
+    print_table([{**counts, "bids_per_sec": round(total / elapsed, 1),
+                  "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                  "p99_ms": round(percentile(latencies, 99) * 1000, 2)}],
+                ["accepted", "rejected", "errors", "bids_per_sec", "p50_ms", "p99_ms"])
+    print_table([{"check": check, "ok": ok} for check, ok in checks.items()], ["check", "ok"])
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+# (route, weight, path) - path gets a Random and the max ids from _max_ids() and returns the url to request
+LOAD_MIX = [
+    ("GET /listings", 20, lambda r, ids: "/listings?limit=20"),
+    ("GET /listings?city", 10, lambda r, ids: f"/listings?city={r.choice(CITIES)[0]}&city_match=exact&limit=20"),
+    ("GET /listings?price", 5, lambda r, ids: f"/listings?min_price={r.randrange(1, 5) * 1000000}"
+                                              f"&max_price={r.randrange(5, 15) * 1000000}&limit=20"),
+    ("GET /listings/search", 8, lambda r, ids: f"/listings/search?q={r.choice(['balkong', 'sjöutsikt', 'pool', 'kakelugn', 'garage'])}"),
+    ("GET /listings/geo", 8, lambda r, ids: "/listings/geo?lat={1}&lon={2}&radius_km=3".format(*r.choice(CITIES))),
+    ("GET /listings/{id}", 25, lambda r, ids: f"/listings/{r.randint(1, ids['listing_id'])}"),
+    ("GET /listings/{id}/images", 8, lambda r, ids: f"/listings/{r.randint(1, ids['listing_id'])}/images"),
+    ("GET /bids?listing_id", 6, lambda r, ids: f"/bids?listing_id={r.randint(1, ids['listing_id'])}"),
+    ("GET /users/{id}/favorites", 5, lambda r, ids: f"/users/{r.randint(1, ids['user_id'])}/favorites"),
+    ("GET /categories", 3, lambda r, ids: "/categories"),
+    ("GET /agencies/{id}", 2, lambda r, ids: f"/agencies/{r.randint(1, ids['agency_id'])}"),
+]
+
+
+def _max_ids() -> dict:
+    con = get_connection()
+    ids = {}
+    with con:
+        with con.cursor() as cursor:
+            for table, column in (("house_listing", "listing_id"), ("users", "user_id"),
+                                  ("realtor_agencies", "agency_id")):
+                cursor.execute(f"SELECT coalesce(max({column}), 1) FROM {table};")
+                ids[column] = cursor.fetchone()[0]
+    con.close()
+    return ids
+
+
+async def http_mix(base_url: str, mix, ids: dict, clients: int, total: int, seed: int) -> dict:
+    """
+    Like http_load, but every request picks a route from the weighted mix. Returns summarize() per route
+    plus "total". Missing rows (404) are expected with random ids and aren't counted as errors
+    """
+    r = random.Random(seed)
+    weights = [weight for _, weight, _ in mix]
+    latencies = {route: [] for route, _, _ in mix}
+    errors = {route: 0 for route, _, _ in mix}
+    sent = 0
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60,
+                                 limits=httpx.Limits(max_connections=clients)) as client:
+        async def worker():
+            nonlocal sent
+            while sent < total:
+                route, _, path = r.choices(mix, weights=weights)[0]
+                url = path(r, ids)
+                sent += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    if response.status_code >= 400 and response.status_code != 404:
+                        errors[route] += 1
+                except httpx.HTTPError:
+                    errors[route] += 1
+                latencies[route].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        elapsed = time.perf_counter() - start
+
+    results = {route: summarize(latencies[route], elapsed, errors[route]) for route in latencies}
+    results["total"] = summarize([latency for values in latencies.values() for latency in values],
+                                 elapsed, sum(errors.values()))
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def bench_load(args):
+    """
+    Replays LOAD_MIX against the api and reports throughput and latency percentiles per route.
+    --output writes the results as json, --baseline compares against such a file from an earlier run
+    """
+    ids = _max_ids()
+
+    def run(base_url):
+        # warm up the pool, the cache and the database buffers
+        asyncio.run(http_mix(base_url, LOAD_MIX, ids, 10, min(args.requests, 500), args.seed + 1))
+        return asyncio.run(http_mix(base_url, LOAD_MIX, ids, args.clients, args.requests, args.seed))
+
+    if args.url:
+        routes = run(args.url)
+    else:
+        with Server(args.module, args.port, args.workers) as server:
+            routes = run(server.base_url)
+
+    result = {
+        "commit": _git_commit(),
+        "module": None if args.url else args.module,
+        "clients": args.clients,
+        "requests": args.requests,
+        "seed": args.seed,
+        "routes": routes,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["routes"]
+
+    rows = []
+    for route, stats in routes.items():
+        row = {"route": route, **stats}
+        if route in baseline:
+            for column in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+                before = baseline[route][column]
+                row[column + "_diff"] = f"{(stats[column] - before) / before * 100:+.1f}%" if before else ""
+        rows.append(row)
+    columns = ["route", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms"]
+    if baseline:
+        columns += ["rps_diff", "p50_ms_diff", "p95_ms_diff", "p99_ms_diff"]
+    print(f"{args.requests} requests, {args.clients} concurrent clients, commit {result['commit'] or '?'}")
+    print_table(rows, columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_async = subparsers.add_parser("async", help="sync vs async endpoints under concurrent load")
+    parser_async.add_argument("--clients", type=int, default=200)
+    parser_async.add_argument("--requests", type=int, default=20000)
+    parser_async.add_argument("--path", default="/listings")
+    parser_async.add_argument("--port", type=int, default=8765)
+    parser_async.set_defaults(func=bench_async)
+
+    parser_pagination = subparsers.add_parser("pagination", help="page 1 vs a deep page, offset vs keyset")
+    parser_pagination.add_argument("--page", type=int, default=10000)
+    parser_pagination.add_argument("--limit", type=int, default=20)
+    parser_pagination.add_argument("--repeat", type=int, default=20)
+    parser_pagination.set_defaults(func=bench_pagination)
+
+    parser_city = subparsers.add_parser("explain-city", help="check that the city filters use their indexes")
+    parser_city.add_argument("--natural", action="store_true", help="don't disable sequential scans")
+    parser_city.add_argument("--verbose", action="store_true", help="print the plans")
+    parser_city.set_defaults(func=check_city_indexes)
+
+    parser_geo = subparsers.add_parser("geo", help="viewport and radius queries of different sizes")
+    parser_geo.add_argument("--lat", type=float, default=59.3293)
+    parser_geo.add_argument("--lon", type=float, default=18.0686)
+    parser_geo.add_argument("--limit", type=int, default=500)
+    parser_geo.add_argument("--repeat", type=int, default=20)
+    parser_geo.set_defaults(func=bench_geo)
+
+    parser_import = subparsers.add_parser("import", help="bulk import vs single row inserts")
+    parser_import.add_argument("--rows", type=int, default=100000)
+    parser_import.add_argument("--single", type=int, default=2000, help="rows for the single row path")
+    parser_import.add_argument("--batch", type=int, default=5000)
+    parser_import.add_argument("--keep", action="store_true", help="keep the imported rows")
+    parser_import.set_defaults(func=bench_import)
+
+    parser_saved = subparsers.add_parser("saved-searches", help="matching new listings against saved searches")
+    parser_saved.add_argument("--searches", type=int, default=1_000_000)
+    parser_saved.add_argument("--listings", type=int, default=1000)
+    parser_saved.add_argument("--seed", type=int, default=1)
+    parser_saved.add_argument("--keep", action="store_true", help="keep the saved searches, listings and matches")
+    parser_saved.set_defaults(func=bench_saved_searches)
+
+    parser_partitions = subparsers.add_parser("partitions", help="plain vs monthly partitioned bids table")
+    parser_partitions.add_argument("--bids", type=int, default=50_000_000)
+    parser_partitions.add_argument("--months", type=int, default=36)
+    parser_partitions.add_argument("--listings", type=int, default=200_000)
+    parser_partitions.add_argument("--repeat", type=int, default=10)
+    parser_partitions.add_argument("--keep", action="store_true", help="keep the two benchmark tables")
+    parser_partitions.set_defaults(func=bench_partitions)
+
+    parser_json = subparsers.add_parser("json", help="CPU time of the JSON encoding of list responses")
+    parser_json.add_argument("--limit", type=int, default=500)
+    parser_json.add_argument("--repeat", type=int, default=50)
+    parser_json.set_defaults(func=bench_json)
+
+    parser_compression = subparsers.add_parser("compression", help="bytes and latency of list pages, fields= and gzip/brotli")
+    parser_compression.add_argument("--limits", type=int, nargs="+", default=[20, 100, 500])
+    parser_compression.add_argument("--mbps", type=float, default=20.0, help="link speed for the transfer estimate")
+    parser_compression.add_argument("--repeat", type=int, default=20)
+    parser_compression.set_defaults(func=bench_compression)
+
+    parser_rows = subparsers.add_parser("rows", help="RealDictCursor vs RecordCursor rows")
+    parser_rows.add_argument("--rows", type=int, default=10000)
+    parser_rows.add_argument("--repeat", type=int, default=20)
+    parser_rows.set_defaults(func=bench_rows)
+
+    parser_prepared = subparsers.add_parser("prepared", help="point lookups, plain SQL vs prepared statements")
+    parser_prepared.add_argument("--calls", type=int, default=5000)
+    parser_prepared.add_argument("--seed", type=int, default=1)
+    parser_prepared.set_defaults(func=bench_prepared)
+
+    parser_bidding = subparsers.add_parser("bidding", help="concurrent bidders on one listing, checks correctness")
+    parser_bidding.add_argument("--bidders", type=int, default=300)
+    parser_bidding.add_argument("--bids", type=int, default=20, help="bids per bidder")
+    parser_bidding.add_argument("--connections", type=int, default=50)
+    parser_bidding.add_argument("--seed", type=int, default=1)
+    parser_bidding.add_argument("--keep", action="store_true", help="keep the listing and its bids")
+    parser_bidding.set_defaults(func=bench_bidding)
+
+    parser_load = subparsers.add_parser("load", help="weighted mix of endpoints, results per route")
+    parser_load.add_argument("--clients", type=int, default=50)
+    parser_load.add_argument("--requests", type=int, default=20000)
+    parser_load.add_argument("--seed", type=int, default=1)
+    parser_load.add_argument("--url", help="api that is already running, otherwise --module is started")
+    parser_load.add_argument("--module", default="app")
+    parser_load.add_argument("--workers", type=int, default=1)
+    parser_load.add_argument("--port", type=int, default=8765)
+    parser_load.add_argument("--output", help="write the results to this json file")
+    parser_load.add_argument("--baseline", help="json file from an earlier run to compare against")
+    parser_load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
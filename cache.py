@@ -0,0 +1,202 @@
+import functools
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Read-through cache for data that rarely changes (categories, agencies, agents).
+
+- By default every process keeps a bounded LRU cache where entries expire after CACHE_TTL seconds
+- With CACHE_REDIS_URL set, the cache lives in redis instead so all uvicorn workers share it
+  (needs the redis package, pip install redis)
+- Entries are grouped in namespaces, writes call invalidate(namespace) to drop everything in it
+
+Usage in db.py:
+
+    @cached("categories")
+    def get_categories(con): ...
+"""
+
+CACHE_MAX_SIZE = 1024
+CACHE_TTL = 300.0
+
+
+class LRUCache:
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: float = CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._generations = {}  # namespace -> number of invalidations
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, namespace: str, key):
+        """Returns (found, value)"""
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end((namespace, key))
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[(namespace, key)]
+            self.misses += 1
+            return False, None
+
+    def generation(self, namespace: str):
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def set(self, namespace: str, key, value, generation=None):
+        with self._lock:
+            # The namespace was invalidated while the value was being loaded, it might be stale already
+            if generation is not None and generation != self._generations.get(namespace, 0):
+                return
+            self._entries[(namespace, key)] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, namespace: str):
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == namespace]:
+                del self._entries[cache_key]
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "lru",
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class RedisCache:
+    """Same interface as LRUCache, redis takes care of expiry and of evictions (maxmemory-policy)"""
+
+    def __init__(self, url: str, ttl: float = CACHE_TTL, prefix: str = "hemnet"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_REDIS_URL is set but the redis package isn't installed (pip install redis)")
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _key(self, namespace: str, key) -> str:
+        return f"{self.prefix}:{namespace}:{key!r}"
+
+    def get(self, namespace: str, key):
+        data = self._redis.get(self._key(namespace, key))
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, pickle.loads(data)
+
+    def generation(self, namespace: str):
+        return None
+
+    def set(self, namespace: str, key, value, generation=None):
+        self._redis.set(self._key(namespace, key), pickle.dumps(value), ex=max(1, int(self.ttl)))
+
+    def invalidate(self, namespace: str):
+        keys = list(self._redis.scan_iter(match=f"{self.prefix}:{namespace}:*", count=500))
+        if keys:
+            self._redis.delete(*keys)
+        with self._lock:
+            self.invalidations += 1
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(match=f"{self.prefix}:*", count=500))
+        if keys:
+            self._redis.delete(*keys)
+
+    def stats(self) -> dict:
+        evictions = self._redis.info("stats").get("evicted_keys", 0)
+        with self._lock:
+            return {
+                "backend": "redis",
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """The cache shared by the process, configured from the environment on first use"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                ttl = float(os.getenv("CACHE_TTL", CACHE_TTL))
+                redis_url = os.getenv("CACHE_REDIS_URL")
+                if redis_url:
+                    _cache = RedisCache(redis_url, ttl=ttl)
+                else:
+                    _cache = LRUCache(int(os.getenv("CACHE_MAX_SIZE", CACHE_MAX_SIZE)), ttl=ttl)
+    return _cache
+
+
+def invalidate(namespace: str):
+    get_cache().invalidate(namespace)
+
+
+def _detach(value):
+    """Plain dicts instead of cursor rows, so cached values can be pickled and aren't tied to a cursor"""
+    if isinstance(value, list):
+        return [dict(row) for row in value]
+    if value is not None:
+        return dict(value)
+    return value
+
+
+def cached(namespace: str):
+    """
+    Caches the result of a db function, keyed by its arguments (the connection isn't part of the key).
+    None (no such row) isn't cached.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(con, *args, **kwargs):
+            key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+            cache = get_cache()
+            found, value = cache.get(namespace, key)
+            if found:
+                return value
+            generation = cache.generation(namespace)
+            value = _detach(fn(con, *args, **kwargs))
+            # a missing row isn't cached, it could be created by another worker that can't invalidate this cache
+            if value is not None:
+                cache.set(namespace, key, value, generation)
+            return value
+        return wrapper
+    return decorator
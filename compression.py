@@ -0,0 +1,120 @@
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Response compression, brotli or gzip depending on the client's Accept-Encoding.
+
+Only complete responses of at least COMPRESSION_MIN_SIZE bytes are compressed, below that the bytes saved
+don't pay for the CPU time. Streaming responses (the CSV export, the Server-Sent Events of
+/listings/{id}/bids/stream) pass through untouched: their body arrives in parts, and compressing
+an event stream would hold events back in the compressor's buffer.
+
+brotli is optional (pip install brotli), without it only gzip is offered.
+The levels favour speed, a list page compresses in about a millisecond.
+
+- COMPRESSION_MIN_SIZE - smallest body that is compressed, in bytes (default 1024, 0 disables compression)
+"""
+
+MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _encoders() -> dict:
+    encoders = {"gzip": lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        encoders["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    return encoders
+
+
+ENCODERS = _encoders()
+# Preferred first, when the client accepts both equally
+PREFERENCE = ("br", "gzip")
+
+
+def choose_encoding(accept_encoding: str):
+    """The encoding to use for this Accept-Encoding header, None if there's none we both support"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    best = None
+    for encoding in PREFERENCE:
+        if encoding not in ENCODERS:
+            continue
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+class CompressionMiddleware:
+    """ASGI middleware, compresses complete responses of at least min_size bytes"""
+
+    def __init__(self, app, min_size: int = MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.min_size:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                # Held back until the body shows whether the response is complete and large enough
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            response_headers = [(name.lower(), value) for name, value in start_message["headers"]]
+            names = {name for name, _ in response_headers}
+            if (message.get("more_body", False) or len(body) < self.min_size
+                    or b"content-encoding" in names):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = ENCODERS[encoding](body)
+            vary = b", ".join([value for name, value in response_headers if name == b"vary"] + [b"Accept-Encoding"])
+            response_headers = [(name, value) for name, value in response_headers
+                                if name not in (b"content-length", b"vary")]
+            response_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", vary),
+            ]
+            await send({**start_message, "headers": response_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
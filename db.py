@@ -1,5 +1,5 @@
 
-from datetime import datetime
+from datetime import datetime, date
 import psycopg2
 
 
@@ -49,25 +49,101 @@ start with a connection parameter.
 #             item_id = cursor.fetchone()["id"]
 #     return item_id
 
-from psycopg2.extras import RealDictCursor, DictCursor
-from typing import List, Optional, Dict, Any
-from decimal import Decimal
+from psycopg2.extras import RealDictCursor, DictCursor, execute_values
+from typing import List, Optional, Dict, Any, Iterator
+from decimal import Decimal, InvalidOperation
+import base64
+import json
+
+from cache import cached, invalidate
+from records import RecordCursor
+from db_setup import LISTING_SUMMARY_COLUMNS
+import prepared
+
+# ========== ROWS ==========
+# Most functions return RealDictRows. The list functions behind the busiest endpoints use RecordCursor
+# (records.py) instead, its rows take less memory and are cheaper to build. They're read the same way,
+# row["price"] / dict(row), and responses.FastJSONResponse encodes them as JSON objects.
+
+# The point lookups that run the most (get_user, get_listing, get_listing_images, get_bids for a listing)
+# are registered as prepared statements, see prepared.py
+
+# ========== PAGINATION ==========
+# The list functions support keyset pagination as an alternative to LIMIT/OFFSET: instead of
+# skipping `offset` rows, the caller passes `after`, an opaque cursor built from the sort key of the
+# last row it received, and the query continues right after that row using an index on the sort key.
+
+def encode_cursor(*values) -> str:
+    payload = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(token: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+def next_cursor(rows: List[Dict], limit: int, *keys) -> Optional[str]:
+    """Cursor for the page after `rows`, None when this was the last page"""
+    if len(rows) < limit:
+        return None
+    return encode_cursor(*(rows[-1][key] for key in keys))
+
+# ========== FIELD SELECTION ==========
+# get_listings, get_users and get_bids take `fields`, the columns the caller needs, and select only those,
+# so Postgres doesn't read (or detoast) and send columns like description that a list page doesn't show.
+# Only names from the function's whitelist get into the SQL.
+
+def select_list(fields: Optional[List[str]], allowed, required=(), default: str = "*") -> str:
+    """
+    SELECT list for `fields`, `default` when no fields are given. `required` columns are always
+    selected, e.g the sort key next_cursor is built from. Raises ValueError for unknown fields.
+    The columns come in the order of `allowed`, so the same fields in any order make the same query
+    (and the same record class, see records.py)
+    """
+    if not fields:
+        return default
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    selected = {*fields, *required}
+    return ", ".join(column for column in allowed if column in selected)
 
 # ========== USER OPERATIONS ==========
-def get_users(con, limit: int = 100, offset: int = 0) -> List[Dict]:
+# password_hash can't be selected through `fields`
+USER_COLUMNS = ("user_id", "email", "first_name", "last_name", "phone", "user_type", "role",
+                "created_at", "updated_at")
+
+def get_users(con, limit: int = 100, offset: int = 0, after: Optional[str] = None,
+              fields: Optional[List[str]] = None) -> List[Dict]:
+    columns = select_list(fields, USER_COLUMNS, ("user_id",))
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT * FROM users 
-                ORDER BY user_id 
-                LIMIT %s OFFSET %s;
-            """, (limit, offset))
+            if after:
+                (user_id,) = decode_cursor(after, 1)
+                cursor.execute(f"""
+                    SELECT {columns} FROM users 
+                    WHERE user_id > %s
+                    ORDER BY user_id 
+                    LIMIT %s;
+                """, (user_id, limit))
+            else:
+                cursor.execute(f"""
+                    SELECT {columns} FROM users 
+                    ORDER BY user_id 
+                    LIMIT %s OFFSET %s;
+                """, (limit, offset))
             return cursor.fetchall()
 
+prepared.register("get_user", "SELECT * FROM users WHERE user_id = %s;", ("integer",))
+
 def get_user(con, user_id: int) -> Optional[Dict]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM users WHERE user_id = %s;", (user_id,))
+            prepared.execute(cursor, "get_user", (user_id,))
             return cursor.fetchone()
 
 def create_user(con, email: str, password_hash: str, first_name: str, last_name: str,
@@ -95,7 +171,7 @@ def update_user(con, user_id: int, **kwargs) -> bool:
         with con.cursor() as cursor:
             cursor.execute(f"""
                 UPDATE users 
-                SET {set_clause}, updated_at = CURRENT_TIMESTAMP
+                SET {set_clause}, updated_at = clock_timestamp()
                 WHERE user_id = %s;
             """, tuple(values))
             return cursor.rowcount > 0
@@ -107,22 +183,41 @@ def delete_user(con, user_id: int) -> bool:
             return cursor.rowcount > 0
 
 # ========== AGENCY OPERATIONS ==========
-def get_agencies(con, limit: int = 100, offset: int = 0) -> List[Dict]:
+def get_agencies(con, limit: int = 100, offset: int = 0, after: Optional[str] = None) -> List[Dict]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT * FROM realtor_agencies 
-                ORDER BY agency_id 
-                LIMIT %s OFFSET %s;
-            """, (limit, offset))
+            if after:
+                (agency_id,) = decode_cursor(after, 1)
+                cursor.execute("""
+                    SELECT * FROM realtor_agencies 
+                    WHERE agency_id > %s
+                    ORDER BY agency_id 
+                    LIMIT %s;
+                """, (agency_id, limit))
+            else:
+                cursor.execute("""
+                    SELECT * FROM realtor_agencies 
+                    ORDER BY agency_id 
+                    LIMIT %s OFFSET %s;
+                """, (limit, offset))
             return cursor.fetchall()
 
-def get_agency(con, agency_id: int) -> Optional[Dict]:
+@cached("agencies")
+def get_agency(con, agency_id: int, version: Optional[datetime] = None) -> Optional[Dict]:
+    """version (get_agency_version) is only part of the cache key, so a newer agency isn't served from an older entry"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute("SELECT * FROM realtor_agencies WHERE agency_id = %s;", (agency_id,))
             return cursor.fetchone()
 
+def get_agency_version(con, agency_id: int) -> Optional[datetime]:
+    """Version of get_agency, agencies aren't updated through the api so it's their created_at"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT created_at FROM realtor_agencies WHERE agency_id = %s;", (agency_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
 def create_agency(con, name: str, license_number: str, **kwargs) -> Optional[int]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
@@ -143,45 +238,277 @@ def create_agency(con, name: str, license_number: str, **kwargs) -> Optional[int
                 RETURNING agency_id;
             """, tuple(values))
             result = cursor.fetchone()
-            return result["agency_id"] if result else None
+    # after the commit, so no other request can cache the old state again
+    invalidate("agencies")
+    return result["agency_id"] if result else None
 
 # ========== HOUSE LISTING OPERATIONS ==========
+# Columns returned for a listing, search_vector is internal and left out
+LISTING_COLUMNS = (
+    "listing_id", "agent_id", "category_id", "user_id", "title", "description", "price",
+    "address", "city", "postal_code", "rooms", "size_sqm", "plot_size_sqm", "year_built",
+    "floor", "balcony", "monthly_fee", "operating_cost", "latitude", "longitude", "status",
+    "published_at", "sold_at", "created_at", "updated_at", "external_ref", "highest_bid",
+)
+LISTING_SELECT = ", ".join(LISTING_COLUMNS)
+
+# Document for full text search, titles weigh more than descriptions.
+# The listings are in Swedish, hence the swedish configuration (stemming and stop words)
+SEARCH_VECTOR_SQL = ("setweight(to_tsvector('swedish', {title}), 'A') || "
+                     "setweight(to_tsvector('swedish', {description}), 'B')")
+
+CITY_MATCH_MODES = ("substring", "prefix", "exact")
+
+def _like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def listing_filters(city: Optional[str] = None, min_price: Optional[Decimal] = None,
+                    max_price: Optional[Decimal] = None, category_id: Optional[int] = None,
+                    city_match: str = "substring"):
+    """
+    Builds the WHERE clause shared by the listing queries, returns (sql, params).
+    city_match decides how `city` is compared:
+    - substring: city contains the text, case insensitive (idx_listing_city_trgm)
+    - prefix: city starts with the text, case insensitive (idx_listing_city_lower)
+    - exact: city equals the text, case insensitive (idx_listing_city_lower)
+    """
+    if city_match not in CITY_MATCH_MODES:
+        raise ValueError(f"city_match must be one of {', '.join(CITY_MATCH_MODES)}")
+
+    query = "1=1"
+    params = []
+
+    if city:
+        if city_match == "substring":
+            query += " AND city ILIKE %s"
+            params.append(f"%{_like_escape(city)}%")
+        elif city_match == "prefix":
+            query += " AND lower(city) LIKE lower(%s)"
+            params.append(f"{_like_escape(city)}%")
+        else:
+            query += " AND lower(city) = lower(%s)"
+            params.append(city)
+    
+    if min_price:
+        query += " AND price >= %s"
+        params.append(min_price)
+    
+    if max_price:
+        query += " AND price <= %s"
+        params.append(max_price)
+    
+    if category_id:
+        query += " AND category_id = %s"
+        params.append(category_id)
+
+    return query, params
+
 def get_listings(con, limit: int = 100, offset: int = 0, 
                  city: Optional[str] = None, min_price: Optional[Decimal] = None,
-                 max_price: Optional[Decimal] = None, category_id: Optional[int] = None) -> List[Dict]:
+                 max_price: Optional[Decimal] = None, category_id: Optional[int] = None,
+                 after: Optional[str] = None, city_match: str = "substring", summary: bool = False,
+                 fields: Optional[List[str]] = None) -> List[Dict]:
+    """
+    With summary=True the rows come from listing_summary: fewer listing columns, but with
+    primary_image_url, bid_count, highest_bid and favorite_count (see db_setup.create_tables).
+    fields picks columns out of those (LISTING_COLUMNS or LISTING_SUMMARY_COLUMNS)
+    """
+    where, params = listing_filters(city, min_price, max_price, category_id, city_match)
+    if summary:
+        columns = select_list(fields, LISTING_SUMMARY_COLUMNS, ("created_at", "listing_id"),
+                              ", ".join(LISTING_SUMMARY_COLUMNS))
+        query = f"SELECT {columns} FROM listing_summary WHERE {where}"
+    else:
+        columns = select_list(fields, LISTING_COLUMNS, ("created_at", "listing_id"), LISTING_SELECT)
+        query = f"SELECT {columns} FROM house_listing WHERE {where}"
+
+    # listing_id breaks ties between listings created at the same time,
+    # idx_listing_created_id (idx_summary_created_id) covers this sort order
+    if after:
+        created_at, listing_id = decode_cursor(after, 2)
+        query += " AND (created_at, listing_id) < (%s::timestamp, %s)"
+        params.extend([created_at, listing_id])
+        query += " ORDER BY created_at DESC, listing_id DESC LIMIT %s"
+        params.append(limit)
+    else:
+        query += " ORDER BY created_at DESC, listing_id DESC LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
+
     with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            query = "SELECT * FROM house_listing WHERE 1=1"
-            params = []
-            
-            if city:
-                query += " AND city ILIKE %s"
-                params.append(f"%{city}%")
-            
-            if min_price:
-                query += " AND price >= %s"
-                params.append(min_price)
-            
-            if max_price:
-                query += " AND price <= %s"
-                params.append(max_price)
-            
-            if category_id:
-                query += " AND category_id = %s"
-                params.append(category_id)
-            
-            query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-            
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
             cursor.execute(query, tuple(params))
             return cursor.fetchall()
 
+def search_listings(con, q: str, limit: int = 100, offset: int = 0,
+                    city: Optional[str] = None, min_price: Optional[Decimal] = None,
+                    max_price: Optional[Decimal] = None, category_id: Optional[int] = None,
+                    city_match: str = "substring") -> List[Dict]:
+    """
+    Full text search over title and description, best matches first.
+    q uses web search syntax: words, "quoted phrases", OR and -excluded words
+    """
+    where, params = listing_filters(city, min_price, max_price, category_id, city_match)
+    query = f"""
+        SELECT {LISTING_SELECT}, ts_rank_cd(search_vector, query) AS rank
+        FROM house_listing, websearch_to_tsquery('swedish', %s) query
+        WHERE search_vector @@ query AND {where}
+        ORDER BY rank DESC, listing_id DESC
+        LIMIT %s OFFSET %s;
+    """
+    with con:
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
+            cursor.execute(query, (q, *params, limit, offset))
+            return cursor.fetchall()
+
+# Spatial search. latitude/longitude are DECIMAL columns, the expressions below cast them to float8
+# and have to stay identical to the ones in db_setup.create_tables, otherwise the indexes can't be used
+LISTING_EARTH_SQL = "ll_to_earth(latitude::float8, longitude::float8)"
+LISTING_POINT_SQL = "point(longitude::float8, latitude::float8)"
+
+def get_listings_in_radius(con, latitude: float, longitude: float, radius_km: float, limit: int = 100,
+                           min_price: Optional[Decimal] = None, max_price: Optional[Decimal] = None,
+                           category_id: Optional[int] = None) -> List[Dict]:
+    """Active listings within radius_km of a point, closest first (idx_listing_earth)"""
+    where, params = listing_filters(min_price=min_price, max_price=max_price, category_id=category_id)
+    radius_m = radius_km * 1000
+    # earth_box is a cheap, indexable bounding cube around the circle, earth_distance removes the corners
+    query = f"""
+        SELECT {LISTING_SELECT},
+               earth_distance(ll_to_earth(%s, %s), {LISTING_EARTH_SQL}) / 1000 AS distance_km
+        FROM house_listing
+        WHERE earth_box(ll_to_earth(%s, %s), %s) @> {LISTING_EARTH_SQL}
+          AND earth_distance(ll_to_earth(%s, %s), {LISTING_EARTH_SQL}) <= %s
+          AND status = 'active' AND {where}
+        ORDER BY distance_km, listing_id
+        LIMIT %s;
+    """
+    with con:
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
+            cursor.execute(query, (latitude, longitude,
+                                   latitude, longitude, radius_m,
+                                   latitude, longitude, radius_m,
+                                   *params, limit))
+            return cursor.fetchall()
+
+def get_listings_in_bbox(con, min_latitude: float, min_longitude: float,
+                         max_latitude: float, max_longitude: float, limit: int = 100,
+                         min_price: Optional[Decimal] = None, max_price: Optional[Decimal] = None,
+                         category_id: Optional[int] = None) -> List[Dict]:
+    """Active listings inside a map viewport, newest first (idx_listing_point)"""
+    where, params = listing_filters(min_price=min_price, max_price=max_price, category_id=category_id)
+    query = f"""
+        SELECT {LISTING_SELECT}
+        FROM house_listing
+        WHERE {LISTING_POINT_SQL} <@ box(point(%s, %s), point(%s, %s))
+          AND status = 'active' AND {where}
+        ORDER BY created_at DESC, listing_id DESC
+        LIMIT %s;
+    """
+    with con:
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
+            cursor.execute(query, (min_longitude, min_latitude, max_longitude, max_latitude, *params, limit))
+            return cursor.fetchall()
+
+prepared.register("get_listing", f"SELECT {LISTING_SELECT} FROM house_listing WHERE listing_id = %s;", ("integer",))
+
 def get_listing(con, listing_id: int) -> Optional[Dict]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM house_listing WHERE listing_id = %s;", (listing_id,))
+            prepared.execute(cursor, "get_listing", (listing_id,))
             return cursor.fetchone()
 
+LISTING_DETAIL_PARTS = ("images", "agent", "stats")
+
+def get_listing_detail(con, listing_id: int, include=LISTING_DETAIL_PARTS) -> Optional[Dict]:
+    """
+    A listing with everything the listing page needs, in a single query:
+    - images: the listing images in display order
+    - agent: agent and agency summary
+    - stats: bid_count, highest_bid and favorite_count
+    Parts left out of `include` aren't queried at all
+    """
+    unknown = set(include) - set(LISTING_DETAIL_PARTS)
+    if unknown:
+        raise ValueError(f"Unknown include: {', '.join(sorted(unknown))}")
+
+    columns = [f"h.{column}" for column in LISTING_COLUMNS]
+    joins = []
+
+    if "images" in include:
+        columns.append("coalesce(img.images, '[]'::json) AS images")
+        joins.append("""
+            LEFT JOIN LATERAL (
+                SELECT json_agg(i ORDER BY i.display_order NULLS LAST, i.image_id) AS images
+                FROM listing_images i
+                WHERE i.listing_id = h.listing_id
+            ) img ON true""")
+
+    if "agent" in include:
+        columns.extend(["ag.agent", "ag.agency"])
+        joins.append("""
+            LEFT JOIN LATERAL (
+                SELECT json_build_object(
+                           'agent_id', a.agent_id, 'first_name', u.first_name, 'last_name', u.last_name,
+                           'email', u.email, 'phone', u.phone, 'profile_image_url', a.profile_image_url,
+                           'years_experience', a.years_experience) AS agent,
+                       CASE WHEN r.agency_id IS NOT NULL THEN json_build_object(
+                           'agency_id', r.agency_id, 'name', r.name, 'phone', r.phone,
+                           'email', r.email, 'city', r.city, 'website', r.website) END AS agency
+                FROM realtor_agent a
+                LEFT JOIN users u ON u.user_id = a.user_id
+                LEFT JOIN realtor_agencies r ON r.agency_id = a.agency_id
+                WHERE a.agent_id = h.agent_id
+            ) ag ON true""")
+
+    if "stats" in include:
+        # highest_bid is one of the listing columns (cached by create_bid)
+        columns.extend(["bs.bid_count", "fs.favorite_count"])
+        joins.append("""
+            CROSS JOIN LATERAL (
+                SELECT count(*) AS bid_count
+                FROM bids b
+                WHERE b.listing_id = h.listing_id
+            ) bs
+            CROSS JOIN LATERAL (
+                SELECT count(*) AS favorite_count
+                FROM favorites f
+                WHERE f.listing_id = h.listing_id
+            ) fs""")
+
+    query = f"""
+        SELECT {", ".join(columns)}
+        FROM house_listing h
+        {"".join(joins)}
+        WHERE h.listing_id = %s;
+    """
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, (listing_id,))
+            return cursor.fetchone()
+
+# ---------- versions for conditional GETs ----------
+# Each returns when the data behind a response last changed (None if it doesn't exist), from primary key
+# lookups only, so app.py can answer If-None-Match / If-Modified-Since without running the full query.
+# listing_summary.changed_at moves with bids, favorites and images (see the triggers in db_setup.py)
+
+prepared.register("get_listing_version", """
+    SELECT greatest(h.updated_at, s.changed_at, a.updated_at, u.updated_at, r.created_at) AS version
+    FROM house_listing h
+    LEFT JOIN listing_summary s ON s.listing_id = h.listing_id
+    LEFT JOIN realtor_agent a ON a.agent_id = h.agent_id
+    LEFT JOIN users u ON u.user_id = a.user_id
+    LEFT JOIN realtor_agencies r ON r.agency_id = a.agency_id
+    WHERE h.listing_id = %s;
+""", ("integer",))
+
+def get_listing_version(con, listing_id: int) -> Optional[datetime]:
+    """Version of get_listing_detail, for every include"""
+    with con:
+        with con.cursor() as cursor:
+            prepared.execute(cursor, "get_listing_version", (listing_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
 def create_listing(con, agent_id: int, category_id: int, user_id: int,
                    title: str, description: str, price: Decimal,
                    address: str, city: str, postal_code: str, **kwargs) -> Optional[int]:
@@ -203,7 +530,14 @@ def create_listing(con, agent_id: int, category_id: int, user_id: int,
                     columns.append(field)
                     values.append(kwargs[field])
             
-            placeholders = ", ".join(["%s"] * len(columns))
+            placeholders = ["%s"] * len(columns)
+
+            # Full text search document, see search_listings
+            columns.append("search_vector")
+            placeholders.append(SEARCH_VECTOR_SQL.format(title="%s", description="%s"))
+            values.extend([title, description])
+            
+            placeholders = ", ".join(placeholders)
             columns_str = ", ".join(columns)
             
             cursor.execute(f"""
@@ -220,13 +554,20 @@ def update_listing(con, listing_id: int, **kwargs) -> bool:
     
     set_clause = ", ".join([f"{key} = %s" for key in kwargs.keys()])
     values = list(kwargs.values())
+
+    # Keep the search document in sync, the columns that aren't updated keep their current value
+    if "title" in kwargs or "description" in kwargs:
+        set_clause += ", search_vector = " + SEARCH_VECTOR_SQL.format(
+            title="coalesce(%s, title)", description="coalesce(%s, description)")
+        values.extend([kwargs.get("title"), kwargs.get("description")])
+
     values.append(listing_id)
     
     with con:
         with con.cursor() as cursor:
             cursor.execute(f"""
                 UPDATE house_listing 
-                SET {set_clause}, updated_at = CURRENT_TIMESTAMP
+                SET {set_clause}, updated_at = clock_timestamp()
                 WHERE listing_id = %s;
             """, tuple(values))
             return cursor.rowcount > 0
@@ -238,45 +579,128 @@ def delete_listing(con, listing_id: int) -> bool:
             return cursor.rowcount > 0
 
 # ========== BID OPERATIONS ==========
-def get_bids(con, listing_id: Optional[int] = None) -> List[Dict]:
+prepared.register("get_listing_bids", """
+    SELECT * FROM bids 
+    WHERE listing_id = %s 
+    ORDER BY amount DESC;
+""", ("integer",))
+
+BID_COLUMNS = ("bid_id", "listing_id", "user_id", "amount", "bid_date", "status", "comment",
+               "created_at", "updated_at")
+
+def get_bids(con, listing_id: Optional[int] = None, fields: Optional[List[str]] = None,
+             since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[Dict]:
+    """
+    Bids of a listing (highest first) or all bids (newest first), placed from `since` up to (not including) `until`.
+    When bids is partitioned by month (db_setup.create_tables(partitioned=True)) only those months are read
+    """
+    if listing_id and not (fields or since or until):
+        with con:
+            with con.cursor(cursor_factory=RecordCursor) as cursor:
+                prepared.execute(cursor, "get_listing_bids", (listing_id,))
+                return cursor.fetchall()
+
+    query = f"SELECT {select_list(fields, BID_COLUMNS)} FROM bids WHERE 1=1"
+    params = []
+    if listing_id:
+        query += " AND listing_id = %s"
+        params.append(listing_id)
+    if since:
+        query += " AND bid_date >= %s"
+        params.append(since)
+    if until:
+        query += " AND bid_date < %s"
+        params.append(until)
+    query += " ORDER BY amount DESC;" if listing_id else " ORDER BY bid_date DESC;"
     with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            if listing_id:
-                cursor.execute("""
-                    SELECT * FROM bids 
-                    WHERE listing_id = %s 
-                    ORDER BY amount DESC;
-                """, (listing_id,))
-            else:
-                cursor.execute("SELECT * FROM bids ORDER BY bid_date DESC;")
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
+            cursor.execute(query, tuple(params))
             return cursor.fetchall()
 
+class BidRejected(Exception):
+    """The bid wasn't placed: the listing doesn't exist or isn't active, or the amount doesn't beat the highest bid"""
+
+# Placing a bid is one conditional UPDATE of the listing row, which locks it. Concurrent bids on the same
+# listing queue up on that lock, and after waiting Postgres checks the condition again against the highest
+# bid the previous bidder committed, so two bids can't both beat the same highest bid.
+# house_listing.highest_bid is the cached highest bid that makes this check cheap, a trigger on bids
+# recomputes it when a bid is rejected or deleted (db_setup.create_tables).
+PLACE_BID_SQL = """
+    UPDATE house_listing SET highest_bid = %s
+    WHERE listing_id = %s AND status = 'active' AND (highest_bid IS NULL OR highest_bid < %s)
+    RETURNING listing_id;
+"""
+# Bid events for subscribers of the listing (events.py), Postgres delivers them when the transaction commits
+BID_NOTIFY_SQL = """
+    pg_notify('bids', json_build_object(
+        'event', '{event}', 'bid_id', bid_id, 'listing_id', listing_id, 'user_id', user_id,
+        'amount', amount, 'status', status, 'bid_date', bid_date)::text)
+"""
+INSERT_BID_SQL = f"""
+    WITH bid AS (
+        INSERT INTO bids (listing_id, user_id, amount, status, comment)
+        VALUES (%s, %s, %s, 'pending', %s)
+        RETURNING *
+    )
+    SELECT bid_id, {BID_NOTIFY_SQL.format(event="bid_placed")} FROM bid;
+"""
+UPDATE_BID_STATUS_SQL = f"""
+    WITH bid AS (
+        UPDATE bids 
+        SET status = %s, updated_at = CURRENT_TIMESTAMP
+        WHERE bid_id = %s
+        RETURNING *
+    )
+    SELECT bid_id, {BID_NOTIFY_SQL.format(event="bid_status")} FROM bid;
+"""
+BID_LISTING_SQL = "SELECT status, highest_bid FROM house_listing WHERE listing_id = %s;"
+
+def bid_rejection(listing) -> BidRejected:
+    """Why PLACE_BID_SQL didn't match, listing is the (status, highest_bid) row of BID_LISTING_SQL or None"""
+    if listing is None:
+        return BidRejected("Listing not found")
+    if listing[0] != "active":
+        return BidRejected(f"Listing is {listing[0]} and doesn't accept bids")
+    return BidRejected(f"Bid must be higher than the current highest bid ({listing[1]})")
+
+def bid_amount(amount) -> Decimal:
+    """amount as a Decimal, ValueError (a bad request, not a rejected bid) if it isn't a positive number"""
+    try:
+        amount = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError("Bid amount must be a number")
+    if not amount.is_finite():
+        raise ValueError("Bid amount must be a number")
+    if amount <= 0:
+        raise ValueError("Bid amount must be positive")
+    return amount
+
 def create_bid(con, listing_id: int, user_id: int, amount: Decimal, 
                comment: Optional[str] = None) -> Optional[int]:
+    """
+    Places a bid if the listing is active and amount beats its highest bid, otherwise raises BidRejected.
+    The check and the insert are one transaction, see PLACE_BID_SQL
+    """
+    amount = bid_amount(amount)
     with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                INSERT INTO bids (listing_id, user_id, amount, comment)
-                VALUES (%s, %s, %s, %s)
-                RETURNING bid_id;
-            """, (listing_id, user_id, amount, comment))
-            result = cursor.fetchone()
-            return result["bid_id"] if result else None
+        with con.cursor() as cursor:
+            cursor.execute(PLACE_BID_SQL, (amount, listing_id, amount))
+            if cursor.fetchone() is None:
+                cursor.execute(BID_LISTING_SQL, (listing_id,))
+                raise bid_rejection(cursor.fetchone())
+            cursor.execute(INSERT_BID_SQL, (listing_id, user_id, amount, comment))
+            return cursor.fetchone()[0]
 
 def update_bid_status(con, bid_id: int, status: str) -> bool:
     with con:
         with con.cursor() as cursor:
-            cursor.execute("""
-                UPDATE bids 
-                SET status = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE bid_id = %s;
-            """, (status, bid_id))
+            cursor.execute(UPDATE_BID_STATUS_SQL, (status, bid_id))
             return cursor.rowcount > 0
 
 # ========== FAVORITE OPERATIONS ==========
 def get_favorites(con, user_id: int) -> List[Dict]:
     with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
             cursor.execute("""
                 SELECT f.*, h.title, h.price, h.city 
                 FROM favorites f
@@ -307,17 +731,141 @@ def remove_favorite(con, user_id: int, listing_id: int) -> bool:
             """, (user_id, listing_id))
             return cursor.rowcount > 0
 
-# ========== IMAGE OPERATIONS ==========
-def get_listing_images(con, listing_id: int) -> List[Dict]:
+# ========== SAVED SEARCH OPERATIONS ==========
+# Buyers save filters and get an alert when a listing starts to match them. Instead of running every saved
+# search now and then, triggers on house_listing look up the searches each new or changed listing matches
+# (db_setup.SAVED_SEARCH_MATCH_SQL) and write them to the saved_search_matches outbox in the same transaction.
+
+SAVED_SEARCH_SELECT = "search_id, user_id, name, city, category_id, min_price, max_price, is_active, created_at"
+
+def get_saved_searches(con, user_id: int) -> List[Dict]:
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(f"""
+                SELECT {SAVED_SEARCH_SELECT} FROM saved_searches
+                WHERE user_id = %s
+                ORDER BY search_id;
+            """, (user_id,))
+            return cursor.fetchall()
+
+def create_saved_search(con, user_id: int, name: Optional[str] = None, city: Optional[str] = None,
+                        category_id: Optional[int] = None, min_price: Optional[Decimal] = None,
+                        max_price: Optional[Decimal] = None) -> Optional[int]:
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                INSERT INTO saved_searches (user_id, name, city, category_id, min_price, max_price)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING search_id;
+            """, (user_id, name, city, category_id, min_price, max_price))
+            result = cursor.fetchone()
+            return result["search_id"] if result else None
+
+def delete_saved_search(con, search_id: int) -> bool:
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("DELETE FROM saved_searches WHERE search_id = %s;", (search_id,))
+            return cursor.rowcount > 0
+
+def get_saved_search_matches(con, user_id: int, limit: int = 100) -> List[Dict]:
+    """The user's latest matches with the listing's title, price and city"""
+    with con:
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
+            cursor.execute("""
+                SELECT m.match_id, m.search_id, m.listing_id, m.reason, m.created_at, m.delivered_at,
+                       h.title, h.price, h.city
+                FROM saved_search_matches m
+                JOIN house_listing h ON h.listing_id = m.listing_id
+                WHERE m.user_id = %s
+                ORDER BY m.match_id DESC
+                LIMIT %s;
+            """, (user_id, limit))
+            return cursor.fetchall()
+
+def claim_saved_search_matches(con, limit: int = 100) -> List[Dict]:
+    """
+    Marks up to `limit` undelivered matches as delivered and returns them, for the process that sends the alerts.
+    SKIP LOCKED lets several senders claim batches at the same time without getting the same matches
+    """
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                UPDATE saved_search_matches SET delivered_at = now()
+                WHERE match_id IN (
+                    SELECT match_id FROM saved_search_matches
+                    WHERE delivered_at IS NULL
+                    ORDER BY match_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING match_id, search_id, user_id, listing_id, reason, created_at;
+            """, (limit,))
+            return cursor.fetchall()
+
+# ========== PRICE HISTORY AND ANALYTICS ==========
+# listing_price_history gets a row from triggers on house_listing for every new listing and every price or
+# status change, price_rollup_monthly has the monthly medians of the active stock, refreshed by
+# python db_setup.py --refresh-rollups (see db_setup.create_tables)
+
+def get_price_history(con, listing_id: int) -> List[Dict]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute("""
-                SELECT * FROM listing_images 
-                WHERE listing_id = %s 
-                ORDER BY display_order NULLS LAST;
+                SELECT change, price, status, changed_at FROM listing_price_history
+                WHERE listing_id = %s
+                ORDER BY changed_at;
             """, (listing_id,))
             return cursor.fetchall()
 
+def get_price_per_sqm_series(con, city: Optional[str] = None, category_id: Optional[int] = None,
+                             since: Optional[date] = None, until: Optional[date] = None) -> List[Dict]:
+    """
+    Median asking price per sqm of the active listings at the end of each month from price_rollup_monthly,
+    over all cities/categories when not given
+    """
+    query = """
+        SELECT month, listings, median_price_per_sqm FROM price_rollup_monthly
+        WHERE category_id = %s
+    """
+    params = [category_id or 0]
+    if city:
+        query += " AND city = lower(%s)"
+        params.append(city)
+    else:
+        query += " AND city = ''"
+    if since:
+        query += " AND month >= date_trunc('month', %s::date)"
+        params.append(since)
+    if until:
+        query += " AND month <= %s"
+        params.append(until)
+    query += " ORDER BY month;"
+    with con:
+        with con.cursor(cursor_factory=RecordCursor) as cursor:
+            cursor.execute(query, tuple(params))
+            return cursor.fetchall()
+
+# ========== IMAGE OPERATIONS ==========
+prepared.register("get_listing_images", """
+    SELECT * FROM listing_images 
+    WHERE listing_id = %s 
+    ORDER BY display_order NULLS LAST;
+""", ("integer",))
+
+def get_listing_images(con, listing_id: int) -> List[Dict]:
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            prepared.execute(cursor, "get_listing_images", (listing_id,))
+            return cursor.fetchall()
+
+def get_listing_images_version(con, listing_id: int) -> Optional[datetime]:
+    """Version of get_listing_images, None for listings that don't exist"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT images_changed_at FROM listing_summary WHERE listing_id = %s;", (listing_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
 def add_image(con, listing_id: int, image_url: str, 
               display_order: Optional[int] = None,
               is_primary: bool = False,
@@ -333,22 +881,253 @@ def add_image(con, listing_id: int, image_url: str,
             result = cursor.fetchone()
             return result["image_id"] if result else None
 
+# ========== BULK IMPORT ==========
+# Feed partners import thousands of rows at a time. Rows are identified by their external_ref, so
+# sending the same batch twice doesn't create duplicates. A batch runs in one transaction with
+# multi-row inserts; a row that fails doesn't abort the batch, it's reported in the result instead.
+
+BULK_CHUNK_SIZE = 1000
+
+LISTING_REQUIRED_FIELDS = ("agent_id", "category_id", "user_id", "title", "description",
+                           "price", "address", "city", "postal_code")
+LISTING_OPTIONAL_FIELDS = ("rooms", "size_sqm", "plot_size_sqm", "year_built", "floor", "balcony",
+                           "monthly_fee", "operating_cost", "latitude", "longitude", "status")
+IMAGE_FIELDS = ("image_url", "display_order", "is_primary", "caption")
+
+def _bulk_error(message: str) -> Dict:
+    return {"status": "error", "error": message}
+
+def _bulk_insert(cursor, query: str, template: str, batch, results: list):
+    """
+    Runs the multi-row insert for (index, values) pairs chunk by chunk. When a chunk fails it's
+    retried one row at a time (each behind a savepoint) so only the bad rows are reported.
+    Returns the rows from RETURNING
+    """
+    returned = []
+    for start in range(0, len(batch), BULK_CHUNK_SIZE):
+        chunk = batch[start:start + BULK_CHUNK_SIZE]
+        cursor.execute("SAVEPOINT bulk_chunk;")
+        try:
+            returned += execute_values(cursor, query, [values for _, values in chunk],
+                                       template=template, page_size=len(chunk), fetch=True)
+            cursor.execute("RELEASE SAVEPOINT bulk_chunk;")
+            continue
+        except psycopg2.Error:
+            cursor.execute("ROLLBACK TO SAVEPOINT bulk_chunk;")
+
+        for index, values in chunk:
+            cursor.execute("SAVEPOINT bulk_row;")
+            try:
+                returned += execute_values(cursor, query, [values], template=template, fetch=True)
+                cursor.execute("RELEASE SAVEPOINT bulk_row;")
+            except psycopg2.Error as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT bulk_row;")
+                message = e.diag.message_primary if e.diag and e.diag.message_primary else str(e)
+                results[index] = _bulk_error(message)
+    return returned
+
+def _bulk_upsert(con, table: str, id_column: str, columns, template: str, batch,
+                 upsert: bool, results: list, touch: str = ""):
+    """
+    Inserts (index, external_ref, values) rows into table, rows whose external_ref already exists are
+    skipped, or updated when upsert is set (only if something changed). Fills in results per index
+    """
+    if upsert:
+        changed = [column for column in columns if column not in ("external_ref", "published_at")]
+        set_clause = ", ".join(f"{column} = EXCLUDED.{column}" for column in changed)
+        current = ", ".join(f"{table}.{column}" for column in changed)
+        incoming = ", ".join(f"EXCLUDED.{column}" for column in changed)
+        conflict = f"DO UPDATE SET {set_clause}{touch} WHERE ({current}) IS DISTINCT FROM ({incoming})"
+    else:
+        conflict = "DO NOTHING"
+
+    query = f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        VALUES %s
+        ON CONFLICT (external_ref) {conflict}
+        RETURNING external_ref, {id_column}, (xmax = 0) AS inserted;
+    """
+    with con:
+        with con.cursor() as cursor:
+            returned = _bulk_insert(cursor, query, template,
+                                    [(index, values) for index, _, values in batch], results)
+            written = {ref: (row_id, inserted) for ref, row_id, inserted in returned}
+
+            # Rows that were skipped (already there, or unchanged) still get their id in the result
+            skipped = [ref for index, ref, _ in batch if results[index] is None and ref not in written]
+            existing = {}
+            if skipped:
+                cursor.execute(f"SELECT external_ref, {id_column} FROM {table} WHERE external_ref = ANY(%s);",
+                               (skipped,))
+                existing = dict(cursor.fetchall())
+
+    for index, ref, _ in batch:
+        if results[index] is not None:
+            continue
+        if ref in written:
+            row_id, inserted = written[ref]
+            results[index] = {"status": "created" if inserted else "updated", id_column: row_id}
+        else:
+            results[index] = {"status": "unchanged" if upsert else "exists", id_column: existing.get(ref)}
+
+def _bulk_validate(rows: List[Dict], required, allowed, results: list):
+    """Checks fields and duplicate external_refs, returns the indexes of the valid rows"""
+    valid = []
+    seen = set()
+    for index, row in enumerate(rows):
+        missing = [field for field in ("external_ref", *required) if row.get(field) is None]
+        unknown = set(row) - {"external_ref", *required, *allowed}
+        if missing:
+            results[index] = _bulk_error(f"Missing required field(s): {', '.join(missing)}")
+        elif unknown:
+            results[index] = _bulk_error(f"Unknown field(s): {', '.join(sorted(unknown))}")
+        elif row["external_ref"] in seen:
+            results[index] = _bulk_error("Duplicate external_ref in this batch")
+        else:
+            seen.add(row["external_ref"])
+            valid.append(index)
+    return valid
+
+def bulk_import_listings(con, rows: List[Dict], upsert: bool = False) -> List[Dict]:
+    """
+    Creates (or with upsert, creates and updates) listings keyed by external_ref.
+    Returns one result per row, in order: {"external_ref", "status", "listing_id"} where status is
+    created, updated, exists, unchanged or error (with an "error" message)
+    """
+    results = [None] * len(rows)
+    valid = _bulk_validate(rows, LISTING_REQUIRED_FIELDS, LISTING_OPTIONAL_FIELDS, results)
+
+    fields = ("external_ref", *LISTING_REQUIRED_FIELDS, *LISTING_OPTIONAL_FIELDS)
+    columns = (*fields, "search_vector", "published_at")
+    placeholders = ["coalesce(%s, 'active')" if field == "status" else "%s" for field in fields]
+    placeholders.append(SEARCH_VECTOR_SQL.format(title="%s", description="%s"))
+    placeholders.append("now()")
+    template = "(" + ", ".join(placeholders) + ")"
+
+    batch = []
+    for index in valid:
+        row = rows[index]
+        values = tuple(row.get(field) for field in fields) + (row["title"], row["description"])
+        batch.append((index, row["external_ref"], values))
+
+    if batch:
+        _bulk_upsert(con, "house_listing", "listing_id", columns, template, batch, upsert, results,
+                     touch=", updated_at = clock_timestamp()")
+
+    return [{"external_ref": row.get("external_ref"), **result} for row, result in zip(rows, results)]
+
+def bulk_import_images(con, rows: List[Dict], upsert: bool = False) -> List[Dict]:
+    """
+    Same as bulk_import_listings for listing images. A row points to its listing with either
+    listing_id or listing_external_ref, so images can be sent along with a listing import
+    """
+    results = [None] * len(rows)
+    valid = []
+    for index in _bulk_validate(rows, ("image_url",), ("listing_id", "listing_external_ref", *IMAGE_FIELDS), results):
+        if rows[index].get("listing_id") is None and rows[index].get("listing_external_ref") is None:
+            results[index] = _bulk_error("Missing required field(s): listing_id or listing_external_ref")
+        else:
+            valid.append(index)
+
+    refs = list({rows[index]["listing_external_ref"] for index in valid if rows[index].get("listing_id") is None})
+    listing_ids = {}
+    if refs:
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute("SELECT external_ref, listing_id FROM house_listing WHERE external_ref = ANY(%s);", (refs,))
+                listing_ids = dict(cursor.fetchall())
+
+    columns = ("external_ref", "listing_id", *IMAGE_FIELDS)
+    template = "(%s, %s, %s, %s, coalesce(%s, false), %s)"
+    batch = []
+    for index in valid:
+        row = rows[index]
+        listing_id = row.get("listing_id") or listing_ids.get(row.get("listing_external_ref"))
+        if listing_id is None:
+            results[index] = _bulk_error("Unknown listing_external_ref")
+            continue
+        values = (row["external_ref"], listing_id, *(row.get(field) for field in IMAGE_FIELDS))
+        batch.append((index, row["external_ref"], values))
+
+    if batch:
+        _bulk_upsert(con, "listing_images", "image_id", columns, template, batch, upsert, results)
+
+    return [{"external_ref": row.get("external_ref"), **result} for row, result in zip(rows, results)]
+
+# ========== EXPORT ==========
+# Exports read through a server side (named) cursor, so only `batch_size` rows are held in memory
+# at a time no matter how big the table is. The generators keep a transaction open until they are
+# exhausted or closed, so the connection has to stay checked out while they are consumed.
+
+EXPORT_BATCH_SIZE = 2000
+
+def iter_listings(con, city: Optional[str] = None, min_price: Optional[Decimal] = None,
+                  max_price: Optional[Decimal] = None, category_id: Optional[int] = None,
+                  city_match: str = "substring", batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Dict]:
+    where, params = listing_filters(city, min_price, max_price, category_id, city_match)
+    with con:
+        with con.cursor(name="export_listings", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = batch_size
+            # ordered by the primary key, so postgres can walk the index instead of sorting everything first
+            cursor.execute(f"SELECT {LISTING_SELECT} FROM house_listing WHERE {where} ORDER BY listing_id;",
+                           tuple(params))
+            for row in cursor:
+                yield row
+
+def iter_bids(con, listing_id: Optional[int] = None,
+              batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Dict]:
+    query = f"SELECT {', '.join(BID_COLUMNS)} FROM bids"
+    params = ()
+    if listing_id:
+        query += " WHERE listing_id = %s"
+        params = (listing_id,)
+    with con:
+        with con.cursor(name="export_bids", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query + " ORDER BY bid_id;", params)
+            for row in cursor:
+                yield row
+
 # ========== CATEGORY OPERATIONS ==========
-def get_categories(con) -> List[Dict]:
+@cached("categories")
+def get_categories(con, version: Optional[datetime] = None) -> List[Dict]:
+    """version (get_categories_version) is only part of the cache key, like in get_agency"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute("SELECT * FROM listing_categories ORDER BY name;")
             return cursor.fetchall()
 
+def get_categories_version(con) -> Optional[datetime]:
+    """Version of get_categories, categories are only added through the api so it's the newest created_at"""
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT max(created_at) FROM listing_categories;")
+            return cursor.fetchone()[0]
+
+@cached("categories")
 def get_category(con, category_id: int) -> Optional[Dict]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute("SELECT * FROM listing_categories WHERE category_id = %s;", (category_id,))
             return cursor.fetchone()
 
+def create_category(con, name: str, description: Optional[str] = None) -> Optional[int]:
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                INSERT INTO listing_categories (name, description)
+                VALUES (%s, %s)
+                RETURNING category_id;
+            """, (name, description))
+            result = cursor.fetchone()
+    invalidate("categories")
+    return result["category_id"] if result else None
+
 # ========== VIEWING BOOKING OPERATIONS ==========
 def get_viewings(con, user_id: Optional[int] = None, 
-                 listing_id: Optional[int] = None) -> List[Dict]:
+                 listing_id: Optional[int] = None,
+                 since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[Dict]:
+    """Viewings from `since` up to (not including) `until`, partitions outside that range aren't read"""
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             query = "SELECT * FROM viewing_booking WHERE 1=1"
@@ -361,6 +1140,14 @@ def get_viewings(con, user_id: Optional[int] = None,
             if listing_id:
                 query += " AND listing_id = %s"
                 params.append(listing_id)
+
+            if since:
+                query += " AND viewing_time >= %s"
+                params.append(since)
+
+            if until:
+                query += " AND viewing_time < %s"
+                params.append(until)
             
             query += " ORDER BY viewing_time ASC;"
             cursor.execute(query, tuple(params))
@@ -381,6 +1168,7 @@ def create_viewing(con, listing_id: int, user_id: int,
             return result["viewing_id"] if result else None
 
 # ========== AGENT OPERATIONS ==========
+@cached("agents")
 def get_agents(con, agency_id: Optional[int] = None) -> List[Dict]:
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
@@ -394,6 +1182,21 @@ def get_agents(con, agency_id: Optional[int] = None) -> List[Dict]:
                 cursor.execute("SELECT * FROM realtor_agent ORDER BY agent_id;")
             return cursor.fetchall()
 
+def create_agent(con, agency_id: int, user_id: int, bio: Optional[str] = None,
+                 profile_image_url: Optional[str] = None,
+                 years_experience: Optional[int] = None) -> Optional[int]:
+    with con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                INSERT INTO realtor_agent 
+                (agency_id, user_id, bio, profile_image_url, years_experience)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING agent_id;
+            """, (agency_id, user_id, bio, profile_image_url, years_experience))
+            result = cursor.fetchone()
+    invalidate("agents")
+    return result["agent_id"] if result else None
+
 # ========== REVIEW OPERATIONS ==========
 def get_agent_reviews(con, agent_id: Optional[int] = None) -> List[Dict]:
     with con:
@@ -0,0 +1,398 @@
+import asyncio
+from datetime import datetime
+from psycopg.rows import dict_row
+from typing import List, Optional, Dict
+from decimal import Decimal
+
+from cache import invalidate
+from db import (LISTING_SELECT, SEARCH_VECTOR_SQL, BidRejected, PLACE_BID_SQL, INSERT_BID_SQL,
+                BID_LISTING_SQL, UPDATE_BID_STATUS_SQL, bid_amount, bid_rejection)
+
+
+"""
+Async versions of the functions in db.py, used by app_async.py.
+
+They use psycopg 3 instead of psycopg2, since psycopg2 can't talk to the database without blocking
+the event loop. The queries are the same as in db.py and every function still starts with a connection
+parameter, here an AsyncConnection borrowed from db_setup.get_async_pool().
+db.py stays the synchronous api, which scripts (and app.py) keep using.
+"""
+
+# ========== USER OPERATIONS ==========
+async def get_users(con, limit: int = 100, offset: int = 0) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT * FROM users
+                ORDER BY user_id
+                LIMIT %s OFFSET %s;
+            """, (limit, offset))
+            return await cursor.fetchall()
+
+async def get_user(con, user_id: int) -> Optional[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("SELECT * FROM users WHERE user_id = %s;", (user_id,))
+            return await cursor.fetchone()
+
+async def create_user(con, email: str, password_hash: str, first_name: str, last_name: str,
+                      phone: Optional[str], user_type: str, role: str) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                INSERT INTO users
+                (email, password_hash, first_name, last_name, phone, user_type, role)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING user_id;
+            """, (email, password_hash, first_name, last_name, phone, user_type, role))
+            result = await cursor.fetchone()
+            return result["user_id"] if result else None
+
+async def update_user(con, user_id: int, **kwargs) -> bool:
+    if not kwargs:
+        return False
+
+    set_clause = ", ".join([f"{key} = %s" for key in kwargs.keys()])
+    values = list(kwargs.values())
+    values.append(user_id)
+
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute(f"""
+                UPDATE users
+                SET {set_clause}, updated_at = clock_timestamp()
+                WHERE user_id = %s;
+            """, tuple(values))
+            return cursor.rowcount > 0
+
+async def delete_user(con, user_id: int) -> bool:
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute("DELETE FROM users WHERE user_id = %s;", (user_id,))
+            return cursor.rowcount > 0
+
+# ========== AGENCY OPERATIONS ==========
+async def get_agencies(con, limit: int = 100, offset: int = 0) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT * FROM realtor_agencies
+                ORDER BY agency_id
+                LIMIT %s OFFSET %s;
+            """, (limit, offset))
+            return await cursor.fetchall()
+
+async def get_agency(con, agency_id: int) -> Optional[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("SELECT * FROM realtor_agencies WHERE agency_id = %s;", (agency_id,))
+            return await cursor.fetchone()
+
+async def create_agency(con, name: str, license_number: str, **kwargs) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            columns = ["name", "license_number"]
+            values = [name, license_number]
+
+            for key, value in kwargs.items():
+                if value is not None:
+                    columns.append(key)
+                    values.append(value)
+
+            placeholders = ", ".join(["%s"] * len(columns))
+            columns_str = ", ".join(columns)
+
+            await cursor.execute(f"""
+                INSERT INTO realtor_agencies ({columns_str})
+                VALUES ({placeholders})
+                RETURNING agency_id;
+            """, tuple(values))
+            result = await cursor.fetchone()
+    # app.py workers read agencies through the cache (in redis it's shared), drop it like db.create_agency does.
+    # In a thread, with CACHE_REDIS_URL invalidate is a blocking round trip
+    await asyncio.to_thread(invalidate, "agencies")
+    return result["agency_id"] if result else None
+
+# ========== HOUSE LISTING OPERATIONS ==========
+async def get_listings(con, limit: int = 100, offset: int = 0,
+                       city: Optional[str] = None, min_price: Optional[Decimal] = None,
+                       max_price: Optional[Decimal] = None, category_id: Optional[int] = None) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            query = f"SELECT {LISTING_SELECT} FROM house_listing WHERE 1=1"
+            params = []
+
+            if city:
+                query += " AND city ILIKE %s"
+                params.append(f"%{city}%")
+
+            if min_price:
+                query += " AND price >= %s"
+                params.append(min_price)
+
+            if max_price:
+                query += " AND price <= %s"
+                params.append(max_price)
+
+            if category_id:
+                query += " AND category_id = %s"
+                params.append(category_id)
+
+            query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+
+            await cursor.execute(query, tuple(params))
+            return await cursor.fetchall()
+
+async def get_listing(con, listing_id: int) -> Optional[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(f"SELECT {LISTING_SELECT} FROM house_listing WHERE listing_id = %s;", (listing_id,))
+            return await cursor.fetchone()
+
+async def create_listing(con, agent_id: int, category_id: int, user_id: int,
+                         title: str, description: str, price: Decimal,
+                         address: str, city: str, postal_code: str, **kwargs) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            # Required columns
+            columns = ["agent_id", "category_id", "user_id", "title", "description",
+                      "price", "address", "city", "postal_code"]
+            values = [agent_id, category_id, user_id, title, description, price,
+                     address, city, postal_code]
+
+            # Optional columns
+            optional_fields = ['rooms', 'size_sqm', 'plot_size_sqm', 'year_built',
+                             'floor', 'balcony', 'monthly_fee', 'operating_cost',
+                             'latitude', 'longitude', 'status']
+
+            for field in optional_fields:
+                if field in kwargs and kwargs[field] is not None:
+                    columns.append(field)
+                    values.append(kwargs[field])
+
+            placeholders = ", ".join(["%s"] * len(columns))
+            columns_str = ", ".join(columns)
+            search_vector = SEARCH_VECTOR_SQL.format(title="%s", description="%s")
+            values.extend([title, description])
+
+            # published_at is set by the database, psycopg 3 binds parameters server side
+            # so a "NOW()" string can't be passed as a value
+            await cursor.execute(f"""
+                INSERT INTO house_listing ({columns_str}, published_at, search_vector)
+                VALUES ({placeholders}, now(), {search_vector})
+                RETURNING listing_id;
+            """, tuple(values))
+            result = await cursor.fetchone()
+            return result["listing_id"] if result else None
+
+async def update_listing(con, listing_id: int, **kwargs) -> bool:
+    if not kwargs:
+        return False
+
+    set_clause = ", ".join([f"{key} = %s" for key in kwargs.keys()])
+    values = list(kwargs.values())
+
+    if "title" in kwargs or "description" in kwargs:
+        set_clause += ", search_vector = " + SEARCH_VECTOR_SQL.format(
+            title="coalesce(%s, title)", description="coalesce(%s, description)")
+        values.extend([kwargs.get("title"), kwargs.get("description")])
+
+    values.append(listing_id)
+
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute(f"""
+                UPDATE house_listing
+                SET {set_clause}, updated_at = clock_timestamp()
+                WHERE listing_id = %s;
+            """, tuple(values))
+            return cursor.rowcount > 0
+
+async def delete_listing(con, listing_id: int) -> bool:
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute("DELETE FROM house_listing WHERE listing_id = %s;", (listing_id,))
+            return cursor.rowcount > 0
+
+# ========== BID OPERATIONS ==========
+async def get_bids(con, listing_id: Optional[int] = None) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            if listing_id:
+                await cursor.execute("""
+                    SELECT * FROM bids
+                    WHERE listing_id = %s
+                    ORDER BY amount DESC;
+                """, (listing_id,))
+            else:
+                await cursor.execute("SELECT * FROM bids ORDER BY bid_date DESC;")
+            return await cursor.fetchall()
+
+async def create_bid(con, listing_id: int, user_id: int, amount: Decimal,
+                     comment: Optional[str] = None) -> Optional[int]:
+    """Same as db.create_bid, raises BidRejected"""
+    amount = bid_amount(amount)
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute(PLACE_BID_SQL, (amount, listing_id, amount))
+            if await cursor.fetchone() is None:
+                await cursor.execute(BID_LISTING_SQL, (listing_id,))
+                raise bid_rejection(await cursor.fetchone())
+            await cursor.execute(INSERT_BID_SQL, (listing_id, user_id, amount, comment))
+            return (await cursor.fetchone())[0]
+
+async def update_bid_status(con, bid_id: int, status: str) -> bool:
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute(UPDATE_BID_STATUS_SQL, (status, bid_id))
+            return cursor.rowcount > 0
+
+# ========== FAVORITE OPERATIONS ==========
+async def get_favorites(con, user_id: int) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT f.*, h.title, h.price, h.city
+                FROM favorites f
+                JOIN house_listing h ON f.listing_id = h.listing_id
+                WHERE f.user_id = %s
+                ORDER BY f.created_at DESC;
+            """, (user_id,))
+            return await cursor.fetchall()
+
+async def add_favorite(con, user_id: int, listing_id: int) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                INSERT INTO favorites (user_id, listing_id)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id, listing_id) DO NOTHING
+                RETURNING favorite_id;
+            """, (user_id, listing_id))
+            result = await cursor.fetchone()
+            return result["favorite_id"] if result else None
+
+async def remove_favorite(con, user_id: int, listing_id: int) -> bool:
+    async with con.transaction():
+        async with con.cursor() as cursor:
+            await cursor.execute("""
+                DELETE FROM favorites
+                WHERE user_id = %s AND listing_id = %s;
+            """, (user_id, listing_id))
+            return cursor.rowcount > 0
+
+# ========== IMAGE OPERATIONS ==========
+async def get_listing_images(con, listing_id: int) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                SELECT * FROM listing_images
+                WHERE listing_id = %s
+                ORDER BY display_order NULLS LAST;
+            """, (listing_id,))
+            return await cursor.fetchall()
+
+async def add_image(con, listing_id: int, image_url: str,
+                    display_order: Optional[int] = None,
+                    is_primary: bool = False,
+                    caption: Optional[str] = None) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                INSERT INTO listing_images
+                (listing_id, image_url, display_order, is_primary, caption)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING image_id;
+            """, (listing_id, image_url, display_order, is_primary, caption))
+            result = await cursor.fetchone()
+            return result["image_id"] if result else None
+
+# ========== CATEGORY OPERATIONS ==========
+async def get_categories(con) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("SELECT * FROM listing_categories ORDER BY name;")
+            return await cursor.fetchall()
+
+async def get_category(con, category_id: int) -> Optional[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("SELECT * FROM listing_categories WHERE category_id = %s;", (category_id,))
+            return await cursor.fetchone()
+
+# ========== VIEWING BOOKING OPERATIONS ==========
+async def get_viewings(con, user_id: Optional[int] = None,
+                       listing_id: Optional[int] = None) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            query = "SELECT * FROM viewing_booking WHERE 1=1"
+            params = []
+
+            if user_id:
+                query += " AND user_id = %s"
+                params.append(user_id)
+
+            if listing_id:
+                query += " AND listing_id = %s"
+                params.append(listing_id)
+
+            query += " ORDER BY viewing_time ASC;"
+            await cursor.execute(query, tuple(params))
+            return await cursor.fetchall()
+
+async def create_viewing(con, listing_id: int, user_id: int,
+                         viewing_date: str, viewing_time: datetime,
+                         status: str = "pending", notes: Optional[str] = None) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                INSERT INTO viewing_booking
+                (listing_id, user_id, viewing_date, viewing_time, status, notes)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING viewing_id;
+            """, (listing_id, user_id, viewing_date, viewing_time, status, notes))
+            result = await cursor.fetchone()
+            return result["viewing_id"] if result else None
+
+# ========== AGENT OPERATIONS ==========
+async def get_agents(con, agency_id: Optional[int] = None) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            if agency_id:
+                await cursor.execute("""
+                    SELECT * FROM realtor_agent
+                    WHERE agency_id = %s
+                    ORDER BY agent_id;
+                """, (agency_id,))
+            else:
+                await cursor.execute("SELECT * FROM realtor_agent ORDER BY agent_id;")
+            return await cursor.fetchall()
+
+# ========== REVIEW OPERATIONS ==========
+async def get_agent_reviews(con, agent_id: Optional[int] = None) -> List[Dict]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            if agent_id:
+                await cursor.execute("""
+                    SELECT * FROM agent_reviews
+                    WHERE agent_id = %s
+                    ORDER BY created_at DESC;
+                """, (agent_id,))
+            else:
+                await cursor.execute("SELECT * FROM agent_reviews ORDER BY created_at DESC;")
+            return await cursor.fetchall()
+
+async def create_review(con, agent_id: int, user_id: int, rating: int,
+                        comment: Optional[str] = None,
+                        transaction: Optional[str] = None) -> Optional[int]:
+    async with con.transaction():
+        async with con.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute("""
+                INSERT INTO agent_reviews
+                (agent_id, user_id, rating, comment, transaction)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING review_id;
+            """, (agent_id, user_id, rating, comment, transaction))
+            result = await cursor.fetchone()
+            return result["review_id"] if result else None
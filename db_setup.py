@@ -1,23 +1,71 @@
 
 import os
+import re
+import threading
+from datetime import date
+from typing import Optional
 
 import psycopg2
 from dotenv import load_dotenv
 
+from metrics import InstrumentedConnection
+from pool import ConnectionPool
+from replicas import ReplicaSet
+
 load_dotenv(override=True)
 
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 PASSWORD = os.getenv("PASSWORD")
 
+# Connection pool settings, see pool.py
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+POOL_MAX_USES = int(os.getenv("DB_POOL_MAX_USES", "0"))
+POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+POOL_CHECK_IDLE_AFTER = float(os.getenv("DB_POOL_CHECK_IDLE_AFTER", "5"))
+
+# Read replicas as host:port, comma separated, see replicas.py
+REPLICAS = [address.strip() for address in os.getenv("DB_REPLICAS", "").split(",") if address.strip()]
+REPLICA_EJECT_SECONDS = float(os.getenv("DB_REPLICA_EJECT_SECONDS", "30"))
+REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "10"))
+
+# Monthly partitions are created this many months ahead, see create_monthly_partitions
+PARTITION_MONTHS_AHEAD = 3
+# Tables that are (create_tables(partitioned=True) for bids and viewing_booking) partitioned by month on this column
+PARTITIONED_TABLES = {"bids": "bid_date", "viewing_booking": "viewing_time", "listing_price_history": "changed_at"}
+# maintain_partitions moves partitions of these tables that are past the retention to this schema
+ARCHIVED_TABLES = ("bids", "viewing_booking")
+ARCHIVE_SCHEMA = "archive"
+
+_pool = None
+_replica_set = None
+_async_pool = None
+_pool_lock = threading.Lock()
+
 
 def get_connection():
     """
-    Function that returns a single connection
-    In reality, we might use a connection pool, since
-    this way we'll start a new connection each time
-    someone hits one of our endpoints, which isn't great for performance
+    Function that returns a single, new connection.
+    The api borrows its connections from get_pool() instead, this is used
+    by the pool itself and by scripts such as create_tables.
+    Its cursors record query timings for GET /metrics (see metrics.py)
     """
-    return psycopg2.connect(
+    return psycopg2.connect(connection_factory=InstrumentedConnection, **_connection_params())
+
+
+def get_replica_connection(address: str):
+    """A new connection to the read replica at address (host:port), same database and credentials as the primary"""
+    host, _, port = address.partition(":")
+    params = _connection_params()
+    params["host"] = host
+    if port:
+        params["port"] = port
+    return psycopg2.connect(connection_factory=InstrumentedConnection, **params)
+
+
+def _connection_params():
+    return dict(
         dbname=DATABASE_NAME,
         user="postgres",  # change if needed
         password=PASSWORD,
@@ -26,9 +74,101 @@ def get_connection():
     )
 
 
-def create_tables():
+def get_pool():
+    """
+    Returns the connection pool shared by the whole process, it's created on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    get_connection,
+                    min_size=POOL_MIN_SIZE,
+                    max_size=POOL_MAX_SIZE,
+                    timeout=POOL_TIMEOUT,
+                    max_uses=POOL_MAX_USES,
+                    max_lifetime=POOL_MAX_LIFETIME,
+                    check_idle_after=POOL_CHECK_IDLE_AFTER,
+                )
+    return _pool
+
+
+def get_replica_set():
+    """
+    Returns the pools of the read replicas in DB_REPLICAS, None when there are none. Each replica
+    gets a pool with the DB_POOL_* settings, it's created on first use
+    """
+    global _replica_set
+    if _replica_set is None and REPLICAS:
+        with _pool_lock:
+            if _replica_set is None:
+                _replica_set = ReplicaSet(
+                    {address: ConnectionPool(
+                        lambda address=address: get_replica_connection(address),
+                        min_size=POOL_MIN_SIZE,
+                        max_size=POOL_MAX_SIZE,
+                        timeout=POOL_TIMEOUT,
+                        max_uses=POOL_MAX_USES,
+                        max_lifetime=POOL_MAX_LIFETIME,
+                        check_idle_after=POOL_CHECK_IDLE_AFTER,
+                    ) for address in REPLICAS},
+                    eject_seconds=REPLICA_EJECT_SECONDS,
+                    max_lag=REPLICA_MAX_LAG,
+                )
+    return _replica_set
+
+
+def close_pool():
+    global _pool, _replica_set
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _replica_set is not None:
+            _replica_set.close()
+            _replica_set = None
+
+
+def get_async_pool():
+    """
+    Returns the async connection pool (psycopg 3) used by app_async.py, it's created on first use.
+    It uses the same DB_POOL_* settings as get_pool(), and has to be opened with `await pool.open()`
+    """
+    global _async_pool
+    if _async_pool is None:
+        # Imported here so scripts that only use psycopg2 don't need psycopg 3 installed
+        from psycopg_pool import AsyncConnectionPool
+
+        with _pool_lock:
+            if _async_pool is None:
+                _async_pool = AsyncConnectionPool(
+                    kwargs=_connection_params(),
+                    min_size=POOL_MIN_SIZE,
+                    max_size=POOL_MAX_SIZE,
+                    timeout=POOL_TIMEOUT,
+                    # psycopg_pool has no "unlimited", a year is close enough
+                    max_lifetime=POOL_MAX_LIFETIME or 365 * 24 * 3600,
+                    check=AsyncConnectionPool.check_connection,
+                    open=False,
+                )
+    return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+def create_tables(partitioned: bool = False):
     """
     A function to create the necessary tables for the project.
+    With partitioned=True bids and viewing_booking are created as monthly range partitions (on bid_date and
+    viewing_time), tables that already exist are left as they are.
+    It sets up a new database with the current schema, existing databases are changed by the migrations
+    in migrations/ (see migrate.py): a schema change goes in here and into a new migration
     """
     connection = get_connection()
     with connection:
@@ -137,9 +277,40 @@ def create_tables():
                 );
             """)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_city ON house_listing(city);")
+            # city filters in db.get_listings: ILIKE '%...%' can only use a trigram index,
+            # prefix and exact matches compare lower(city) and use the btree below
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_city_trgm ON house_listing USING gin (city gin_trgm_ops);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_city_lower ON house_listing(lower(city) text_pattern_ops);")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_price ON house_listing(price);")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_category ON house_listing(category_id);")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_status ON house_listing(status);")
+            # Backs ORDER BY created_at DESC, listing_id DESC in get_listings (keyset pagination),
+            # users and realtor_agencies are paginated on their primary key which is already indexed
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_created_id ON house_listing(created_at DESC, listing_id DESC);")
+            # Deleting a user or an agent checks the listings that reference it (migration 0002)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_user ON house_listing(user_id);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_agent ON house_listing(agent_id);")
+            # Full text search document for db.search_listings, kept in sync by db.create_listing / db.update_listing.
+            # Rows inserted some other way (e.g seed_data.sql) are filled in here
+            cursor.execute("ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS search_vector tsvector;")
+            cursor.execute("""
+                UPDATE house_listing
+                SET search_vector = setweight(to_tsvector('swedish', title), 'A') ||
+                                    setweight(to_tsvector('swedish', description), 'B')
+                WHERE search_vector IS NULL;
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_search ON house_listing USING gin (search_vector);")
+            # Key of listings imported by feed partners (db.bulk_import_listings)
+            cursor.execute("ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS external_ref VARCHAR(100);")
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_listing_external_ref ON house_listing(external_ref);")
+            # Highest bid so far, maintained by db.create_bid which checks new bids against it
+            cursor.execute("ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS highest_bid DECIMAL;")
+            # Spatial indexes for db.get_listings_in_radius (earthdistance) and db.get_listings_in_bbox (point)
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS cube;")
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS earthdistance;")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_earth ON house_listing USING gist (ll_to_earth(latitude::float8, longitude::float8));")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_listing_point ON house_listing USING gist (point(longitude::float8, latitude::float8));")
 
 #6. LISTING_IMAGES TABLE
 
@@ -157,28 +328,102 @@ def create_tables():
             """)
 
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_listing ON listing_images(listing_id);")
+            cursor.execute("ALTER TABLE listing_images ADD COLUMN IF NOT EXISTS external_ref VARCHAR(100);")
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_images_external_ref ON listing_images(external_ref);")
 
 
 # 7. BIDS TABLE
 
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS bids (
-                    bid_id SERIAL PRIMARY KEY,
-                    listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
-                    user_id INTEGER REFERENCES users(user_id),
-                    amount DECIMAL NOT NULL,
-                    bid_date TIMESTAMP DEFAULT now(),
-                    status VARCHAR(20) NOT NULL,
-                    comment TEXT,
-                    created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now()
-                );
-
-            
-            """)
+            if partitioned:
+                # The partition key has to be part of the primary key, and can't be NULL
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS bids (
+                        bid_id SERIAL,
+                        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+                        user_id INTEGER REFERENCES users(user_id),
+                        amount DECIMAL NOT NULL,
+                        bid_date TIMESTAMP NOT NULL DEFAULT now(),
+                        status VARCHAR(20) NOT NULL,
+                        comment TEXT,
+                        created_at TIMESTAMP DEFAULT now(),
+                        updated_at TIMESTAMP DEFAULT now(),
+                        PRIMARY KEY (bid_id, bid_date)
+                    ) PARTITION BY RANGE (bid_date);
+                """)
+            else:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS bids (
+                        bid_id SERIAL PRIMARY KEY,
+                        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+                        user_id INTEGER REFERENCES users(user_id),
+                        amount DECIMAL NOT NULL,
+                        bid_date TIMESTAMP DEFAULT now(),
+                        status VARCHAR(20) NOT NULL,
+                        comment TEXT,
+                        created_at TIMESTAMP DEFAULT now(),
+                        updated_at TIMESTAMP DEFAULT now()
+                    );
+                """)
+            if is_partitioned(cursor, "bids"):
+                create_partitions(cursor, "bids", "bid_date")
 
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_bids_listing ON bids(listing_id);")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_bids_user ON bids(user_id);")
+            # Newest first in db.get_bids, per partition when partitioned
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_bids_date ON bids(bid_date);")
+            # Bids placed before house_listing.highest_bid existed (or inserted directly, e.g seed_data.sql).
+            # Rejected bids don't count, a new bid only has to beat the ones still standing
+            cursor.execute("""
+                UPDATE house_listing h SET highest_bid = b.highest_bid
+                FROM (SELECT listing_id, max(amount) FILTER (WHERE status <> 'rejected') AS highest_bid
+                      FROM bids GROUP BY listing_id) b
+                WHERE h.listing_id = b.listing_id AND h.highest_bid IS DISTINCT FROM b.highest_bid;
+            """)
+
+            # db.create_bid only ever raises highest_bid. When bids are rejected (or accepted again), change
+            # amount or are deleted, the affected listings' highest_bid is recomputed from the standing bids
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION recompute_highest_bid() RETURNS trigger AS $$
+                DECLARE
+                    listings INTEGER[];
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        SELECT array_agg(DISTINCT changed.listing_id) INTO listings
+                        FROM old_bids o JOIN new_bids n USING (bid_id)
+                        CROSS JOIN LATERAL (VALUES (o.listing_id), (n.listing_id)) changed(listing_id)
+                        WHERE (o.status, o.amount, o.listing_id) IS DISTINCT FROM (n.status, n.amount, n.listing_id);
+                    ELSE
+                        SELECT array_agg(DISTINCT listing_id) INTO listings FROM old_bids;
+                    END IF;
+                    IF listings IS NULL THEN
+                        RETURN NULL;
+                    END IF;
+                    -- Lock the listings first, like PLACE_BID_SQL does, so the recount (a new statement, with a
+                    -- new snapshot) includes the bids of transactions that held the lock before us
+                    PERFORM 1 FROM house_listing WHERE listing_id = ANY(listings) ORDER BY listing_id FOR UPDATE;
+                    -- updated_at is part of the listing's version (db.get_listing_version), a status-only
+                    -- bid update changes nothing else that would bump it
+                    UPDATE house_listing h SET highest_bid = b.highest_bid, updated_at = clock_timestamp()
+                    FROM (SELECT l.listing_id,
+                                 (SELECT max(amount) FROM bids
+                                  WHERE bids.listing_id = l.listing_id AND status <> 'rejected') AS highest_bid
+                          FROM unnest(listings) l(listing_id)) b
+                    WHERE h.listing_id = b.listing_id AND h.highest_bid IS DISTINCT FROM b.highest_bid;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            triggers = [
+                ("trg_highest_bid_update", "UPDATE", "bids", "NEW TABLE AS new_bids OLD TABLE AS old_bids"),
+                ("trg_highest_bid_delete", "DELETE", "bids", "OLD TABLE AS old_bids"),
+            ]
+            for name, event, table, referencing in triggers:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table};")
+                cursor.execute(f"""
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    REFERENCING {referencing}
+                    FOR EACH STATEMENT EXECUTE FUNCTION recompute_highest_bid();
+                """)
 
 
 #8. FAVORITES TABLE
@@ -193,6 +438,8 @@ def create_tables():
              """)
 
             cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_favorites_user_listing ON favorites(user_id, listing_id);")
+            # favorite counts per listing (db.get_listing_detail), the unique index above starts with user_id
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_favorites_listing ON favorites(listing_id);")
 
 
 # 9. AGENT_REVIEWS TABLE
@@ -215,27 +462,712 @@ def create_tables():
 
 #10. VIEWING_BOOKINGS TABLE
 
+            if partitioned:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS viewing_booking (
+                        viewing_id SERIAL,
+                        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+                        user_id INTEGER REFERENCES users(user_id),
+                        viewing_date date NOT NULL,
+                        viewing_time TIMESTAMP NOT NULL,
+                        status VARCHAR(20) NOT NULL,
+                        notes TEXT,
+                        created_at TIMESTAMP DEFAULT now(),
+                        updated_at TIMESTAMP DEFAULT now(),
+                        PRIMARY KEY (viewing_id, viewing_time)
+                    ) PARTITION BY RANGE (viewing_time);
+                """)
+            else:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS viewing_booking (
+                        viewing_id SERIAL PRIMARY KEY,
+                        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+                        user_id INTEGER REFERENCES users(user_id),
+                        viewing_date date NOT NULL,
+                        viewing_time TIMESTAMP NOT NULL,
+                        status VARCHAR(20) NOT NULL,
+                        notes TEXT,
+                        created_at TIMESTAMP DEFAULT now(),
+                        updated_at TIMESTAMP DEFAULT now()
+                    );
+                """)
+            if is_partitioned(cursor, "viewing_booking"):
+                create_partitions(cursor, "viewing_booking", "viewing_time")
+
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_viewing_listing ON viewing_booking(listing_id);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_viewing_user ON viewing_booking(user_id);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_viewing_time ON viewing_booking(viewing_time);")
+
+
+#11. LISTING_SUMMARY TABLE
+# One row per listing with what a search results page shows, so db.get_listings(summary=True) is a single
+# indexed query instead of lookups in listing_images, bids and favorites per listing.
+# Kept up to date by statement level triggers (one UPDATE per statement, also for COPY and bulk imports)
+
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS viewing_booking (
-                    viewing_id SERIAL PRIMARY KEY,
-                    listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
-                    user_id INTEGER REFERENCES users(user_id),
-                    viewing_date date NOT NULL,
-                    viewing_time TIMESTAMP NOT NULL,
-                    status VARCHAR(20) NOT NULL,
-                    notes TEXT,
+                CREATE TABLE IF NOT EXISTS listing_summary (
+                    listing_id INTEGER PRIMARY KEY REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+                    category_id INTEGER,
+                    title VARCHAR(50) NOT NULL,
+                    price DECIMAL NOT NULL,
+                    address VARCHAR(255) NOT NULL,
+                    city VARCHAR(100) NOT NULL,
+                    rooms DECIMAL,
+                    size_sqm DECIMAL,
+                    status VARCHAR(50),
+                    created_at TIMESTAMP,
+                    primary_image_url VARCHAR(500),
+                    bid_count INTEGER NOT NULL DEFAULT 0,
+                    highest_bid DECIMAL,
+                    favorite_count INTEGER NOT NULL DEFAULT 0
+                );
+            """)
+
+            # Versions for conditional GETs (ETag / Last-Modified), bumped by the triggers below:
+            # changed_at whenever the summary row changes, images_changed_at when the listing's images change.
+            # Stamped with clock_timestamp(), now() is the start of the transaction, so a long transaction
+            # committing after a short one would stamp an older version and clients could get a stale 304
+            cursor.execute("ALTER TABLE listing_summary ADD COLUMN IF NOT EXISTS changed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp();")
+            cursor.execute("ALTER TABLE listing_summary ADD COLUMN IF NOT EXISTS images_changed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp();")
+            cursor.execute("ALTER TABLE listing_summary ALTER COLUMN changed_at SET DEFAULT clock_timestamp();")
+            cursor.execute("ALTER TABLE listing_summary ALTER COLUMN images_changed_at SET DEFAULT clock_timestamp();")
+
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_created_id ON listing_summary(created_at DESC, listing_id DESC);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_city_trgm ON listing_summary USING gin (city gin_trgm_ops);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_city_lower ON listing_summary(lower(city) text_pattern_ops);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_price ON listing_summary(price);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_summary_category ON listing_summary(category_id);")
+
+            # Listing columns, copied on insert and on updates that change one of them
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION listing_summary_upsert_listings() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        INSERT INTO listing_summary (listing_id, category_id, title, price, address, city,
+                                                     rooms, size_sqm, status, created_at)
+                        SELECT listing_id, category_id, title, price, address, city, rooms, size_sqm, status, created_at
+                        FROM new_listings
+                        ON CONFLICT (listing_id) DO NOTHING;
+                    ELSE
+                        -- Only listings where one of the copied columns changed (not e.g search_vector)
+                        UPDATE listing_summary s
+                        SET category_id = n.category_id, title = n.title, price = n.price, address = n.address,
+                            city = n.city, rooms = n.rooms, size_sqm = n.size_sqm, status = n.status,
+                            created_at = n.created_at, changed_at = clock_timestamp()
+                        FROM new_listings n JOIN old_listings o USING (listing_id)
+                        WHERE s.listing_id = n.listing_id
+                          AND (o.category_id, o.title, o.price, o.address, o.city, o.rooms, o.size_sqm, o.status, o.created_at)
+                              IS DISTINCT FROM
+                              (n.category_id, n.title, n.price, n.address, n.city, n.rooms, n.size_sqm, n.status, n.created_at);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            # A new bid can only raise the highest bid, changed or deleted bids are counted again. Rejected bids
+            # don't count towards highest_bid, the same as house_listing.highest_bid
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION listing_summary_bids() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        UPDATE listing_summary s
+                        SET bid_count = s.bid_count + n.bids, highest_bid = greatest(s.highest_bid, n.highest_bid),
+                            changed_at = clock_timestamp()
+                        FROM (SELECT listing_id, count(*) AS bids,
+                                     max(amount) FILTER (WHERE status <> 'rejected') AS highest_bid
+                              FROM new_bids GROUP BY listing_id) n
+                        WHERE s.listing_id = n.listing_id;
+                        RETURN NULL;
+                    END IF;
+
+                    IF TG_OP = 'UPDATE' THEN
+                        -- Most updates only change the status, those only affect the summary to or from 'rejected'
+                        UPDATE listing_summary s
+                        SET (bid_count, highest_bid) = (SELECT count(*), max(b.amount) FILTER (WHERE b.status <> 'rejected')
+                                                        FROM bids b WHERE b.listing_id = s.listing_id),
+                            changed_at = clock_timestamp()
+                        WHERE s.listing_id IN (
+                            SELECT o.listing_id FROM old_bids o JOIN new_bids n USING (bid_id)
+                            WHERE o.amount IS DISTINCT FROM n.amount OR o.listing_id IS DISTINCT FROM n.listing_id
+                               OR (o.status = 'rejected') IS DISTINCT FROM (n.status = 'rejected')
+                            UNION
+                            SELECT n.listing_id FROM old_bids o JOIN new_bids n USING (bid_id)
+                            WHERE o.listing_id IS DISTINCT FROM n.listing_id
+                        );
+                    ELSE
+                        UPDATE listing_summary s
+                        SET (bid_count, highest_bid) = (SELECT count(*), max(b.amount) FILTER (WHERE b.status <> 'rejected')
+                                                        FROM bids b WHERE b.listing_id = s.listing_id),
+                            changed_at = clock_timestamp()
+                        WHERE s.listing_id IN (SELECT listing_id FROM old_bids);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION listing_summary_favorites() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        UPDATE listing_summary s SET favorite_count = s.favorite_count + n.favorites, changed_at = clock_timestamp()
+                        FROM (SELECT listing_id, count(*) AS favorites FROM new_favorites GROUP BY listing_id) n
+                        WHERE s.listing_id = n.listing_id;
+                    ELSE
+                        UPDATE listing_summary s SET favorite_count = greatest(s.favorite_count - o.favorites, 0), changed_at = clock_timestamp()
+                        FROM (SELECT listing_id, count(*) AS favorites FROM old_favorites GROUP BY listing_id) o
+                        WHERE s.listing_id = o.listing_id;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            # Primary image: the one marked is_primary, otherwise the first in display order
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION listing_summary_images() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        UPDATE listing_summary s SET primary_image_url = (
+                            SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                            ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                            changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+                        WHERE s.listing_id IN (SELECT listing_id FROM new_images);
+                    ELSIF TG_OP = 'UPDATE' THEN
+                        UPDATE listing_summary s SET primary_image_url = (
+                            SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                            ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                            changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+                        WHERE s.listing_id IN (SELECT listing_id FROM new_images UNION SELECT listing_id FROM old_images);
+                    ELSE
+                        UPDATE listing_summary s SET primary_image_url = (
+                            SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                            ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                            changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+                        WHERE s.listing_id IN (SELECT listing_id FROM old_images);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            # Transition tables need one trigger per event
+            triggers = [
+                ("trg_summary_listings_insert", "INSERT", "house_listing", "NEW TABLE AS new_listings", "listing_summary_upsert_listings"),
+                ("trg_summary_listings_update", "UPDATE", "house_listing", "NEW TABLE AS new_listings OLD TABLE AS old_listings", "listing_summary_upsert_listings"),
+                ("trg_summary_bids_insert", "INSERT", "bids", "NEW TABLE AS new_bids", "listing_summary_bids"),
+                ("trg_summary_bids_update", "UPDATE", "bids", "NEW TABLE AS new_bids OLD TABLE AS old_bids", "listing_summary_bids"),
+                ("trg_summary_bids_delete", "DELETE", "bids", "OLD TABLE AS old_bids", "listing_summary_bids"),
+                ("trg_summary_favorites_insert", "INSERT", "favorites", "NEW TABLE AS new_favorites", "listing_summary_favorites"),
+                ("trg_summary_favorites_delete", "DELETE", "favorites", "OLD TABLE AS old_favorites", "listing_summary_favorites"),
+                ("trg_summary_images_insert", "INSERT", "listing_images", "NEW TABLE AS new_images", "listing_summary_images"),
+                ("trg_summary_images_update", "UPDATE", "listing_images", "NEW TABLE AS new_images OLD TABLE AS old_images", "listing_summary_images"),
+                ("trg_summary_images_delete", "DELETE", "listing_images", "OLD TABLE AS old_images", "listing_summary_images"),
+            ]
+            for name, event, table, referencing, function in triggers:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table};")
+                cursor.execute(f"""
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    REFERENCING {referencing}
+                    FOR EACH STATEMENT EXECUTE FUNCTION {function}();
+                """)
+
+            # Listings that existed before the triggers
+            refresh_listing_summary(cursor, missing_only=True)
+
+
+#12. SAVED_SEARCHES TABLE
+# Filters a buyer wants alerts for. NULL filters match anything. Triggers on house_listing look up the searches
+# new and changed listings match (SAVED_SEARCH_MATCH_SQL) and add them to the saved_search_matches outbox,
+# in the transaction of the write, whichever path it comes from (db.py, db_async.py, bulk imports, COPY)
+
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist;")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS saved_searches (
+                    search_id SERIAL PRIMARY KEY,
+                    user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                    name VARCHAR(100),
+                    city VARCHAR(100),
+                    category_id INTEGER REFERENCES listing_categories(category_id) ON DELETE CASCADE,
+                    min_price DECIMAL,
+                    max_price DECIMAL,
+                    is_active BOOLEAN NOT NULL DEFAULT true,
                     created_at TIMESTAMP DEFAULT now(),
-                    updated_at TIMESTAMP DEFAULT now()
+                    -- Bucket keys, '' and 0 stand for any city / any category
+                    city_key VARCHAR(100) GENERATED ALWAYS AS (coalesce(lower(city), '')) STORED,
+                    category_key INTEGER GENERATED ALWAYS AS (coalesce(category_id, 0)) STORED,
+                    -- A missing bound is unbounded
+                    price_range NUMRANGE GENERATED ALWAYS AS (numrange(min_price, max_price, '[]')) STORED,
+                    CHECK (min_price IS NULL OR max_price IS NULL OR min_price <= max_price)
+                );
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_saved_search_user ON saved_searches(user_id);")
+            # Equality on the bucket keys and @> on the price range in one index (btree_gist)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_saved_search_match
+                ON saved_searches USING gist (category_key, city_key, price_range)
+                WHERE is_active;
+            """)
+
+            # Outbox of matches, whatever sends the alerts claims them with db.claim_saved_search_matches.
+            # A listing is reported once per search
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS saved_search_matches (
+                    match_id BIGSERIAL PRIMARY KEY,
+                    search_id INTEGER NOT NULL REFERENCES saved_searches(search_id) ON DELETE CASCADE,
+                    user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                    listing_id INTEGER NOT NULL REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+                    reason VARCHAR(20) NOT NULL CHECK (reason IN ('new', 'updated')),
+                    created_at TIMESTAMP DEFAULT now(),
+                    delivered_at TIMESTAMP,
+                    UNIQUE (search_id, listing_id)
                 );
             """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_saved_search_matches_user ON saved_search_matches(user_id, match_id DESC);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_saved_search_matches_pending ON saved_search_matches(match_id) WHERE delivered_at IS NULL;")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_saved_search_matches_listing ON saved_search_matches(listing_id);")
 
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_viewing_listing ON viewing_booking(listing_id);")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_viewing_user ON viewing_booking(user_id);")
+            # Updates only match listings where a column the searches filter on changed,
+            # and only the searches the listing didn't match before the update
+            changed = """(SELECT * FROM {table} WHERE listing_id IN (SELECT listing_id FROM changed))"""
+            cursor.execute(f"""
+                CREATE OR REPLACE FUNCTION match_saved_searches() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        INSERT INTO saved_search_matches (search_id, user_id, listing_id, reason)
+                        SELECT search_id, user_id, listing_id, 'new'
+                        FROM ({SAVED_SEARCH_MATCH_SQL.format(listings="new_listings")}) matching
+                        ON CONFLICT (search_id, listing_id) DO NOTHING;
+                    ELSE
+                        WITH changed AS (
+                            SELECT n.listing_id FROM new_listings n JOIN old_listings o USING (listing_id)
+                            WHERE (o.price, o.status, o.city, o.category_id)
+                                  IS DISTINCT FROM (n.price, n.status, n.city, n.category_id)
+                        )
+                        INSERT INTO saved_search_matches (search_id, user_id, listing_id, reason)
+                        SELECT search_id, user_id, listing_id, 'updated'
+                        FROM ({SAVED_SEARCH_MATCH_SQL.format(listings=changed.format(table="new_listings"))}
+                              EXCEPT
+                              {SAVED_SEARCH_MATCH_SQL.format(listings=changed.format(table="old_listings"))}) matching
+                        ON CONFLICT (search_id, listing_id) DO NOTHING;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            triggers = [
+                ("trg_saved_search_match_insert", "INSERT", "house_listing", "NEW TABLE AS new_listings", "match_saved_searches"),
+                ("trg_saved_search_match_update", "UPDATE", "house_listing", "NEW TABLE AS new_listings OLD TABLE AS old_listings", "match_saved_searches"),
+            ]
+            for name, event, table, referencing, function in triggers:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table};")
+                cursor.execute(f"""
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    REFERENCING {referencing}
+                    FOR EACH STATEMENT EXECUTE FUNCTION {function}();
+                """)
+
+
+#13. LISTING_PRICE_HISTORY TABLE
+# Every listing's asking price and status over time: a row when the listing is created and one for every
+# update that changes its price or status (also the ones made outside db.update_listing, e.g bulk imports).
+# Append-only and partitioned by month, old months can be detached and archived as a whole.
+
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS listing_price_history (
+                    listing_id INTEGER NOT NULL,
+                    change VARCHAR(10) NOT NULL CHECK (change IN ('created', 'price', 'status')),
+                    price DECIMAL NOT NULL,
+                    status VARCHAR(50),
+                    city VARCHAR(100) NOT NULL,
+                    category_id INTEGER,
+                    size_sqm DECIMAL,
+                    changed_at TIMESTAMP NOT NULL DEFAULT now()
+                ) PARTITION BY RANGE (changed_at);
+            """)
+            # Starts at the oldest listing, the existing listings are added below
+            cursor.execute("SELECT coalesce(min(created_at), now())::date FROM house_listing;")
+            create_partitions(cursor, "listing_price_history", "changed_at", start=cursor.fetchone()[0])
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_history_listing ON listing_price_history(listing_id, changed_at);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_history_changed_city ON listing_price_history(changed_at, city);")
+
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION listing_price_history_append_only() RETURNS trigger AS $$
+                BEGIN
+                    RAISE EXCEPTION 'listing_price_history is append-only';
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            cursor.execute("DROP TRIGGER IF EXISTS trg_price_history_append_only ON listing_price_history;")
+            cursor.execute("""
+                CREATE TRIGGER trg_price_history_append_only BEFORE UPDATE OR DELETE ON listing_price_history
+                FOR EACH STATEMENT EXECUTE FUNCTION listing_price_history_append_only();
+            """)
+
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION record_listing_price_history() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        INSERT INTO listing_price_history (listing_id, change, price, status, city, category_id, size_sqm, changed_at)
+                        SELECT listing_id, 'created', price, status, city, category_id, size_sqm, coalesce(created_at, now())
+                        FROM new_listings;
+                    ELSE
+                        INSERT INTO listing_price_history (listing_id, change, price, status, city, category_id, size_sqm, changed_at)
+                        SELECT n.listing_id, CASE WHEN o.price IS DISTINCT FROM n.price THEN 'price' ELSE 'status' END,
+                               n.price, n.status, n.city, n.category_id, n.size_sqm, now()
+                        FROM new_listings n JOIN old_listings o USING (listing_id)
+                        WHERE (o.price, o.status) IS DISTINCT FROM (n.price, n.status);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+#14. PRICE_ROLLUP_MONTHLY TABLE
+# Median asking price per sqm of the active stock at the end of each month, by city and category: every listing
+# whose last history row before the month's end is active, with that row's price (the current month: as of now).
+# city '' and category_id 0 are the rollups over all cities / categories, cities are lower-cased like the
+# saved searches' city_key (listings without a category have category_id -1). A history row changes the stock
+# of its month and every month after it, the trigger marks those in price_rollup_dirty_months and
+# refresh_price_rollups (python db_setup.py --refresh-rollups, run it from cron) recomputes only those,
+# each from the previous month's stock (price_rollup_stock) and the history of that one month.
+
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS price_rollup_monthly (
+                    city VARCHAR(100) NOT NULL,
+                    category_id INTEGER NOT NULL,
+                    month DATE NOT NULL,
+                    listings INTEGER NOT NULL,
+                    median_price_per_sqm DECIMAL,
+                    refreshed_at TIMESTAMP NOT NULL DEFAULT now(),
+                    PRIMARY KEY (city, category_id, month)
+                );
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS price_rollup_dirty_months (
+                    month DATE PRIMARY KEY
+                );
+            """)
+            # The active listings at the end of the last closed month and the current month, with their price
+            # per sqm, refresh_price_rollups carries a month's stock forward from the one before
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS price_rollup_stock (
+                    month DATE NOT NULL,
+                    listing_id INTEGER NOT NULL,
+                    city VARCHAR(100) NOT NULL,
+                    category_id INTEGER NOT NULL,
+                    price_per_sqm DECIMAL NOT NULL,
+                    PRIMARY KEY (month, listing_id)
+                );
+            """)
+            cursor.execute(f"""
+                CREATE OR REPLACE FUNCTION mark_price_rollups_dirty() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO price_rollup_dirty_months (month)
+                    {PRICE_ROLLUP_MONTHS_SQL.format(history="new_history")}
+                    ON CONFLICT DO NOTHING;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            triggers = [
+                ("trg_price_history_insert", "INSERT", "house_listing", "NEW TABLE AS new_listings", "record_listing_price_history"),
+                ("trg_price_history_update", "UPDATE", "house_listing", "NEW TABLE AS new_listings OLD TABLE AS old_listings", "record_listing_price_history"),
+                ("trg_price_rollup_dirty", "INSERT", "listing_price_history", "NEW TABLE AS new_history", "mark_price_rollups_dirty"),
+            ]
+            for name, event, table, referencing, function in triggers:
+                cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table};")
+                cursor.execute(f"""
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    REFERENCING {referencing}
+                    FOR EACH STATEMENT EXECUTE FUNCTION {function}();
+                """)
+
+            # Listings that existed before the history, their current price as of their creation
+            cursor.execute("""
+                INSERT INTO listing_price_history (listing_id, change, price, status, city, category_id, size_sqm, changed_at)
+                SELECT listing_id, 'created', price, status, city, category_id, size_sqm, coalesce(created_at, now())
+                FROM house_listing
+                WHERE NOT EXISTS (SELECT 1 FROM listing_price_history);
+            """)
+            refresh_price_rollups(cursor)
+
+
+def add_months(day: date, months: int) -> date:
+    """First day of the month `months` after day's month"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_monthly_partitions(cursor, table: str, column: str, start: date, end: date):
+    """
+    Creates the missing monthly partitions of `table` (PARTITION BY RANGE on `column`) from start's month
+    up to and including end's month, named {table}_yYYYYmMM. Rows for a new month that are in the
+    default partition ({table}_default) are moved into it
+    """
+    month = add_months(start, 0)
+    while month <= end:
+        following = add_months(month, 1)
+        name = f"{table}_y{month.year}m{month.month:02d}"
+        cursor.execute("SELECT to_regclass(%s);", (name,))
+        if cursor.fetchone()[0] is None:
+            cursor.execute(f"""
+                SELECT to_regclass(%s) IS NOT NULL AND EXISTS (
+                    SELECT 1 FROM {table} WHERE {column} >= %s AND {column} < %s)
+            """, (f"{table}_default", month, following))
+            if cursor.fetchone()[0]:
+                # Rows of this month are in the default partition (there is no partition for it yet),
+                # a partition can't be added while the default partition has rows that belong in it
+                cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+                cursor.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM {table}_default WHERE {column} >= %s AND {column} < %s RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved;
+                """, (month, following))
+                cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);",
+                               (month, following))
+            else:
+                cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);",
+                               (month, following))
+        month = following
+
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def create_partitions(cursor, table: str, column: str, start: Optional[date] = None):
+    """
+    The default partition of `table` (rows outside the created months end up there instead of failing)
+    and the monthly partitions from `start` (default the oldest row's month) to PARTITION_MONTHS_AHEAD months ahead
+    """
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
+    if start is None:
+        cursor.execute(f"SELECT coalesce(min({column}), now())::date FROM {table};")
+        start = cursor.fetchone()[0]
+    create_monthly_partitions(cursor, table, column, start, add_months(date.today(), PARTITION_MONTHS_AHEAD))
+
+
+def monthly_partitions(cursor, table: str) -> list:
+    """(name, first day of the month) of the monthly partitions attached to table, oldest first"""
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s);
+    """, (table,))
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = re.fullmatch(rf"{table}_y(\d{{4}})m(\d{{2}})", name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def maintain_partitions(cursor, retention_months: Optional[int] = None) -> list:
+    """
+    Creates the coming months' partitions of the partitioned tables, run it monthly (e.g from cron).
+    With retention_months, partitions of ARCHIVED_TABLES whose month ended more than that many months ago
+    are detached and moved to the ARCHIVE_SCHEMA schema, from where they can be dumped and dropped.
+    listing_summary keeps counting archived bids until it's refreshed (--refresh-summary).
+    Returns the names of the archived partitions
+    """
+    today = date.today()
+    for table, column in PARTITIONED_TABLES.items():
+        if is_partitioned(cursor, table):
+            create_monthly_partitions(cursor, table, column, today, add_months(today, PARTITION_MONTHS_AHEAD))
+
+    archived = []
+    if not retention_months:
+        return archived
+    cutoff = add_months(today, -retention_months)
+    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA};")
+    for table in ARCHIVED_TABLES:
+        if not is_partitioned(cursor, table):
+            continue
+        for name, month in monthly_partitions(cursor, table):
+            if add_months(month, 1) > cutoff:
+                break
+            # Only a short exclusive lock on the parent, no rows are copied or deleted
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+            cursor.execute(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA};")
+            archived.append(name)
+    return archived
+
+
+# (search_id, user_id, listing_id) of the active saved searches the listings match, format with a table or
+# subquery of listings. A listing's category and city pick at most four (category_key, city_key) buckets
+# of idx_saved_search_match ('' and 0 stand for any city / category), the price is a range lookup within them
+SAVED_SEARCH_MATCH_SQL = """
+    SELECT DISTINCT s.search_id, s.user_id, l.listing_id
+    FROM {listings} l
+    CROSS JOIN LATERAL (VALUES (0, ''), (0, lower(l.city)), (coalesce(l.category_id, 0), ''),
+                               (coalesce(l.category_id, 0), lower(l.city))) b(category_key, city_key)
+    JOIN saved_searches s ON s.is_active AND s.category_key = b.category_key AND s.city_key = b.city_key
+                         AND s.price_range @> l.price::numeric
+    WHERE l.status = 'active'
+"""
+
+
+# The months whose month-end stock a set of history rows changes: from the oldest row's month up to the
+# current month, format with the name of the rows' table
+PRICE_ROLLUP_MONTHS_SQL = """
+    SELECT generate_series(date_trunc('month', min(h.changed_at)), date_trunc('month', now()), interval '1 month')::date
+    FROM {history} h
+"""
+
+# Any number, as long as nothing else in the database takes this advisory lock
+PRICE_ROLLUP_LOCK = 7301
+
+
+def refresh_price_rollups(cursor, full: bool = False) -> Optional[int]:
+    """
+    Recomputes the months of price_rollup_monthly marked in price_rollup_dirty_months and the months since the
+    latest rollup, or (full=True) every month since the oldest history, e.g to repair drift.
+    Returns the number of months refreshed, None when another refresh is running
+    """
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%s);", (PRICE_ROLLUP_LOCK,))
+    if not cursor.fetchone()[0]:
+        return None
+    if full:
+        cursor.execute("DELETE FROM price_rollup_stock;")
+        cursor.execute(f"""
+            INSERT INTO price_rollup_dirty_months (month)
+            {PRICE_ROLLUP_MONTHS_SQL.format(history="listing_price_history")}
+            ON CONFLICT DO NOTHING;
+        """)
+    # Months without any history still have their stock
+    cursor.execute("""
+        INSERT INTO price_rollup_dirty_months (month)
+        SELECT generate_series(coalesce(max(month) + interval '1 month', date_trunc('month', now())),
+                               date_trunc('month', now()), interval '1 month')::date
+        FROM price_rollup_monthly WHERE city = '' AND category_id = 0
+        ON CONFLICT DO NOTHING;
+    """)
+    cursor.execute("DELETE FROM price_rollup_dirty_months RETURNING month;")
+    months = sorted(row[0] for row in cursor.fetchall())
+
+    # Oldest first, every month's stock is carried forward from the one before
+    for month in months:
+        previous = add_months(month, -1)
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM price_rollup_stock WHERE month = %s);", (previous,))
+        if not cursor.fetchone()[0]:
+            _close_price_rollup_month(cursor, previous, carried=False)
+        _close_price_rollup_month(cursor, month, carried=True)
+
+        # Groups without active listings anymore disappear
+        cursor.execute("DELETE FROM price_rollup_monthly WHERE month = %s;", (month,))
+        cursor.execute("""
+            INSERT INTO price_rollup_monthly (city, category_id, month, listings, median_price_per_sqm, refreshed_at)
+            SELECT coalesce(city, ''), coalesce(category_id, 0), month, count(*),
+                   round(percentile_cont(0.5) WITHIN GROUP (ORDER BY price_per_sqm)::numeric), now()
+            FROM price_rollup_stock
+            WHERE month = %(month)s
+            GROUP BY month, GROUPING SETS ((city, category_id), (city), (category_id), ());
+        """, {"month": month})
+
+    # Only the last closed month is needed to carry the current one forward
+    cursor.execute("DELETE FROM price_rollup_stock WHERE month < date_trunc('month', now()) - interval '1 month';")
+    return len(months)
+
+
+def _close_price_rollup_month(cursor, month: date, carried: bool):
+    """
+    Replaces price_rollup_stock of month with the active listings at its end: carried=True takes the previous
+    month's stock and the listings with history in this month (one partition), carried=False reads all history
+    """
+    cursor.execute("DELETE FROM price_rollup_stock WHERE month = %s;", (month,))
+    since, unchanged = "", ""
+    if carried:
+        since = "h.changed_at >= %(month)s AND"
+        unchanged = """
+            UNION ALL
+            SELECT %(month)s, s.listing_id, s.city, s.category_id, s.price_per_sqm
+            FROM price_rollup_stock s
+            WHERE s.month = %(previous)s AND NOT EXISTS (SELECT 1 FROM changed c WHERE c.listing_id = s.listing_id)
+        """
+    cursor.execute(f"""
+        WITH changed AS (
+            SELECT DISTINCT ON (h.listing_id) h.listing_id, lower(h.city) AS city,
+                   coalesce(h.category_id, -1) AS category_id, h.status, h.price, h.size_sqm
+            FROM listing_price_history h
+            WHERE {since} h.changed_at < %(end)s
+            ORDER BY h.listing_id, h.changed_at DESC
+        )
+        INSERT INTO price_rollup_stock (month, listing_id, city, category_id, price_per_sqm)
+        SELECT %(month)s, c.listing_id, c.city, c.category_id, c.price / c.size_sqm
+        FROM changed c
+        WHERE c.status = 'active' AND c.size_sqm > 0
+        {unchanged};
+    """, {"month": month, "previous": add_months(month, -1), "end": add_months(month, 1)})
+
+
+LISTING_SUMMARY_COLUMNS = ("listing_id", "category_id", "title", "price", "address", "city", "rooms", "size_sqm",
+                           "status", "created_at", "primary_image_url", "bid_count", "highest_bid", "favorite_count")
+
+
+def refresh_listing_summary(cursor, missing_only: bool = False):
+    """
+    Computes listing_summary from scratch, for listings without a summary row or (missing_only=False) for all
+    of them. The triggers keep it up to date, this is for the initial load and to repair drift
+    """
+    cursor.execute(f"""
+        INSERT INTO listing_summary ({", ".join(LISTING_SUMMARY_COLUMNS)})
+        SELECT h.listing_id, h.category_id, h.title, h.price, h.address, h.city, h.rooms, h.size_sqm,
+               h.status, h.created_at, img.image_url, coalesce(b.bid_count, 0), b.highest_bid,
+               coalesce(f.favorite_count, 0)
+        FROM house_listing h
+        LEFT JOIN LATERAL (
+            SELECT i.image_url FROM listing_images i WHERE i.listing_id = h.listing_id
+            ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1
+        ) img ON true
+        LEFT JOIN (SELECT listing_id, count(*) AS bid_count, max(amount) FILTER (WHERE status <> 'rejected') AS highest_bid
+                   FROM bids GROUP BY listing_id) b ON b.listing_id = h.listing_id
+        LEFT JOIN (SELECT listing_id, count(*) AS favorite_count
+                   FROM favorites GROUP BY listing_id) f ON f.listing_id = h.listing_id
+        {"WHERE NOT EXISTS (SELECT 1 FROM listing_summary s WHERE s.listing_id = h.listing_id)" if missing_only else ""}
+        ON CONFLICT (listing_id) DO UPDATE SET
+            {", ".join(f"{column} = EXCLUDED.{column}" for column in LISTING_SUMMARY_COLUMNS[1:])},
+            changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+        WHERE ({", ".join(f"listing_summary.{column}" for column in LISTING_SUMMARY_COLUMNS[1:])})
+              IS DISTINCT FROM ({", ".join(f"EXCLUDED.{column}" for column in LISTING_SUMMARY_COLUMNS[1:])});
+    """)
 
             
 
 
 if __name__ == "__main__":
     # Only reason to execute this file would be to create new tables, meaning it serves a migration file
-    create_tables()
-    print("Tables created successfully.")
+    import sys
+    if "--refresh-summary" in sys.argv:
+        connection = get_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                refresh_listing_summary(cursor)
+        print("listing_summary refreshed.")
+    elif "--refresh-rollups" in sys.argv:
+        connection = get_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                months = refresh_price_rollups(cursor, full="--full" in sys.argv)
+        if months is None:
+            print("Another refresh is running.")
+        else:
+            print(f"price_rollup_monthly refreshed, {months} months.")
+    elif "--partitions" in sys.argv:
+        # Run monthly (e.g from cron) so the next months' partitions exist before rows arrive,
+        # --retention-months N also archives the bids and viewings partitions older than N months
+        retention = None
+        if "--retention-months" in sys.argv:
+            retention = int(sys.argv[sys.argv.index("--retention-months") + 1])
+        connection = get_connection()
+        with connection:
+            with connection.cursor() as cursor:
+                archived = maintain_partitions(cursor, retention)
+        print(f"Partitions created, archived: {', '.join(archived) or 'none'}.")
+    else:
+        create_tables(partitioned="--partitioned" in sys.argv)
+        print("Tables created successfully.")
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from db_setup import get_connection
+
+"""
+Push updates for bids, through Postgres LISTEN/NOTIFY.
+
+db.create_bid and db.update_bid_status send a NOTIFY on the "bids" channel inside their transaction,
+Postgres delivers it when the transaction commits (and never if it rolls back).
+Every process has one BidListener: a thread with a single LISTEN connection that hands each
+notification to the subscribers of that listing, so a thousand clients watching bids cost one connection.
+
+    subscription = get_listener().subscribe(listing_id)
+    event = await subscription.get(timeout=15)   # None on timeout
+    subscription.close()
+
+If the listen connection drops, the listener reconnects and sends every subscriber a "reconnected" event,
+notifications sent in between are lost, so clients should reload the bids when they get it.
+"""
+
+CHANNEL = "bids"
+SUBSCRIBER_QUEUE_SIZE = 100
+RECONNECT_DELAY = 1.0
+
+log = logging.getLogger("events")
+
+
+class Subscription:
+    def __init__(self, listener, listing_id: int, loop):
+        self.listener = listener
+        self.listing_id = listing_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event: dict):
+        """Runs on the event loop, a subscriber that can't keep up loses its oldest events"""
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: float = None):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.listener.unsubscribe(self)
+
+
+class BidListener:
+    def __init__(self, connect=get_connection, channel: str = CHANNEL):
+        self._connect = connect
+        self.channel = channel
+        self._subscribers = {}  # listing_id -> set of Subscription
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self.notifications = 0
+        self.reconnects = 0
+
+    # ---------- subscribers ----------
+    def subscribe(self, listing_id: int) -> Subscription:
+        """Has to be called from the event loop the subscription is read on"""
+        subscription = Subscription(self, listing_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(listing_id, set()).add(subscription)
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="bid-listener", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.listing_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.listing_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "listings": len(self._subscribers),
+                "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+                "notifications": self.notifications,
+                "reconnects": self.reconnects,
+            }
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    # ---------- listen thread ----------
+    def _dispatch(self, listing_id, event: dict):
+        with self._lock:
+            if listing_id is None:
+                subscribers = [s for subscribers in self._subscribers.values() for s in subscribers]
+            else:
+                subscribers = list(self._subscribers.get(listing_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The subscriber's event loop is closed
+                self.unsubscribe(subscription)
+
+    def _listen(self, conn):
+        while not self._stopping.is_set():
+            # Wake up now and then to notice stop(), and to find out about dead connections
+            if select.select([conn], [], [], 1.0) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.notifications += 1
+                try:
+                    event = json.loads(notify.payload)
+                except ValueError:
+                    log.warning("Ignoring notification with invalid payload: %r", notify.payload)
+                    continue
+                self._dispatch(event.get("listing_id"), event)
+
+    def _run(self):
+        connected_before = False
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel};")
+                if connected_before:
+                    self.reconnects += 1
+                    self._dispatch(None, {"event": "reconnected"})
+                connected_before = True
+                self._listen(conn)
+            except Exception:
+                log.exception("Bid listener lost its connection, reconnecting in %ss", RECONNECT_DELAY)
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener() -> BidListener:
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = BidListener()
+    return _listener
+
+
+def stop_listener():
+    if _listener is not None:
+        _listener.stop()
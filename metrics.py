@@ -0,0 +1,313 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+from psycopg2.extensions import connection as _connection, cursor as _cursor
+
+"""
+Latency instrumentation for the api, exported in the Prometheus text format by GET /metrics.
+
+- MetricsMiddleware times every request per route, and splits the time into phases:
+  pool (waiting for a connection), execute (query + transfer), fetch (building the row dicts)
+  and other (everything else, mostly validation and JSON serialization)
+- InstrumentedConnection hands out cursors that time execute/fetch per db.py function and count
+  the rows returned. db_setup.get_connection uses it, so every db.py function is covered
+- Queries slower than DB_SLOW_QUERY_MS (0 disables) are logged to the "db.slow_queries" logger,
+  with the literals in the query and the parameters redacted
+
+Every process has its own metrics, with several uvicorn workers each scrape hits one of them.
+"""
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "0"))
+REQUEST_PHASES = ("pool", "execute", "fetch")
+
+slow_query_log = logging.getLogger("db.slow_queries")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), series):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {series[-1]}")
+                lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Time spent on a request",
+                             ("method", "route", "status"))
+REQUEST_PHASE = Histogram("http_request_phase_seconds", "Time spent on a request per phase",
+                          ("method", "route", "phase"))
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Time spent in cursor calls per db function",
+                           ("function", "phase"))
+QUERY_ROWS = Counter("db_query_rows_total", "Rows fetched per db function", ("function",))
+QUERY_COUNT = Counter("db_queries_total", "Statements executed per db function", ("function",))
+SLOW_QUERIES = Counter("db_slow_queries_total", "Statements slower than DB_SLOW_QUERY_MS", ("function",))
+POOL_WAIT = Histogram("db_pool_wait_seconds", "Time spent waiting for a pooled connection")
+
+METRICS = [REQUEST_DURATION, REQUEST_PHASE, QUERY_DURATION, QUERY_ROWS, QUERY_COUNT, SLOW_QUERIES, POOL_WAIT]
+
+# Seconds per phase of the request that is being handled, set by MetricsMiddleware
+_request_phases = ContextVar("request_phases", default=None)
+
+
+def _add_to_request(phase: str, seconds: float):
+    phases = _request_phases.get()
+    if phases is not None:
+        phases[phase] += seconds
+
+
+def observe_pool_wait(seconds: float):
+    POOL_WAIT.observe(seconds)
+    _add_to_request("pool", seconds)
+
+
+# ========== QUERIES ==========
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def redact(query) -> str:
+    """The query with string and number literals replaced by ?, collapsed to one line"""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return " ".join(_LITERALS.sub("?", str(query)).split())
+
+
+# Modules that run queries on behalf of a db.py function
+_HELPER_MODULES = {"psycopg2", "psycopg2.extras", "psycopg2.extensions", "prepared", __name__}
+
+
+def _caller() -> str:
+    """Name of the function that created the cursor, skipping helpers like execute_values and prepared.execute"""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__", "") in _HELPER_MODULES:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+
+def _record_execute(function: str, seconds: float, query, params):
+    QUERY_DURATION.observe(seconds, function, "execute")
+    QUERY_COUNT.inc(1, function)
+    _add_to_request("execute", seconds)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(1, function)
+        if isinstance(params, dict):
+            redacted = {key: type(value).__name__ for key, value in params.items()}
+        else:
+            redacted = [type(value).__name__ for value in params or ()]
+        slow_query_log.warning("%s took %.1f ms: %s params=%s", function, seconds * 1000, redact(query), redacted)
+
+
+def _record_fetch(function: str, seconds: float, rows: int):
+    QUERY_DURATION.observe(seconds, function, "fetch")
+    QUERY_ROWS.inc(rows, function)
+    _add_to_request("fetch", seconds)
+
+
+class InstrumentedCursorMixin:
+    # Name of the db.py function that created the cursor, worked out once in InstrumentedConnection.cursor
+    function = "unknown"
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_execute(self.function, time.perf_counter() - start, query, vars)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record_execute(self.function, time.perf_counter() - start, query, None)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        _record_fetch(self.function, time.perf_counter() - start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        _record_fetch(self.function, time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        _record_fetch(self.function, time.perf_counter() - start, len(rows))
+        return rows
+
+    def __iter__(self):
+        """
+        Iterating a cursor (the exports read named cursors this way, itersize rows per round trip) doesn't
+        go through fetch*, the rows are recorded per itersize rows and when the iteration ends
+        """
+        iterator = super().__iter__()
+        rows, seconds = 0, 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+                rows += 1
+                if rows >= self.itersize:
+                    _record_fetch(self.function, seconds, rows)
+                    rows, seconds = 0, 0.0
+                yield row
+        finally:
+            if rows or seconds:
+                _record_fetch(self.function, seconds, rows)
+
+
+_cursor_classes = {}
+
+
+def instrumented(cursor_factory):
+    """Subclass of cursor_factory (e.g RealDictCursor) with InstrumentedCursorMixin, created once per factory"""
+    cls = _cursor_classes.get(cursor_factory)
+    if cls is None:
+        cls = _cursor_classes[cursor_factory] = type(
+            "Instrumented" + cursor_factory.__name__, (InstrumentedCursorMixin, cursor_factory), {})
+    return cls
+
+
+class InstrumentedConnection(_connection):
+    """psycopg2 connection whose cursors are instrumented, pass it as connection_factory to psycopg2.connect"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or _cursor
+        kwargs["cursor_factory"] = instrumented(factory)
+        cursor = super().cursor(*args, **kwargs)
+        # Once per cursor instead of walking the stack on every execute and fetch
+        cursor.function = _caller()
+        return cursor
+
+
+# ========== REQUESTS ==========
+class MetricsMiddleware:
+    """ASGI middleware, records the duration of every request under its route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        phases = dict.fromkeys(REQUEST_PHASES, 0.0)
+        token = _request_phases.set(phases)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_phases.reset(token)
+            # The router puts the matched route in the scope, unmatched paths share one label
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUEST_DURATION.observe(elapsed, method, route, str(status_code))
+            for phase, seconds in phases.items():
+                REQUEST_PHASE.observe(seconds, method, route, phase)
+            REQUEST_PHASE.observe(max(0.0, elapsed - sum(phases.values())), method, route, "other")
+
+
+def _gauge(name: str, help: str, values: dict, label: str = "") -> list:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for key, value in values.items():
+        lines.append(f"{name}{_labels((label,), (key,)) if label else ''} {value}")
+    return lines
+
+
+def render(pool_stats: dict = None, cache_stats: dict = None) -> str:
+    """All metrics in the Prometheus text format, pool and cache stats are added as gauges"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    if pool_stats:
+        lines.extend(_gauge("db_pool_connections", "Pooled connections by state",
+                            {"in_use": pool_stats["in_use"], "idle": pool_stats["idle"]}, "state"))
+        lines.extend(_gauge("db_pool_timeouts", "Checkouts that timed out", {"": pool_stats["timeouts"]}))
+    if cache_stats:
+        lines.extend(_gauge("cache_requests", "Cache lookups by result",
+                            {"hit": cache_stats["hits"], "miss": cache_stats["misses"]}, "result"))
+        lines.extend(_gauge("cache_evictions", "Entries evicted from the cache", {"": cache_stats["evictions"]}))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,387 @@
+"""
+Versioned schema migrations.
+
+Schema changes go into migrations/ as numbered files, NNNN_description.py, that are applied in order.
+Every applied version is recorded in the schema_migrations table, so each runs once per database.
+0001_baseline is the schema as it was when migrations were introduced, later versions change it. A migration
+is never edited after it was applied: a schema change goes into db_setup.create_tables (which sets up a new
+database with the current schema in one go) and into a new migration for the existing databases.
+
+A migration defines upgrade(m), m is an Operations object:
+
+    TRANSACTIONAL = False  # default True, see below
+
+    def upgrade(m):
+        m.execute("ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS energy_class VARCHAR(1);")
+        m.create_index_concurrently("idx_listing_energy", "house_listing", "(energy_class)")
+        m.backfill("house_listing", "energy_class = 'C'", where="energy_class IS NULL", key="listing_id")
+
+- TRANSACTIONAL = True runs the whole migration and its schema_migrations row in one transaction,
+  it's applied completely or not at all
+- TRANSACTIONAL = False runs every statement in its own transaction, needed for CREATE INDEX CONCURRENTLY
+  and batched backfills, which don't block writes for long. The migration has to be safe to run again
+  after it failed halfway (IF NOT EXISTS, WHERE ... IS NULL)
+- Every statement waits at most MIGRATION_LOCK_TIMEOUT for its locks, so a migration queued behind a
+  long transaction doesn't block the queries queued behind it. It's retried MIGRATION_LOCK_RETRIES times
+
+    python migrate.py status
+    python migrate.py up [--to VERSION] [--dry-run]
+    python migrate.py new add_energy_class
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
+import re
+import sys
+import time
+
+from psycopg2 import errors
+
+from db_setup import get_connection
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+LOCK_RETRIES = int(os.getenv("MIGRATION_LOCK_RETRIES", "5"))
+# Advisory lock held while migrating, so two deploys don't run the same migrations at once
+MIGRATION_LOCK = 7302
+
+FILE_PATTERN = re.compile(r"(\d{4})_(\w+)\.py")
+
+TEMPLATE = '''"""{description}"""
+
+TRANSACTIONAL = True
+
+
+def upgrade(m):
+    m.execute("")
+'''
+
+
+class Migration:
+    def __init__(self, path: str):
+        self.path = path
+        match = FILE_PATTERN.fullmatch(os.path.basename(path))
+        self.version = int(match.group(1))
+        self.name = match.group(2)
+        with open(path, "rb") as file:
+            self.checksum = hashlib.sha256(file.read()).hexdigest()
+        self._module = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            spec = importlib.util.spec_from_file_location(f"migrations.{self.version:04d}_{self.name}", self.path)
+            self._module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(self._module)
+        return self._module
+
+    @property
+    def transactional(self) -> bool:
+        return getattr(self.module, "TRANSACTIONAL", True)
+
+    def __str__(self):
+        return f"{self.version:04d}_{self.name}"
+
+
+def load_migrations() -> list:
+    migrations = [Migration(os.path.join(MIGRATIONS_DIR, name))
+                  for name in os.listdir(MIGRATIONS_DIR) if FILE_PATTERN.fullmatch(name)]
+    migrations.sort(key=lambda migration: migration.version)
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError("Two migrations have the same version number")
+    return migrations
+
+
+# ========== OPERATIONS ==========
+class Operations:
+    """What a migration's upgrade(m) gets. In dry-run mode the statements are printed instead of run"""
+
+    def __init__(self, con, transactional: bool, dry_run: bool = False):
+        self.con = con
+        self.transactional = transactional
+        self.dry_run = dry_run
+
+    def _print(self, statement: str, params=None):
+        with self.con.cursor() as cursor:
+            rendered = cursor.mogrify(statement, params).decode() if params else statement
+        print("    " + "\n    ".join(line.strip() for line in rendered.strip().splitlines() if line.strip()))
+
+    def execute(self, statement: str, params=None):
+        if self.dry_run:
+            self._print(statement, params)
+            return
+        # In a transactional migration a lock timeout fails the whole migration, which is retried as a whole
+        attempts = 1 if self.transactional else LOCK_RETRIES + 1
+        for attempt in range(attempts):
+            try:
+                with self.con.cursor() as cursor:
+                    cursor.execute(statement, params)
+                return
+            except errors.LockNotAvailable:
+                if attempt == attempts - 1:
+                    raise
+                print(f"    lock timeout, retrying ({attempt + 1}/{LOCK_RETRIES})")
+                time.sleep(2 ** attempt)
+
+    def query(self, statement: str, params=None) -> list:
+        """Rows of a read only query, also run in dry-run mode"""
+        with self.con.cursor() as cursor:
+            cursor.execute(statement, params)
+            return cursor.fetchall()
+
+    def _partitions(self, table: str) -> list:
+        """Names of the partitions of table, empty when it isn't partitioned"""
+        return [name for (name,) in self.query("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            ORDER BY c.relname;
+        """, (table,))]
+
+    def create_index_concurrently(self, name: str, table: str, definition: str, unique: bool = False):
+        """
+        CREATE INDEX CONCURRENTLY, writes to the table continue while the index is built.
+        definition is what follows the table name, e.g "(agent_id)" or "USING gin (city gin_trgm_ops)".
+        A partitioned table can't be indexed concurrently, its index is created ON ONLY the table and
+        the partitions are indexed concurrently one by one and attached to it
+        """
+        if self.transactional:
+            raise RuntimeError("CREATE INDEX CONCURRENTLY can't run in a transaction, set TRANSACTIONAL = False")
+        partitions = self._partitions(table)
+        if partitions:
+            valid = self.query("""
+                SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s AND i.indisvalid;
+            """, (name,))
+            if valid:
+                return
+            self.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON ONLY {table} {definition};")
+            for partition in partitions:
+                index = f"{name}_{partition[len(table) + 1:]}"
+                self.create_index_concurrently(index, partition, definition, unique)
+                self.execute(f"ALTER INDEX {name} ATTACH PARTITION {index};")
+            return
+        # A build that failed or was interrupted leaves an invalid index behind, IF NOT EXISTS would keep it
+        invalid = self.query("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid;
+        """, (name,))
+        if invalid:
+            self.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        self.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition};")
+
+    def drop_index_concurrently(self, name: str):
+        if self.transactional:
+            raise RuntimeError("DROP INDEX CONCURRENTLY can't run in a transaction, set TRANSACTIONAL = False")
+        partitioned = self.query("SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'I';", (name,))
+        # Not supported for the index of a partitioned table, dropping it only holds its lock briefly
+        self.execute(f"DROP INDEX {'' if partitioned else 'CONCURRENTLY '}IF EXISTS {name};")
+
+    def backfill(self, table: str, set_clause: str, where: str, key: str, batch_size: int = 5000,
+                 pause: float = 0.1, params=()):
+        """
+        UPDATE table SET set_clause WHERE where, in batches of batch_size key values (an indexed integer column,
+        usually the primary key), each batch committed on its own and followed by a pause, so row locks are
+        held briefly and replicas and autovacuum keep up. `where` has to exclude rows that are already done,
+        so a backfill that was interrupted can run again
+        """
+        if self.transactional:
+            raise RuntimeError("A batched backfill commits per batch, set TRANSACTIONAL = False")
+        statement = f"UPDATE {table} SET {set_clause} WHERE {key} >= %s AND {key} < %s AND ({where});"
+        if self.dry_run:
+            try:
+                low, high = self.query(f"SELECT min({key}), max({key}) FROM {table};")[0]
+            except errors.UndefinedTable:
+                # Created by an earlier migration that the dry run didn't apply
+                low = high = None
+            print(f"    -- in batches of {batch_size} {key} values ({low} to {high}), {pause}s apart:")
+            self._print(statement, (*params, low or 0, (low or 0) + batch_size))
+            return
+        low, high = self.query(f"SELECT min({key}), max({key}) FROM {table};")[0]
+        if low is None:
+            return
+        updated = 0
+        for start in range(low, high + 1, batch_size):
+            with self.con.cursor() as cursor:
+                for attempt in range(LOCK_RETRIES + 1):
+                    try:
+                        cursor.execute(statement, (*params, start, start + batch_size))
+                        break
+                    except errors.LockNotAvailable:
+                        if attempt == LOCK_RETRIES:
+                            raise
+                        time.sleep(2 ** attempt)
+                updated += cursor.rowcount
+            print(f"\r    {table}: {min(start + batch_size, high + 1) - low}/{high + 1 - low} {key} values, "
+                  f"{updated} rows updated", end="", flush=True)
+            time.sleep(pause)
+        print()
+
+    def run(self, function, *args, **kwargs):
+        """
+        Calls function(cursor, *args, **kwargs) with a cursor on the migration's connection, so its statements
+        wait at most MIGRATION_LOCK_TIMEOUT too, e.g db_setup.create_partitions. With TRANSACTIONAL = False
+        it runs in a transaction of its own, which is retried after a lock timeout
+        """
+        if self.dry_run:
+            print(f"    -- {function.__module__}.{function.__name__}(cursor{''.join(f', {arg!r}' for arg in args)})")
+            return
+        if self.transactional:
+            with self.con.cursor() as cursor:
+                return function(cursor, *args, **kwargs)
+        for attempt in range(LOCK_RETRIES + 1):
+            self.con.autocommit = False
+            try:
+                with self.con:
+                    with self.con.cursor() as cursor:
+                        return function(cursor, *args, **kwargs)
+            except errors.LockNotAvailable:
+                if attempt == LOCK_RETRIES:
+                    raise
+                print(f"    lock timeout, retrying ({attempt + 1}/{LOCK_RETRIES})")
+                time.sleep(2 ** attempt)
+            finally:
+                self.con.autocommit = True
+
+
+# ========== RUNNER ==========
+def ensure_tracking_table(con):
+    with con.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                checksum VARCHAR(64) NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now(),
+                duration_ms INTEGER
+            );
+        """)
+
+
+def applied_migrations(con) -> dict:
+    """version -> (name, checksum, applied_at)"""
+    with con.cursor() as cursor:
+        cursor.execute("SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version;")
+        return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+def _record(con, migration: Migration, started: float):
+    with con.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+            VALUES (%s, %s, %s, %s);
+        """, (migration.version, migration.name, migration.checksum, round((time.perf_counter() - started) * 1000)))
+
+
+def apply(con, migration: Migration, dry_run: bool = False):
+    transactional = migration.transactional
+    print(f"{migration} ({'transaction' if transactional else 'no transaction'})")
+    operations = Operations(con, transactional, dry_run)
+    if dry_run:
+        migration.module.upgrade(operations)
+        return
+
+    for attempt in range(LOCK_RETRIES + 1):
+        started = time.perf_counter()
+        con.autocommit = not transactional
+        try:
+            if transactional:
+                with con:
+                    migration.module.upgrade(operations)
+                    _record(con, migration, started)
+            else:
+                migration.module.upgrade(operations)
+                _record(con, migration, started)
+            break
+        except errors.LockNotAvailable:
+            if not transactional or attempt == LOCK_RETRIES:
+                raise
+            print(f"    lock timeout, retrying the migration ({attempt + 1}/{LOCK_RETRIES})")
+            time.sleep(2 ** attempt)
+        finally:
+            con.autocommit = True
+    print(f"    done in {time.perf_counter() - started:.1f}s")
+
+
+def connect():
+    con = get_connection()
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute("SET lock_timeout = %s;", (LOCK_TIMEOUT,))
+    ensure_tracking_table(con)
+    return con
+
+
+def status(args):
+    con = connect()
+    applied = applied_migrations(con)
+    for migration in load_migrations():
+        if migration.version in applied:
+            name, checksum, applied_at = applied[migration.version]
+            changed = "  (file changed since it was applied)" if checksum != migration.checksum else ""
+            print(f"{migration}  applied {applied_at:%Y-%m-%d %H:%M}{changed}")
+        else:
+            print(f"{migration}  pending")
+    con.close()
+
+
+def up(args):
+    con = connect()
+    with con.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s);", (MIGRATION_LOCK,))
+        if not cursor.fetchone()[0]:
+            sys.exit("Another migrate.py is running")
+    try:
+        applied = applied_migrations(con)
+        migrations = load_migrations()
+        for migration in migrations:
+            if migration.version in applied and applied[migration.version][1] != migration.checksum:
+                print(f"Warning: {migration} was changed after it was applied, the change won't run")
+        pending = [migration for migration in migrations
+                   if migration.version not in applied and (args.to is None or migration.version <= args.to)]
+        if not pending:
+            print("Nothing to migrate")
+        if args.dry_run and pending:
+            print("Dry run, nothing is changed. Planned statements:")
+        for migration in pending:
+            apply(con, migration, args.dry_run)
+    finally:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK,))
+        con.close()
+
+
+def new(args):
+    name = re.sub(r"\W+", "_", args.name.strip().lower()).strip("_")
+    migrations = load_migrations()
+    version = migrations[-1].version + 1 if migrations else 1
+    path = os.path.join(MIGRATIONS_DIR, f"{version:04d}_{name}.py")
+    with open(path, "x") as file:
+        file.write(TEMPLATE.format(description=args.name.strip()))
+    print(f"Created {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_status = subparsers.add_parser("status", help="applied and pending migrations")
+    parser_status.set_defaults(func=status)
+
+    parser_up = subparsers.add_parser("up", help="apply the pending migrations")
+    parser_up.add_argument("--to", type=int, help="stop after this version")
+    parser_up.add_argument("--dry-run", action="store_true", help="print the statements instead of running them")
+    parser_up.set_defaults(func=up)
+
+    parser_new = subparsers.add_parser("new", help="create the next migration file")
+    parser_new.add_argument("name")
+    parser_new.set_defaults(func=new)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,501 @@
+"""
+The schema as it was when migrations were introduced (db_setup.create_tables back then), frozen: later
+changes are migrations of their own. It only creates what doesn't exist yet, so on a database that was
+set up with db_setup.py this just records the baseline. Indexes are built concurrently, search_vector
+is filled in by 0003_backfill_search_vector
+"""
+
+from db_setup import create_partitions
+
+TRANSACTIONAL = False
+
+TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id SERIAL PRIMARY KEY,
+        email VARCHAR(100) UNIQUE NOT NULL,
+        password_hash VARCHAR(255) NOT NULL,
+        first_name VARCHAR(50) NOT NULL,
+        last_name VARCHAR(50) NOT NULL,
+        phone VARCHAR(15),
+        user_type varchar(50) NOT NULL,
+        role VARCHAR(20) NOT NULL CHECK (role IN ('buyer', 'seller', 'admin', 'agent')),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS realtor_agencies (
+        agency_id SERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        license_number VARCHAR(100) UNIQUE NOT NULL,
+        description TEXT,
+        phone VARCHAR(15),
+        email VARCHAR(100),
+        address VARCHAR(255),
+        city VARCHAR(50),
+        postal_code VARCHAR(50),
+        website VARCHAR(100),
+        created_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS realtor_agent (
+        agent_id SERIAL PRIMARY KEY,
+        agency_id INTEGER REFERENCES realtor_agencies(agency_id),
+        user_id INTEGER REFERENCES users(user_id),
+        bio VARCHAR(200),
+        profile_image_url VARCHAR(500),
+        years_experience INTEGER,
+        created_at TIMESTAMP DEFAULT now(),
+        updated_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS listing_categories (
+        category_id SERIAL PRIMARY KEY,
+        name VARCHAR(100) NOT NULL UNIQUE,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS house_listing (
+        listing_id SERIAL PRIMARY KEY,
+        agent_id INTEGER REFERENCES realtor_agent(agent_id),
+        category_id INTEGER REFERENCES listing_categories(category_id),
+        user_id INTEGER REFERENCES users(user_id),
+        title VARCHAR(50) NOT NULL,
+        description TEXT NOT NULL,
+        price DECIMAL NOT NULL,
+        address VARCHAR(255) NOT NULL,
+        city VARCHAR(100) NOT NULL,
+        postal_code VARCHAR(10) NOT NULL,
+        rooms DECIMAL,
+        size_sqm DECIMAL,
+        plot_size_sqm DECIMAL,
+        year_built INTEGER,
+        floor INTEGER,
+        balcony BOOLEAN,
+        monthly_fee DECIMAL,
+        operating_cost DECIMAL,
+        latitude DECIMAL,
+        longitude DECIMAL,
+        status VARCHAR(50) DEFAULT 'active',
+        published_at TIMESTAMP,
+        sold_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT now(),
+        updated_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    "ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS search_vector tsvector;",
+    "ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS external_ref VARCHAR(100);",
+    "ALTER TABLE house_listing ADD COLUMN IF NOT EXISTS highest_bid DECIMAL;",
+    """
+    CREATE TABLE IF NOT EXISTS listing_images (
+        image_id SERIAL PRIMARY KEY,
+        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+        image_url VARCHAR(500) NOT NULL,
+        display_order INTEGER,
+        is_primary BOOLEAN DEFAULT false,
+        caption VARCHAR(255),
+        created_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    "ALTER TABLE listing_images ADD COLUMN IF NOT EXISTS external_ref VARCHAR(100);",
+    """
+    CREATE TABLE IF NOT EXISTS bids (
+        bid_id SERIAL PRIMARY KEY,
+        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+        user_id INTEGER REFERENCES users(user_id),
+        amount DECIMAL NOT NULL,
+        bid_date TIMESTAMP DEFAULT now(),
+        status VARCHAR(20) NOT NULL,
+        comment TEXT,
+        created_at TIMESTAMP DEFAULT now(),
+        updated_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS favorites (
+        favorite_id SERIAL PRIMARY KEY,
+        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+        user_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE,
+        created_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS agent_reviews (
+        review_id SERIAL PRIMARY KEY,
+        agent_id INTEGER REFERENCES realtor_agent(agent_id) ON DELETE CASCADE,
+        user_id INTEGER REFERENCES users(user_id),
+        rating INTEGER NOT NULL CHECK (rating BETWEEN 1 AND 5),
+        comment TEXT,
+        transaction VARCHAR(20),
+        created_at TIMESTAMP DEFAULT now(),
+        updated_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS viewing_booking (
+        viewing_id SERIAL PRIMARY KEY,
+        listing_id INTEGER REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+        user_id INTEGER REFERENCES users(user_id),
+        viewing_date date NOT NULL,
+        viewing_time TIMESTAMP NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        notes TEXT,
+        created_at TIMESTAMP DEFAULT now(),
+        updated_at TIMESTAMP DEFAULT now()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS listing_summary (
+        listing_id INTEGER PRIMARY KEY REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+        category_id INTEGER,
+        title VARCHAR(50) NOT NULL,
+        price DECIMAL NOT NULL,
+        address VARCHAR(255) NOT NULL,
+        city VARCHAR(100) NOT NULL,
+        rooms DECIMAL,
+        size_sqm DECIMAL,
+        status VARCHAR(50),
+        created_at TIMESTAMP,
+        primary_image_url VARCHAR(500),
+        bid_count INTEGER NOT NULL DEFAULT 0,
+        highest_bid DECIMAL,
+        favorite_count INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    "ALTER TABLE listing_summary ADD COLUMN IF NOT EXISTS changed_at TIMESTAMP NOT NULL DEFAULT now();",
+    "ALTER TABLE listing_summary ADD COLUMN IF NOT EXISTS images_changed_at TIMESTAMP NOT NULL DEFAULT now();",
+    """
+    CREATE TABLE IF NOT EXISTS saved_searches (
+        search_id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+        name VARCHAR(100),
+        city VARCHAR(100),
+        category_id INTEGER REFERENCES listing_categories(category_id) ON DELETE CASCADE,
+        min_price DECIMAL,
+        max_price DECIMAL,
+        is_active BOOLEAN NOT NULL DEFAULT true,
+        created_at TIMESTAMP DEFAULT now(),
+        city_key VARCHAR(100) GENERATED ALWAYS AS (coalesce(lower(city), '')) STORED,
+        category_key INTEGER GENERATED ALWAYS AS (coalesce(category_id, 0)) STORED,
+        price_range NUMRANGE GENERATED ALWAYS AS (numrange(min_price, max_price, '[]')) STORED,
+        CHECK (min_price IS NULL OR max_price IS NULL OR min_price <= max_price)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS saved_search_matches (
+        match_id BIGSERIAL PRIMARY KEY,
+        search_id INTEGER NOT NULL REFERENCES saved_searches(search_id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+        listing_id INTEGER NOT NULL REFERENCES house_listing(listing_id) ON DELETE CASCADE,
+        reason VARCHAR(20) NOT NULL CHECK (reason IN ('new', 'updated')),
+        created_at TIMESTAMP DEFAULT now(),
+        delivered_at TIMESTAMP,
+        UNIQUE (search_id, listing_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS listing_price_history (
+        listing_id INTEGER NOT NULL,
+        change VARCHAR(10) NOT NULL CHECK (change IN ('created', 'price', 'status')),
+        price DECIMAL NOT NULL,
+        status VARCHAR(50),
+        city VARCHAR(100) NOT NULL,
+        category_id INTEGER,
+        size_sqm DECIMAL,
+        changed_at TIMESTAMP NOT NULL DEFAULT now()
+    ) PARTITION BY RANGE (changed_at);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS price_rollup_monthly (
+        city VARCHAR(100) NOT NULL,
+        category_id INTEGER NOT NULL,
+        month DATE NOT NULL,
+        listings INTEGER NOT NULL,
+        median_price_per_sqm DECIMAL,
+        refreshed_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (city, category_id, month)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS price_rollup_dirty (
+        month DATE NOT NULL,
+        city VARCHAR(100) NOT NULL,
+        category_id INTEGER NOT NULL,
+        PRIMARY KEY (month, city, category_id)
+    );
+    """,
+]
+
+EXTENSIONS = ["pg_trgm", "cube", "earthdistance", "btree_gist"]
+
+# name, table, definition, unique
+INDEXES = [
+    ("idx_users_email", "users", "(email)", False),
+    ("idx_users_role", "users", "(role)", False),
+    ("idx_realtor_agencies_city", "realtor_agencies", "(city)", False),
+    ("idx_realtor_agent_user", "realtor_agent", "(user_id)", False),
+    ("idx_categories_name", "listing_categories", "(name)", False),
+    ("idx_listing_city", "house_listing", "(city)", False),
+    ("idx_listing_city_trgm", "house_listing", "USING gin (city gin_trgm_ops)", False),
+    ("idx_listing_city_lower", "house_listing", "(lower(city) text_pattern_ops)", False),
+    ("idx_listing_price", "house_listing", "(price)", False),
+    ("idx_listing_category", "house_listing", "(category_id)", False),
+    ("idx_listing_status", "house_listing", "(status)", False),
+    ("idx_listing_created_id", "house_listing", "(created_at DESC, listing_id DESC)", False),
+    ("idx_listing_search", "house_listing", "USING gin (search_vector)", False),
+    ("uq_listing_external_ref", "house_listing", "(external_ref)", True),
+    ("idx_listing_earth", "house_listing", "USING gist (ll_to_earth(latitude::float8, longitude::float8))", False),
+    ("idx_listing_point", "house_listing", "USING gist (point(longitude::float8, latitude::float8))", False),
+    ("idx_images_listing", "listing_images", "(listing_id)", False),
+    ("uq_images_external_ref", "listing_images", "(external_ref)", True),
+    ("idx_bids_listing", "bids", "(listing_id)", False),
+    ("idx_bids_user", "bids", "(user_id)", False),
+    ("idx_bids_date", "bids", "(bid_date)", False),
+    ("uq_favorites_user_listing", "favorites", "(user_id, listing_id)", True),
+    ("idx_favorites_listing", "favorites", "(listing_id)", False),
+    ("idx_reviews_agent", "agent_reviews", "(agent_id)", False),
+    ("idx_viewing_listing", "viewing_booking", "(listing_id)", False),
+    ("idx_viewing_user", "viewing_booking", "(user_id)", False),
+    ("idx_viewing_time", "viewing_booking", "(viewing_time)", False),
+    ("idx_summary_created_id", "listing_summary", "(created_at DESC, listing_id DESC)", False),
+    ("idx_summary_city_trgm", "listing_summary", "USING gin (city gin_trgm_ops)", False),
+    ("idx_summary_city_lower", "listing_summary", "(lower(city) text_pattern_ops)", False),
+    ("idx_summary_price", "listing_summary", "(price)", False),
+    ("idx_summary_category", "listing_summary", "(category_id)", False),
+    ("idx_saved_search_user", "saved_searches", "(user_id)", False),
+    ("idx_saved_search_match", "saved_searches", "USING gist (category_key, city_key, price_range) WHERE is_active", False),
+    ("idx_saved_search_matches_user", "saved_search_matches", "(user_id, match_id DESC)", False),
+    ("idx_saved_search_matches_pending", "saved_search_matches", "(match_id) WHERE delivered_at IS NULL", False),
+    ("idx_saved_search_matches_listing", "saved_search_matches", "(listing_id)", False),
+    ("idx_price_history_listing", "listing_price_history", "(listing_id, changed_at)", False),
+    ("idx_price_history_changed_city", "listing_price_history", "(changed_at, city)", False),
+    ("idx_price_rollup_city_lower", "price_rollup_monthly", "(lower(city), category_id, month)", False),
+]
+
+FUNCTIONS = {
+    "listing_summary_upsert_listings": """
+        CREATE FUNCTION listing_summary_upsert_listings() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO listing_summary (listing_id, category_id, title, price, address, city,
+                                             rooms, size_sqm, status, created_at)
+                SELECT listing_id, category_id, title, price, address, city, rooms, size_sqm, status, created_at
+                FROM new_listings
+                ON CONFLICT (listing_id) DO NOTHING;
+            ELSE
+                UPDATE listing_summary s
+                SET category_id = n.category_id, title = n.title, price = n.price, address = n.address,
+                    city = n.city, rooms = n.rooms, size_sqm = n.size_sqm, status = n.status,
+                    created_at = n.created_at, changed_at = now()
+                FROM new_listings n JOIN old_listings o USING (listing_id)
+                WHERE s.listing_id = n.listing_id
+                  AND (o.category_id, o.title, o.price, o.address, o.city, o.rooms, o.size_sqm, o.status, o.created_at)
+                      IS DISTINCT FROM
+                      (n.category_id, n.title, n.price, n.address, n.city, n.rooms, n.size_sqm, n.status, n.created_at);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    "listing_summary_bids": """
+        CREATE FUNCTION listing_summary_bids() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE listing_summary s
+                SET bid_count = s.bid_count + n.bids, highest_bid = greatest(s.highest_bid, n.highest_bid),
+                    changed_at = now()
+                FROM (SELECT listing_id, count(*) AS bids, max(amount) AS highest_bid
+                      FROM new_bids GROUP BY listing_id) n
+                WHERE s.listing_id = n.listing_id;
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'UPDATE' THEN
+                UPDATE listing_summary s
+                SET (bid_count, highest_bid) = (SELECT count(*), max(b.amount) FROM bids b WHERE b.listing_id = s.listing_id),
+                    changed_at = now()
+                WHERE s.listing_id IN (
+                    SELECT o.listing_id FROM old_bids o JOIN new_bids n USING (bid_id)
+                    WHERE o.amount IS DISTINCT FROM n.amount OR o.listing_id IS DISTINCT FROM n.listing_id
+                    UNION
+                    SELECT n.listing_id FROM old_bids o JOIN new_bids n USING (bid_id)
+                    WHERE o.listing_id IS DISTINCT FROM n.listing_id
+                );
+            ELSE
+                UPDATE listing_summary s
+                SET (bid_count, highest_bid) = (SELECT count(*), max(b.amount) FROM bids b WHERE b.listing_id = s.listing_id),
+                    changed_at = now()
+                WHERE s.listing_id IN (SELECT listing_id FROM old_bids);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    "listing_summary_favorites": """
+        CREATE FUNCTION listing_summary_favorites() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE listing_summary s SET favorite_count = s.favorite_count + n.favorites, changed_at = now()
+                FROM (SELECT listing_id, count(*) AS favorites FROM new_favorites GROUP BY listing_id) n
+                WHERE s.listing_id = n.listing_id;
+            ELSE
+                UPDATE listing_summary s SET favorite_count = greatest(s.favorite_count - o.favorites, 0), changed_at = now()
+                FROM (SELECT listing_id, count(*) AS favorites FROM old_favorites GROUP BY listing_id) o
+                WHERE s.listing_id = o.listing_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    "listing_summary_images": """
+        CREATE FUNCTION listing_summary_images() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE listing_summary s SET primary_image_url = (
+                    SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                    ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                    changed_at = now(), images_changed_at = now()
+                WHERE s.listing_id IN (SELECT listing_id FROM new_images);
+            ELSIF TG_OP = 'UPDATE' THEN
+                UPDATE listing_summary s SET primary_image_url = (
+                    SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                    ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                    changed_at = now(), images_changed_at = now()
+                WHERE s.listing_id IN (SELECT listing_id FROM new_images UNION SELECT listing_id FROM old_images);
+            ELSE
+                UPDATE listing_summary s SET primary_image_url = (
+                    SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                    ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                    changed_at = now(), images_changed_at = now()
+                WHERE s.listing_id IN (SELECT listing_id FROM old_images);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    "listing_price_history_append_only": """
+        CREATE FUNCTION listing_price_history_append_only() RETURNS trigger AS $$
+        BEGIN
+            RAISE EXCEPTION 'listing_price_history is append-only';
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    "record_listing_price_history": """
+        CREATE FUNCTION record_listing_price_history() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO listing_price_history (listing_id, change, price, status, city, category_id, size_sqm, changed_at)
+                SELECT listing_id, 'created', price, status, city, category_id, size_sqm, coalesce(created_at, now())
+                FROM new_listings;
+            ELSE
+                INSERT INTO listing_price_history (listing_id, change, price, status, city, category_id, size_sqm, changed_at)
+                SELECT n.listing_id, CASE WHEN o.price IS DISTINCT FROM n.price THEN 'price' ELSE 'status' END,
+                       n.price, n.status, n.city, n.category_id, n.size_sqm, now()
+                FROM new_listings n JOIN old_listings o USING (listing_id)
+                WHERE (o.price, o.status) IS DISTINCT FROM (n.price, n.status);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    "mark_price_rollups_dirty": """
+        CREATE FUNCTION mark_price_rollups_dirty() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO price_rollup_dirty (month, city, category_id)
+            SELECT DISTINCT date_trunc('month', h.changed_at)::date, g.city, g.category_id
+            FROM new_history h
+            CROSS JOIN LATERAL (VALUES (h.city, coalesce(h.category_id, -1)), (h.city, 0),
+                                       ('', coalesce(h.category_id, -1)), ('', 0)) g(city, category_id)
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+}
+
+# name, timing, table, referencing, function. Statement level, transition tables need one trigger per event
+TRIGGERS = [
+    ("trg_summary_listings_insert", "AFTER INSERT", "house_listing", "NEW TABLE AS new_listings", "listing_summary_upsert_listings"),
+    ("trg_summary_listings_update", "AFTER UPDATE", "house_listing", "NEW TABLE AS new_listings OLD TABLE AS old_listings", "listing_summary_upsert_listings"),
+    ("trg_summary_bids_insert", "AFTER INSERT", "bids", "NEW TABLE AS new_bids", "listing_summary_bids"),
+    ("trg_summary_bids_update", "AFTER UPDATE", "bids", "NEW TABLE AS new_bids OLD TABLE AS old_bids", "listing_summary_bids"),
+    ("trg_summary_bids_delete", "AFTER DELETE", "bids", "OLD TABLE AS old_bids", "listing_summary_bids"),
+    ("trg_summary_favorites_insert", "AFTER INSERT", "favorites", "NEW TABLE AS new_favorites", "listing_summary_favorites"),
+    ("trg_summary_favorites_delete", "AFTER DELETE", "favorites", "OLD TABLE AS old_favorites", "listing_summary_favorites"),
+    ("trg_summary_images_insert", "AFTER INSERT", "listing_images", "NEW TABLE AS new_images", "listing_summary_images"),
+    ("trg_summary_images_update", "AFTER UPDATE", "listing_images", "NEW TABLE AS new_images OLD TABLE AS old_images", "listing_summary_images"),
+    ("trg_summary_images_delete", "AFTER DELETE", "listing_images", "OLD TABLE AS old_images", "listing_summary_images"),
+    ("trg_price_history_append_only", "BEFORE UPDATE OR DELETE", "listing_price_history", None, "listing_price_history_append_only"),
+    ("trg_price_history_insert", "AFTER INSERT", "house_listing", "NEW TABLE AS new_listings", "record_listing_price_history"),
+    ("trg_price_history_update", "AFTER UPDATE", "house_listing", "NEW TABLE AS new_listings OLD TABLE AS old_listings", "record_listing_price_history"),
+    ("trg_price_rollup_dirty", "AFTER INSERT", "listing_price_history", "NEW TABLE AS new_history", "mark_price_rollups_dirty"),
+]
+
+
+def is_partitioned(m, table: str) -> bool:
+    return bool(m.query("SELECT 1 FROM pg_class WHERE oid = to_regclass(%s) AND relkind = 'p';", (table,)))
+
+
+def create_history_partitions(cursor):
+    """From the oldest listing on, the existing listings are added below"""
+    cursor.execute("SELECT coalesce(min(created_at), now())::date FROM house_listing;")
+    create_partitions(cursor, "listing_price_history", "changed_at", start=cursor.fetchone()[0])
+
+
+def upgrade(m):
+    for extension in EXTENSIONS:
+        m.execute(f"CREATE EXTENSION IF NOT EXISTS {extension};")
+    for statement in TABLES:
+        m.execute(statement)
+
+    # bids and viewing_booking when db_setup.py --partitioned created them, the history always
+    for table, column in (("bids", "bid_date"), ("viewing_booking", "viewing_time")):
+        if is_partitioned(m, table):
+            m.run(create_partitions, table, column)
+    m.run(create_history_partitions)
+
+    for name, table, definition, unique in INDEXES:
+        m.create_index_concurrently(name, table, definition, unique)
+
+    for name, statement in FUNCTIONS.items():
+        if not m.query("SELECT 1 FROM pg_proc WHERE proname = %s;", (name,)):
+            m.execute(statement)
+    for name, timing, table, referencing, function in TRIGGERS:
+        if not m.query("SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = to_regclass(%s);", (name, table)):
+            m.execute(f"""
+                CREATE TRIGGER {name} {timing} ON {table}
+                {f"REFERENCING {referencing}" if referencing else ""}
+                FOR EACH STATEMENT EXECUTE FUNCTION {function}();
+            """)
+
+    # Listings that existed before the triggers
+    m.execute("""
+        INSERT INTO listing_summary (listing_id, category_id, title, price, address, city, rooms, size_sqm,
+                                     status, created_at, primary_image_url, bid_count, highest_bid, favorite_count)
+        SELECT h.listing_id, h.category_id, h.title, h.price, h.address, h.city, h.rooms, h.size_sqm,
+               h.status, h.created_at, img.image_url, coalesce(b.bid_count, 0), b.highest_bid,
+               coalesce(f.favorite_count, 0)
+        FROM house_listing h
+        LEFT JOIN LATERAL (
+            SELECT i.image_url FROM listing_images i WHERE i.listing_id = h.listing_id
+            ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1
+        ) img ON true
+        LEFT JOIN (SELECT listing_id, count(*) AS bid_count, max(amount) AS highest_bid
+                   FROM bids GROUP BY listing_id) b ON b.listing_id = h.listing_id
+        LEFT JOIN (SELECT listing_id, count(*) AS favorite_count
+                   FROM favorites GROUP BY listing_id) f ON f.listing_id = h.listing_id
+        WHERE NOT EXISTS (SELECT 1 FROM listing_summary s WHERE s.listing_id = h.listing_id)
+        ON CONFLICT (listing_id) DO NOTHING;
+    """)
+    # Listings that existed before the history, their current price as of their creation
+    m.execute("""
+        INSERT INTO listing_price_history (listing_id, change, price, status, city, category_id, size_sqm, changed_at)
+        SELECT listing_id, 'created', price, status, city, category_id, size_sqm, coalesce(created_at, now())
+        FROM house_listing
+        WHERE NOT EXISTS (SELECT 1 FROM listing_price_history);
+    """)
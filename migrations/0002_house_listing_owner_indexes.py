@@ -0,0 +1,11 @@
+"""
+Indexes on the house_listing foreign keys to users and realtor_agent. Without them deleting a user
+or an agent checks the reference by scanning every listing
+"""
+
+TRANSACTIONAL = False
+
+
+def upgrade(m):
+    m.create_index_concurrently("idx_listing_user", "house_listing", "(user_id)")
+    m.create_index_concurrently("idx_listing_agent", "house_listing", "(agent_id)")
@@ -0,0 +1,10 @@
+"""search_vector for listings loaded without it, e.g with datagen.py --skip-search"""
+
+from db import SEARCH_VECTOR_SQL
+
+TRANSACTIONAL = False
+
+
+def upgrade(m):
+    m.backfill("house_listing", "search_vector = " + SEARCH_VECTOR_SQL.format(title="title", description="description"),
+               where="search_vector IS NULL", key="listing_id", batch_size=2000)
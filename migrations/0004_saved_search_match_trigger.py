@@ -0,0 +1,55 @@
+"""
+Saved searches are matched by triggers on house_listing instead of in db.create_listing / db.update_listing,
+so async writes, bulk imports and COPY add their matches to saved_search_matches too
+"""
+
+# (search_id, user_id, listing_id) of the active saved searches the listings match, format with a table or subquery
+MATCH_SQL = """
+    SELECT DISTINCT s.search_id, s.user_id, l.listing_id
+    FROM {listings} l
+    CROSS JOIN LATERAL (VALUES (0, ''), (0, lower(l.city)), (coalesce(l.category_id, 0), ''),
+                               (coalesce(l.category_id, 0), lower(l.city))) b(category_key, city_key)
+    JOIN saved_searches s ON s.is_active AND s.category_key = b.category_key AND s.city_key = b.city_key
+                         AND s.price_range @> l.price::numeric
+    WHERE l.status = 'active'
+"""
+CHANGED = "(SELECT * FROM {table} WHERE listing_id IN (SELECT listing_id FROM changed))"
+
+
+def upgrade(m):
+    m.execute(f"""
+        CREATE OR REPLACE FUNCTION match_saved_searches() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO saved_search_matches (search_id, user_id, listing_id, reason)
+                SELECT search_id, user_id, listing_id, 'new'
+                FROM ({MATCH_SQL.format(listings="new_listings")}) matching
+                ON CONFLICT (search_id, listing_id) DO NOTHING;
+            ELSE
+                WITH changed AS (
+                    SELECT n.listing_id FROM new_listings n JOIN old_listings o USING (listing_id)
+                    WHERE (o.price, o.status, o.city, o.category_id)
+                          IS DISTINCT FROM (n.price, n.status, n.city, n.category_id)
+                )
+                INSERT INTO saved_search_matches (search_id, user_id, listing_id, reason)
+                SELECT search_id, user_id, listing_id, 'updated'
+                FROM ({MATCH_SQL.format(listings=CHANGED.format(table="new_listings"))}
+                      EXCEPT
+                      {MATCH_SQL.format(listings=CHANGED.format(table="old_listings"))}) matching
+                ON CONFLICT (search_id, listing_id) DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    triggers = [
+        ("trg_saved_search_match_insert", "INSERT", "NEW TABLE AS new_listings"),
+        ("trg_saved_search_match_update", "UPDATE", "NEW TABLE AS new_listings OLD TABLE AS old_listings"),
+    ]
+    for name, event, referencing in triggers:
+        m.execute(f"DROP TRIGGER IF EXISTS {name} ON house_listing;")
+        m.execute(f"""
+            CREATE TRIGGER {name} AFTER {event} ON house_listing
+            REFERENCING {referencing}
+            FOR EACH STATEMENT EXECUTE FUNCTION match_saved_searches();
+        """)
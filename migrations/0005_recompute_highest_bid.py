@@ -0,0 +1,45 @@
+"""
+house_listing.highest_bid is recomputed from the bids that aren't rejected when bids are rejected (or accepted
+again), change amount or are deleted, and the listing's updated_at (its version) is bumped with it
+"""
+
+
+def upgrade(m):
+    m.execute("""
+        CREATE OR REPLACE FUNCTION recompute_highest_bid() RETURNS trigger AS $$
+        DECLARE
+            listings INTEGER[];
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                SELECT array_agg(DISTINCT changed.listing_id) INTO listings
+                FROM old_bids o JOIN new_bids n USING (bid_id)
+                CROSS JOIN LATERAL (VALUES (o.listing_id), (n.listing_id)) changed(listing_id)
+                WHERE (o.status, o.amount, o.listing_id) IS DISTINCT FROM (n.status, n.amount, n.listing_id);
+            ELSE
+                SELECT array_agg(DISTINCT listing_id) INTO listings FROM old_bids;
+            END IF;
+            IF listings IS NULL THEN
+                RETURN NULL;
+            END IF;
+            PERFORM 1 FROM house_listing WHERE listing_id = ANY(listings) ORDER BY listing_id FOR UPDATE;
+            UPDATE house_listing h SET highest_bid = b.highest_bid, updated_at = clock_timestamp()
+            FROM (SELECT l.listing_id,
+                         (SELECT max(amount) FROM bids
+                          WHERE bids.listing_id = l.listing_id AND status <> 'rejected') AS highest_bid
+                  FROM unnest(listings) l(listing_id)) b
+            WHERE h.listing_id = b.listing_id AND h.highest_bid IS DISTINCT FROM b.highest_bid;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    triggers = [
+        ("trg_highest_bid_update", "UPDATE", "NEW TABLE AS new_bids OLD TABLE AS old_bids"),
+        ("trg_highest_bid_delete", "DELETE", "OLD TABLE AS old_bids"),
+    ]
+    for name, event, referencing in triggers:
+        m.execute(f"DROP TRIGGER IF EXISTS {name} ON bids;")
+        m.execute(f"""
+            CREATE TRIGGER {name} AFTER {event} ON bids
+            REFERENCING {referencing}
+            FOR EACH STATEMENT EXECUTE FUNCTION recompute_highest_bid();
+        """)
@@ -0,0 +1,11 @@
+"""house_listing.highest_bid without the rejected bids, it used to count every bid"""
+
+TRANSACTIONAL = False
+
+HIGHEST_BID = ("(SELECT max(b.amount) FROM bids b "
+               "WHERE b.listing_id = house_listing.listing_id AND b.status <> 'rejected')")
+
+
+def upgrade(m):
+    m.backfill("house_listing", f"highest_bid = {HIGHEST_BID}, updated_at = clock_timestamp()",
+               where=f"highest_bid IS DISTINCT FROM {HIGHEST_BID}", key="listing_id")
@@ -0,0 +1,121 @@
+"""
+listing_summary versions are stamped with clock_timestamp() instead of now() (the start of the transaction,
+a long transaction committing after a short one stamped an older version), and its highest_bid leaves out
+rejected bids like house_listing.highest_bid. The triggers stay, only their functions are replaced
+"""
+
+FUNCTIONS = [
+    """
+        CREATE OR REPLACE FUNCTION listing_summary_upsert_listings() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO listing_summary (listing_id, category_id, title, price, address, city,
+                                             rooms, size_sqm, status, created_at)
+                SELECT listing_id, category_id, title, price, address, city, rooms, size_sqm, status, created_at
+                FROM new_listings
+                ON CONFLICT (listing_id) DO NOTHING;
+            ELSE
+                -- Only listings where one of the copied columns changed (not e.g search_vector)
+                UPDATE listing_summary s
+                SET category_id = n.category_id, title = n.title, price = n.price, address = n.address,
+                    city = n.city, rooms = n.rooms, size_sqm = n.size_sqm, status = n.status,
+                    created_at = n.created_at, changed_at = clock_timestamp()
+                FROM new_listings n JOIN old_listings o USING (listing_id)
+                WHERE s.listing_id = n.listing_id
+                  AND (o.category_id, o.title, o.price, o.address, o.city, o.rooms, o.size_sqm, o.status, o.created_at)
+                      IS DISTINCT FROM
+                      (n.category_id, n.title, n.price, n.address, n.city, n.rooms, n.size_sqm, n.status, n.created_at);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    """
+        CREATE OR REPLACE FUNCTION listing_summary_bids() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE listing_summary s
+                SET bid_count = s.bid_count + n.bids, highest_bid = greatest(s.highest_bid, n.highest_bid),
+                    changed_at = clock_timestamp()
+                FROM (SELECT listing_id, count(*) AS bids,
+                             max(amount) FILTER (WHERE status <> 'rejected') AS highest_bid
+                      FROM new_bids GROUP BY listing_id) n
+                WHERE s.listing_id = n.listing_id;
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'UPDATE' THEN
+                -- Most updates only change the status, those only affect the summary to or from 'rejected'
+                UPDATE listing_summary s
+                SET (bid_count, highest_bid) = (SELECT count(*), max(b.amount) FILTER (WHERE b.status <> 'rejected')
+                                                FROM bids b WHERE b.listing_id = s.listing_id),
+                    changed_at = clock_timestamp()
+                WHERE s.listing_id IN (
+                    SELECT o.listing_id FROM old_bids o JOIN new_bids n USING (bid_id)
+                    WHERE o.amount IS DISTINCT FROM n.amount OR o.listing_id IS DISTINCT FROM n.listing_id
+                       OR (o.status = 'rejected') IS DISTINCT FROM (n.status = 'rejected')
+                    UNION
+                    SELECT n.listing_id FROM old_bids o JOIN new_bids n USING (bid_id)
+                    WHERE o.listing_id IS DISTINCT FROM n.listing_id
+                );
+            ELSE
+                UPDATE listing_summary s
+                SET (bid_count, highest_bid) = (SELECT count(*), max(b.amount) FILTER (WHERE b.status <> 'rejected')
+                                                FROM bids b WHERE b.listing_id = s.listing_id),
+                    changed_at = clock_timestamp()
+                WHERE s.listing_id IN (SELECT listing_id FROM old_bids);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    """
+        CREATE OR REPLACE FUNCTION listing_summary_favorites() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE listing_summary s SET favorite_count = s.favorite_count + n.favorites, changed_at = clock_timestamp()
+                FROM (SELECT listing_id, count(*) AS favorites FROM new_favorites GROUP BY listing_id) n
+                WHERE s.listing_id = n.listing_id;
+            ELSE
+                UPDATE listing_summary s SET favorite_count = greatest(s.favorite_count - o.favorites, 0), changed_at = clock_timestamp()
+                FROM (SELECT listing_id, count(*) AS favorites FROM old_favorites GROUP BY listing_id) o
+                WHERE s.listing_id = o.listing_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+    """
+        CREATE OR REPLACE FUNCTION listing_summary_images() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE listing_summary s SET primary_image_url = (
+                    SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                    ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                    changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+                WHERE s.listing_id IN (SELECT listing_id FROM new_images);
+            ELSIF TG_OP = 'UPDATE' THEN
+                UPDATE listing_summary s SET primary_image_url = (
+                    SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                    ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                    changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+                WHERE s.listing_id IN (SELECT listing_id FROM new_images UNION SELECT listing_id FROM old_images);
+            ELSE
+                UPDATE listing_summary s SET primary_image_url = (
+                    SELECT i.image_url FROM listing_images i WHERE i.listing_id = s.listing_id
+                    ORDER BY i.is_primary DESC NULLS LAST, i.display_order NULLS LAST, i.image_id LIMIT 1),
+                    changed_at = clock_timestamp(), images_changed_at = clock_timestamp()
+                WHERE s.listing_id IN (SELECT listing_id FROM old_images);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """,
+]
+
+
+def upgrade(m):
+    m.execute("ALTER TABLE listing_summary ALTER COLUMN changed_at SET DEFAULT clock_timestamp();")
+    m.execute("ALTER TABLE listing_summary ALTER COLUMN images_changed_at SET DEFAULT clock_timestamp();")
+    for statement in FUNCTIONS:
+        m.execute(statement)
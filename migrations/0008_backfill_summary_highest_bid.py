@@ -0,0 +1,11 @@
+"""listing_summary.highest_bid without the rejected bids, it used to count every bid"""
+
+TRANSACTIONAL = False
+
+HIGHEST_BID = ("(SELECT max(b.amount) FROM bids b "
+               "WHERE b.listing_id = listing_summary.listing_id AND b.status <> 'rejected')")
+
+
+def upgrade(m):
+    m.backfill("listing_summary", f"highest_bid = {HIGHEST_BID}, changed_at = clock_timestamp()",
+               where=f"highest_bid IS DISTINCT FROM {HIGHEST_BID}", key="listing_id")
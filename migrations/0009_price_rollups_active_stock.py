@@ -0,0 +1,44 @@
+"""
+price_rollup_monthly holds the median price per sqm of the active stock at the end of each month, grouped on
+lower(city). History marks the months it changes in price_rollup_dirty_months (replacing the groups in
+price_rollup_dirty), and price_rollup_stock carries each month's stock forward to the next
+"""
+
+from db_setup import refresh_price_rollups
+
+TRANSACTIONAL = False
+
+
+def upgrade(m):
+    m.execute("""
+        CREATE TABLE IF NOT EXISTS price_rollup_dirty_months (
+            month DATE PRIMARY KEY
+        );
+    """)
+    m.execute("""
+        CREATE TABLE IF NOT EXISTS price_rollup_stock (
+            month DATE NOT NULL,
+            listing_id INTEGER NOT NULL,
+            city VARCHAR(100) NOT NULL,
+            category_id INTEGER NOT NULL,
+            price_per_sqm DECIMAL NOT NULL,
+            PRIMARY KEY (month, listing_id)
+        );
+    """)
+    # A history row changes the month-end stock of its month and every month after it
+    m.execute("""
+        CREATE OR REPLACE FUNCTION mark_price_rollups_dirty() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO price_rollup_dirty_months (month)
+            SELECT generate_series(date_trunc('month', min(h.changed_at)), date_trunc('month', now()), interval '1 month')::date
+            FROM new_history h
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    m.execute("DROP TABLE IF EXISTS price_rollup_dirty;")
+    # The cities are stored lower-cased, the primary key covers the lookups
+    m.drop_index_concurrently("idx_price_rollup_city_lower")
+    # Every month again, the rollups were grouped on the raw city and only counted the listings that changed
+    m.run(refresh_price_rollups, full=True)
@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import deque
+
+from psycopg2 import extensions
+
+"""
+A small thread-safe connection pool for psycopg2.
+
+The api borrows a connection per request and hands it back when the request ends,
+instead of opening (and leaking) a new connection every time someone hits an endpoint.
+
+- Connections are created lazily up to max_size, min_size of them are opened up front
+- getconn() waits up to `timeout` seconds for a free connection and raises PoolTimeout after that
+- A connection that has been idle for a while is pinged with SELECT 1 before it is handed out
+- Connections are recycled after `max_uses` checkouts or `max_lifetime` seconds (0 disables)
+"""
+
+
+class PoolError(Exception):
+    pass
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class _ConnectionInfo:
+    __slots__ = ("created_at", "last_used", "uses")
+
+    def __init__(self):
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+
+class ConnectionPool:
+    def __init__(self, connect, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, max_uses: int = 0, max_lifetime: float = 0.0,
+                 check_idle_after: float = 5.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size, expected 0 <= min_size <= max_size and max_size >= 1")
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_lifetime = max_lifetime
+        self.check_idle_after = check_idle_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._info = {}
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+
+        # statistics
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._failed_checks = 0
+
+    # ---------- lifecycle ----------
+    def open(self):
+        """Opens min_size connections up front so the first requests don't pay for the handshake."""
+        conns = []
+        with self._cond:
+            missing = self.min_size - self._size
+            self._size += max(missing, 0)
+        try:
+            for _ in range(max(missing, 0)):
+                conns.append(self._new_connection())
+        except Exception:
+            with self._cond:
+                self._size -= missing - len(conns)
+                self._cond.notify_all()
+            raise
+        finally:
+            with self._cond:
+                for conn in conns:
+                    self._idle.append(conn)
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            for conn in idle:
+                self._info.pop(id(conn), None)
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    # ---------- checkout / checkin ----------
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        conn = None
+        waited_since = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("Connection pool is closed")
+                if self._idle:
+                    conn = self._idle.pop()  # LIFO, the most recently used connection is the warmest
+                    break
+                if self._size < self.max_size:
+                    self._size += 1  # reserve a slot, the connection is opened outside the lock
+                    break
+                now = time.monotonic()
+                if waited_since is None:
+                    waited_since = now
+                if now >= deadline:
+                    self._timeouts += 1
+                    self._waits += 1
+                    self._wait_time += now - waited_since
+                    raise PoolTimeout(f"No database connection available within {self.timeout}s")
+                self._cond.wait(deadline - now)
+
+            if waited_since is not None:
+                self._waits += 1
+                self._wait_time += time.monotonic() - waited_since
+            self._in_use += 1
+
+        try:
+            if conn is None:
+                conn = self._new_connection()
+            else:
+                conn = self._checked(conn)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        with self._cond:
+            info = self._info.get(id(conn))
+        if info is None:
+            raise PoolError("Connection does not belong to this pool")
+
+        info.uses += 1
+        discard = self._closed or conn.closed or self._expired(info)
+        if not discard:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                # The request left a transaction open (e.g an exception halfway through), don't leak it
+                try:
+                    conn.rollback()
+                except Exception:
+                    discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._info.pop(id(conn), None)
+                self._size -= 1
+                self._recycled += 1
+            else:
+                info.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+        if discard:
+            self._close_quietly(conn)
+
+    # ---------- statistics ----------
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waits": self._waits,
+                "wait_time_ms": round(self._wait_time * 1000, 3),
+                "avg_wait_ms": round(self._wait_time * 1000 / self._waits, 3) if self._waits else 0.0,
+                "timeouts": self._timeouts,
+                "connections_created": self._created,
+                "connections_recycled": self._recycled,
+                "failed_checks": self._failed_checks,
+            }
+
+    # ---------- helpers ----------
+    def _new_connection(self):
+        conn = self._connect()
+        with self._cond:
+            self._info[id(conn)] = _ConnectionInfo()
+            self._created += 1
+        return conn
+
+    def _expired(self, info: _ConnectionInfo) -> bool:
+        if self.max_uses and info.uses >= self.max_uses:
+            return True
+        if self.max_lifetime and time.monotonic() - info.created_at >= self.max_lifetime:
+            return True
+        return False
+
+    def _checked(self, conn):
+        """Returns conn if it is still usable, otherwise replaces it with a fresh connection."""
+        with self._cond:
+            info = self._info[id(conn)]
+        healthy = not conn.closed and not self._expired(info)
+
+        if healthy and time.monotonic() - info.last_used >= self.check_idle_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.rollback()
+            except Exception:
+                healthy = False
+                with self._cond:
+                    self._failed_checks += 1
+
+        if healthy:
+            return conn
+
+        with self._cond:
+            self._info.pop(id(conn), None)
+            self._recycled += 1
+        self._close_quietly(conn)
+        return self._new_connection()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
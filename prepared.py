@@ -0,0 +1,96 @@
+import os
+import re
+import threading
+import weakref
+
+from psycopg2 import extensions, errors
+
+"""
+Server side prepared statements for the hottest queries in db.py.
+
+A statement is registered once with its SQL (with %s placeholders, like everywhere else in db.py).
+The first time a connection runs it, it's PREPAREd on that connection, from then on only
+EXECUTE name (params) is sent, so Postgres skips parsing and (after a few runs) planning.
+
+- Which statements a connection has prepared is tracked per connection object, a new connection
+  (the pool reconnected or recycled one) prepares them again on first use
+- If the server lost the statement (DISCARD ALL, a connection pooler) or the statement's result type
+  changed with the schema ("cached plan must not change result type"), it's prepared again and retried,
+  as long as the statement was the first one of its transaction
+- DB_PREPARED_STATEMENTS=0 runs the plain SQL instead, e.g behind pgbouncer in transaction mode
+
+    prepared.register("get_user", "SELECT * FROM users WHERE user_id = %s;", ("integer",))
+    prepared.execute(cursor, "get_user", (user_id,))
+"""
+
+ENABLED = os.getenv("DB_PREPARED_STATEMENTS", "1") != "0"
+
+_statements = {}  # name -> (sql, PREPARE statement, EXECUTE statement)
+_prepared = weakref.WeakKeyDictionary()  # connection -> names prepared on it
+_lock = threading.Lock()
+
+
+def register(name: str, sql: str, param_types=()):
+    """Registers sql under name, param_types are the Postgres types of the %s placeholders in order"""
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", name):
+        raise ValueError(f"Invalid statement name: {name}")
+    if sql.count("%s") != len(param_types):
+        raise ValueError(f"{name} has {sql.count('%s')} placeholders but {len(param_types)} parameter types")
+
+    numbered = iter(range(1, len(param_types) + 1))
+    body = re.sub(r"%s", lambda match: f"${next(numbered)}", sql.strip().rstrip(";"))
+    types = f" ({', '.join(param_types)})" if param_types else ""
+    placeholders = f" ({', '.join(['%s'] * len(param_types))})" if param_types else ""
+    _statements[name] = (sql, f"PREPARE {name}{types} AS {body};", f"EXECUTE {name}{placeholders};")
+
+
+def _prepared_on(con) -> set:
+    with _lock:
+        names = _prepared.get(con)
+        if names is None:
+            names = _prepared[con] = set()
+        return names
+
+
+def _prepare(cursor, name: str, names: set):
+    cursor.execute(_statements[name][1])
+    names.add(name)
+
+
+def _is_stale(error) -> bool:
+    """The statement doesn't exist on the server anymore, or its result columns changed"""
+    if isinstance(error, errors.InvalidSqlStatementName):
+        return True
+    return isinstance(error, errors.FeatureNotSupported) and "cached plan" in str(error)
+
+
+def forget(con):
+    """Forgets what was prepared on con, e.g after running DISCARD ALL on it yourself"""
+    with _lock:
+        _prepared.pop(con, None)
+
+
+def execute(cursor, name: str, params=()):
+    """Runs a registered statement on cursor, preparing it on the cursor's connection first if needed"""
+    sql, _, execute_sql = _statements[name]
+    if not ENABLED:
+        cursor.execute(sql, params)
+        return
+
+    con = cursor.connection
+    names = _prepared_on(con)
+    # Only a statement that starts its transaction can be retried, a rollback would lose earlier work
+    first_in_transaction = con.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+    try:
+        if name not in names:
+            _prepare(cursor, name, names)
+        cursor.execute(execute_sql, params)
+    except (errors.InvalidSqlStatementName, errors.FeatureNotSupported) as e:
+        if not (first_in_transaction and _is_stale(e)):
+            raise
+        con.rollback()
+        names.discard(name)
+        if isinstance(e, errors.FeatureNotSupported):
+            cursor.execute(f"DEALLOCATE {name};")
+        _prepare(cursor, name, names)
+        cursor.execute(execute_sql, params)
@@ -0,0 +1,101 @@
+import dataclasses
+import functools
+import keyword
+from itertools import starmap
+
+from psycopg2.extensions import cursor as _cursor
+
+"""
+Compact rows for the list queries.
+
+RealDictCursor builds a new dict (with its own key table) for every row. RecordCursor fetches plain tuples
+and turns them into instances of a __slots__ dataclass instead, the class is generated once per query shape
+(the column names of the result) and reused. A record takes about half the memory of a RealDictRow and
+is cheaper to build.
+
+Records can still be read like the dicts elsewhere in the code (row["price"], row.get("price"), dict(row))
+and orjson serializes them natively, so responses.FastJSONResponse encodes them without converting
+them first.
+
+    with con.cursor(cursor_factory=RecordCursor) as cursor:
+"""
+
+
+class Record:
+    """Base class of the generated record classes, gives them the read-only part of the dict interface"""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__dataclass_fields__
+
+    def __iter__(self):
+        return iter(self.__dataclass_fields__)
+
+    def __len__(self) -> int:
+        return len(self.__dataclass_fields__)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if isinstance(key, str) else default
+
+    def keys(self):
+        return self.__dataclass_fields__.keys()
+
+    def values(self):
+        return [getattr(self, name) for name in self.__dataclass_fields__]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__dataclass_fields__]
+
+    def _asdict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+
+RECORD_CLASSES_MAX_SIZE = 256
+
+
+@functools.lru_cache(maxsize=RECORD_CLASSES_MAX_SIZE)
+def record_class(columns: tuple):
+    """
+    The record class for rows with these columns, None if the names can't be attributes
+    (duplicates, keywords, "?column?" for unnamed expressions) and the rows have to be dicts.
+    Classes are kept for the most recently used query shapes only, `fields` lets clients pick many
+    """
+    if len(set(columns)) == len(columns) and all(
+            name.isidentifier() and not keyword.iskeyword(name) and not name.startswith("_") for name in columns):
+        return dataclasses.make_dataclass("Record", columns, bases=(Record,), slots=True, eq=False)
+    return None
+
+
+class RecordCursor(_cursor):
+    """Cursor that returns Record instances instead of tuples"""
+
+    def _records(self, rows) -> list:
+        columns = tuple(column.name for column in self.description)
+        cls = record_class(columns)
+        if cls is None:
+            return [dict(zip(columns, row)) for row in rows]
+        return list(starmap(cls, rows))
+
+    def fetchone(self):
+        row = super().fetchone()
+        return None if row is None else self._records((row,))[0]
+
+    def fetchmany(self, size=None):
+        return self._records(super().fetchmany(self.arraysize if size is None else size))
+
+    def fetchall(self):
+        return self._records(super().fetchall())
+
+    def __iter__(self):
+        # Named cursors (iter_* in db.py) fetch itersize rows per round trip, convert them per batch
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
@@ -0,0 +1,182 @@
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from http.cookies import SimpleCookie
+
+"""
+Read replicas for the endpoints that only read.
+
+A ReplicaSet has a ConnectionPool (pool.py) per replica and hands out connections round-robin over the
+healthy ones. A replica is ejected for eject_seconds when it can't be reached, when its pool has no free
+connection in time, or when it replays the primary's changes more than max_lag seconds behind, after
+that the next request tries it again. With every replica ejected getconn() raises NoReplicaAvailable,
+and the caller uses the primary.
+
+Replicas are behind the primary, so a client that just wrote might not see its write on a replica.
+ReadYourWritesMiddleware sets a cookie on every successful non-GET request, and while it's valid
+(DB_READ_YOUR_WRITES_SECONDS) pinned_to_primary(request) is true and the client reads from the primary.
+
+- DB_READ_YOUR_WRITES_SECONDS - how long a client reads from the primary after a write (default 5, 0 disables)
+"""
+
+READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+PIN_COOKIE = "db_primary_until"
+
+# Replay lag in seconds, 0 when the replica has replayed everything it received (an idle primary
+# sends nothing, pg_last_xact_replay_timestamp() alone would grow while nothing is behind)
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+log = logging.getLogger("db.replicas")
+
+
+class NoReplicaAvailable(Exception):
+    pass
+
+
+class _Replica:
+    __slots__ = ("name", "pool", "ejected_until", "ejections", "lag", "lag_checked_at")
+
+    def __init__(self, name: str, pool):
+        self.name = name
+        self.pool = pool
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.lag = None
+        self.lag_checked_at = 0.0
+
+
+class ReplicaSet:
+    def __init__(self, pools: dict, eject_seconds: float = 30.0, max_lag: float = 10.0,
+                 lag_check_interval: float = 5.0):
+        """pools maps a replica's name (e.g host:port) to its ConnectionPool, max_lag 0 doesn't check the lag"""
+        if not pools:
+            raise ValueError("A ReplicaSet needs at least one replica")
+        self._replicas = [_Replica(name, pool) for name, pool in pools.items()]
+        self.eject_seconds = eject_seconds
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._checked_out = {}  # id(conn) -> _Replica
+
+    # ---------- lifecycle ----------
+    def open(self):
+        """Opens the replica pools, a replica that can't be reached is ejected instead of failing the startup"""
+        for replica in self._replicas:
+            try:
+                replica.pool.open()
+            except Exception as e:
+                self._eject(replica, f"unreachable ({e})")
+
+    def close(self):
+        for replica in self._replicas:
+            replica.pool.close()
+
+    # ---------- checkout / checkin ----------
+    def getconn(self):
+        now = time.monotonic()
+        start = next(self._next)
+        candidates = self._replicas[start % len(self._replicas):] + self._replicas[:start % len(self._replicas)]
+        for replica in candidates:
+            if replica.ejected_until > now:
+                continue
+            try:
+                conn = replica.pool.getconn()
+            except Exception as e:
+                self._eject(replica, f"unreachable ({e})")
+                continue
+            if self.max_lag and now - replica.lag_checked_at >= self.lag_check_interval:
+                try:
+                    lagging = self._check_lag(replica, conn, now)
+                except Exception as e:
+                    replica.pool.putconn(conn)
+                    self._eject(replica, f"lag check failed ({e})")
+                    continue
+                if lagging:
+                    replica.pool.putconn(conn)
+                    self._eject(replica, f"{replica.lag:.1f}s behind the primary")
+                    continue
+            with self._lock:
+                self._checked_out[id(conn)] = replica
+            return conn
+        raise NoReplicaAvailable("No healthy replica")
+
+    def putconn(self, conn):
+        with self._lock:
+            replica = self._checked_out.pop(id(conn), None)
+        if replica is None:
+            raise ValueError("Connection does not belong to this replica set")
+        replica.pool.putconn(conn)
+
+    # ---------- statistics ----------
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            replica.name: {
+                "healthy": replica.ejected_until <= now,
+                "ejected_for": round(max(replica.ejected_until - now, 0.0), 1),
+                "ejections": replica.ejections,
+                "lag_seconds": None if replica.lag is None else round(replica.lag, 3),
+                "pool": replica.pool.stats(),
+            }
+            for replica in self._replicas
+        }
+
+    # ---------- helpers ----------
+    def _check_lag(self, replica: _Replica, conn, now: float) -> bool:
+        with conn.cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            replica.lag = float(cursor.fetchone()[0])
+        conn.rollback()
+        replica.lag_checked_at = now
+        return replica.lag > self.max_lag
+
+    def _eject(self, replica: _Replica, reason: str):
+        with self._lock:
+            replica.ejected_until = time.monotonic() + self.eject_seconds
+            replica.ejections += 1
+            # Checked again as soon as it's back
+            replica.lag_checked_at = 0.0
+        log.warning("Replica %s ejected for %ss: %s", replica.name, self.eject_seconds, reason)
+
+
+# ========== READ YOUR WRITES ==========
+def pinned_to_primary(request) -> bool:
+    """Whether the client wrote something in the last READ_YOUR_WRITES_SECONDS, going by its cookie"""
+    try:
+        return float(request.cookies.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    """ASGI middleware, pins a client to the primary for `seconds` after a successful non-GET request"""
+
+    def __init__(self, app, seconds: float = READ_YOUR_WRITES_SECONDS):
+        self.app = app
+        self.seconds = seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.seconds or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                cookie = SimpleCookie()
+                cookie[PIN_COOKIE] = f"{time.time() + self.seconds:.3f}"
+                cookie[PIN_COOKIE].update({"max-age": str(math.ceil(self.seconds)), "path": "/",
+                                           "httponly": True, "samesite": "Lax"})
+                header = cookie[PIN_COOKIE].OutputString().encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", header)]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
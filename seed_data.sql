@@ -83,6 +83,12 @@ INSERT INTO house_listing (agent_id, category_id, user_id, title, description, p
 
 (2, 3, 2, 'Rymligt parhus i Täby', 'Välplanerat parhus i två plan. Ljust och fräscht med renoverat kök 2021. Fyra sovrum och två badrum. Stor altan och trädgård. Barnvänligt område med nära till skolor och natur.', 8900000, 'Enhagsvägen 15', 'Täby', '183 52', 6, 155, 250, 1988, NULL, false, 3600, 0, 59.4389, 18.0712, 'active', '2024-11-29 10:30:00');
 
+-- Full text search document (db.create_listing fills it in for listings created through the api)
+UPDATE house_listing
+SET search_vector = setweight(to_tsvector('swedish', title), 'A') ||
+                    setweight(to_tsvector('swedish', description), 'B')
+WHERE search_vector IS NULL;
+
 -- 6. LISTING IMAGES
 INSERT INTO listing_images (listing_id, image_url, display_order, is_primary, caption) VALUES
 -- Images for Listing 1 (Lyxig takvåning)
@@ -142,6 +148,11 @@ INSERT INTO bids (listing_id, user_id, amount, bid_date, status, comment) VALUES
 (7, 6, 5050000, '2024-12-10 14:00:00', 'pending', 'Kan flytta in direkt'),
 (9, 14, 4800000, '2024-12-11 10:30:00', 'pending', NULL);
 
+-- Cached highest bid per listing, rejected bids don't count (db.create_bid keeps it up to date for bids placed through the api)
+UPDATE house_listing h SET highest_bid = b.highest_bid
+FROM (SELECT listing_id, max(amount) FILTER (WHERE status <> 'rejected') AS highest_bid FROM bids GROUP BY listing_id) b
+WHERE h.listing_id = b.listing_id;
+
 -- 8. FAVORITES
 INSERT INTO favorites (listing_id, user_id) VALUES
 (1, 1),
@@ -0,0 +1,59 @@
+"""
+The city filters of db.listing_filters and the indexes they depend on (bench.py explain-city).
+
+Needs psycopg2 and the database configured in .env with the tables created (db_setup.py),
+the EXPLAIN tests are skipped when it can't be reached.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+psycopg2 = pytest.importorskip("psycopg2")
+pytest.importorskip("httpx")  # imported by bench.py
+
+import bench  # noqa: E402
+import db  # noqa: E402
+from db_setup import get_connection  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def con():
+    try:
+        con = get_connection()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no database: {e}")
+    yield con
+    con.close()
+
+
+@pytest.mark.parametrize("city_match, sql, param", [
+    ("substring", "city ILIKE %s", "%holm%"),
+    ("prefix", "lower(city) LIKE lower(%s)", "stock%"),
+    ("exact", "lower(city) = lower(%s)", "stock"),
+])
+def test_listing_filters_city(city_match, sql, param):
+    where, params = db.listing_filters(city=param.strip("%"), city_match=city_match)
+    assert where == f"1=1 AND {sql}"
+    assert params == [param]
+
+
+def test_listing_filters_escapes_like():
+    where, params = db.listing_filters(city="50%_", city_match="prefix")
+    assert params == ["50\\%\\_%"]
+
+
+def test_listing_filters_unknown_mode():
+    with pytest.raises(ValueError):
+        db.listing_filters(city="Stockholm", city_match="fuzzy")
+
+
+@pytest.mark.parametrize("check", bench.CITY_INDEX_CHECKS, ids=[check[0] for check in bench.CITY_INDEX_CHECKS])
+def test_city_filter_uses_index(con, check):
+    row = next(row for row in bench.city_index_plans(con) if row["city_match"] == check[0])
+    assert row["used"], f"{row['index']} isn't used for city_match={row['city_match']}:\n{row['plan']}"